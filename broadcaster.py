@@ -4,10 +4,19 @@ import logging
 from aiogram import Bot
 from aiogram.types import Message
 from user_manager import UserManager
-from ds_utils import add_message_to_deepseek_dialog
+from ds_utils import add_broadcast_to_deepseek_dialogs
+from telegram_sender import send_priority, PRIORITY_BROADCAST
+from sharding import get_shard_cluster
+from shutdown import shutdown_coordinator
 
 logger = logging.getLogger(__name__)
 
+# Сколько доставленных сообщений копить перед пакетной записью в истории диалогов
+DIALOG_HISTORY_BATCH_SIZE = 200
+
+# Сколько сообщений рассылки может одновременно ждать в очереди планировщика отправки
+BROADCAST_CONCURRENCY = 20
+
 async def send_broadcast_message(bot: Bot, user_manager: UserManager, message_text: str):
     logger.info(f"DEBUG_BROADCAST: В send_broadcast_message получен message_text: '{message_text}'")
     all_user_ids = user_manager.get_all_user_ids()
@@ -15,30 +24,65 @@ async def send_broadcast_message(bot: Bot, user_manager: UserManager, message_te
     logger.info(f"Начинается рассылка сообщения '{message_text[:50]}...' для {len(all_user_ids)} пользователей.")
     sent_count = 0
     blocked_count = 0
+    delivered_ids = []
+    history_tasks = []
+    pending_ids = iter(enumerate(all_user_ids))
+
+    def flush_history():
+        # Запись истории идет в фоне и не задерживает отправку следующим пользователям
+        if delivered_ids:
+            history_tasks.append(asyncio.create_task(
+                add_broadcast_to_deepseek_dialogs(list(delivered_ids), message_text, bot)
+            ))
+            delivered_ids.clear()
+
+    async def worker():
+        nonlocal sent_count, blocked_count
+        # Темп отправки задает планировщик (telegram_sender): фиксированные паузы не нужны
+        for i, user_id in pending_ids:
+            logger.info(f"DEBUG_BROADCAST: Обрабатываем пользователя {i+1}/{len(all_user_ids)}: {user_id}")
+            try:
+                await bot.send_message(chat_id=user_id, text=message_text, parse_mode='HTML')
+                sent_count += 1
+                logger.info(f"DEBUG_BROADCAST: Сообщение успешно отправлено в чат {user_id}")
 
-    for i, user_id in enumerate(all_user_ids):
-        logger.info(f"DEBUG_BROADCAST: Обрабатываем пользователя {i+1}/{len(all_user_ids)}: {user_id}")
-        try:
-            await bot.send_message(chat_id=user_id, text=message_text, parse_mode='HTML')
-            sent_count += 1
-            logger.info(f"DEBUG_BROADCAST: Сообщение успешно отправлено в чат {user_id}")
-
-            # --- ЭТО НУЖНО ДОБАВИТЬ: ЗАПИСЬ В ИСТОРИЮ DEEPSEEK ---
-            add_message_to_deepseek_dialog(user_id=user_id, role="assistant", content=message_text, bot=bot)
-            # --- КОНЕЦ ДОБАВЛЕНИЯ ---
-
-            await asyncio.sleep(0.1)
-        except Exception as e:
-            logger.error(f"DEBUG_BROADCAST: Не удалось отправить сообщение в чат {user_id}: {e}", exc_info=True)
-            if "bot was blocked by the user" in str(e) or "chat not found" in str(e).lower():
-                blocked_count += 1
-                logger.info(f"DEBUG_BROADCAST: Удаляем заблокированного пользователя {user_id}")
-                user_manager.remove_user(user_id)
-            await asyncio.sleep(0.1)
+                delivered_ids.append(user_id)
+                if len(delivered_ids) >= DIALOG_HISTORY_BATCH_SIZE:
+                    flush_history()
+            except Exception as e:
+                logger.error(f"DEBUG_BROADCAST: Не удалось отправить сообщение в чат {user_id}: {e}", exc_info=True)
+                if "bot was blocked by the user" in str(e) or "chat not found" in str(e).lower():
+                    blocked_count += 1
+                    logger.info(f"DEBUG_BROADCAST: Удаляем заблокированного пользователя {user_id}")
+                    user_manager.remove_user(user_id)
+
+    # Рассылка идет с низким приоритетом: ответы пользователям отправляются раньше
+    try:
+        with send_priority(PRIORITY_BROADCAST):
+            await asyncio.gather(*(worker() for _ in range(min(BROADCAST_CONCURRENCY, len(all_user_ids)))))
+    finally:
+        # Рассылка, прерванная остановкой бота, все равно записывает доставленное в истории диалогов
+        flush_history()
+        if history_tasks:
+            await asyncio.gather(*history_tasks)
 
     logger.info(f"Рассылка завершена. Отправлено {sent_count} сообщений. Бот был заблокирован {blocked_count} пользователями.")
     return sent_count, blocked_count
 
+async def broadcast_all_shards(message_text: str):
+    """
+    Рассылка при разделении на процессы: каждый обработчик рассылает своим пользователям.
+
+    Returns:
+        tuple: (отправлено, заблокировано, номера обработчиков, не выполнивших рассылку)
+    """
+    cluster = get_shard_cluster()
+    results = await cluster.call_all("broadcast", timeout=None, text=message_text)
+    sent = sum(result[0] for result in results.values())
+    blocked = sum(result[1] for result in results.values())
+    failed = [index for index in range(cluster.count) if index not in results]
+    return sent, blocked, failed
+
 async def broadcast_command_handler(
     message: Message,
     bot: Bot,
@@ -70,10 +114,16 @@ async def broadcast_command_handler(
 
     try:
         logger.info(f"DEBUG_BROADCAST_CMD: Вызов send_broadcast_message с текстом: '{current_broadcast_text}'")
-        sent, blocked = await send_broadcast_message(bot, user_manager, current_broadcast_text)
+        failed_shards = []
+        if get_shard_cluster():
+            sent, blocked, failed_shards = await broadcast_all_shards(current_broadcast_text)
+        else:
+            sent, blocked = await send_broadcast_message(bot, user_manager, current_broadcast_text)
         await message.answer(f"Рассылка завершена. Отправлено {sent} сообщений. Не удалось отправить (бот заблокирован/чат не найден) {blocked} пользователям.")
+        if failed_shards:
+            await message.answer(f"⚠️ Обработчики {', '.join(map(str, failed_shards))} не выполнили рассылку: их пользователи сообщение не получили. Подробности в логах.")
         if sheets_logger_instance:
-            asyncio.create_task(sheets_logger_instance.log_message_async(message.from_user.full_name, message.from_user.id, f"/broadcast: Отправлено {sent}, заблокировано {blocked}", is_user=True))
+            shutdown_coordinator.track(sheets_logger_instance.log_message_async(message.from_user.full_name, message.from_user.id, f"/broadcast: Отправлено {sent}, заблокировано {blocked}", is_user=True))
     except Exception as e:
         logger.error(f"DEBUG_BROADCAST_CMD: Ошибка при выполнении рассылки: {e}", exc_info=True)
         await message.answer("Произошла ошибка при выполнении рассылки. Проверьте логи.")
\ No newline at end of file
@@ -1,23 +1,42 @@
 
 import json
 import os
+import hashlib
+import asyncio
 import logging
-from typing import Dict, List, Any
+import threading
+from typing import Callable, Dict, List, Any, Iterable, Optional
 from datetime import datetime
 
 logger = logging.getLogger(__name__)
 
 class DialogManager:
-    def __init__(self, data_dir: str = "dialogs"):
+    def __init__(self, data_dir: str = "dialogs", user_filter: Optional[Callable[[int], bool]] = None,
+                 shared_content_name: str = "shared_content.json"):
         """
         Инициализация менеджера диалогов с постоянным хранением
         
         Args:
             data_dir: Директория для хранения файлов диалогов
+            user_filter: Загружать диалоги только пользователей, для которых функция возвращает True
+                (при разделении на процессы каждый обработчик владеет своей частью диалогов)
+            shared_content_name: Файл общей таблицы содержимого; у каждого обработчика свой,
+                чтобы очистка неиспользуемых записей не удаляла тексты из чужих диалогов
         """
         self.data_dir = data_dir
+        self.user_filter = user_filter
+        self.shared_content_name = shared_content_name
         self._ensure_data_dir()
         self.dialogs_cache = {}  # Кэш диалогов в памяти для быстрого доступа
+        # Номера изменений диалогов: не даем фоновой записи старого снимка
+        # перезаписать более новый файл
+        self._generations: Dict[int, int] = {}
+        self._written_generations: Dict[int, int] = {}
+        self._write_lock = threading.Lock()
+        # Общая таблица содержимого (хеш -> текст): текст рассылки хранится
+        # один раз, а в историях лежат только ссылки на него
+        self.shared_content: Dict[str, str] = {}
+        self._load_shared_content()
         self._load_all_dialogs()
         
     def _ensure_data_dir(self) -> None:
@@ -30,6 +49,65 @@ class DialogManager:
         """Возвращает путь к файлу диалога пользователя"""
         return os.path.join(self.data_dir, f"dialog_{user_id}.json")
     
+    def _get_shared_content_file_path(self) -> str:
+        """Возвращает путь к файлу общей таблицы содержимого"""
+        return os.path.join(self.data_dir, self.shared_content_name)
+
+    def _load_shared_content(self) -> None:
+        """Загружает общую таблицу содержимого"""
+        file_path = self._get_shared_content_file_path()
+        if not os.path.exists(file_path):
+            # Первый запуск обработчика: ссылки в его диалогах ведут в общую таблицу одного процесса
+            file_path = os.path.join(self.data_dir, "shared_content.json")
+        if not os.path.exists(file_path):
+            return
+        try:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                self.shared_content = json.load(f)
+        except Exception as e:
+            logger.error(f"Ошибка при чтении общей таблицы содержимого: {e}")
+
+    def _save_shared_content(self, shared_content: Dict[str, str]) -> None:
+        """Атомарно сохраняет общую таблицу содержимого"""
+        file_path = self._get_shared_content_file_path()
+        tmp_path = f"{file_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(shared_content, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, file_path)
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении общей таблицы содержимого: {e}")
+
+    def _put_shared_content(self, content: str) -> str:
+        """Кладет текст в общую таблицу и возвращает ссылку на него"""
+        content_ref = hashlib.sha256(content.encode('utf-8')).hexdigest()
+        self.shared_content.setdefault(content_ref, content)
+        return content_ref
+
+    def _prune_shared_content(self) -> None:
+        """Удаляет из общей таблицы тексты, на которые не ссылается ни один диалог"""
+        used_refs = {
+            msg["content_ref"]
+            for dialog in self.dialogs_cache.values()
+            for msg in dialog.get("messages", [])
+            if "content_ref" in msg
+        }
+        unused_refs = set(self.shared_content) - used_refs
+        if not unused_refs:
+            return
+        for content_ref in unused_refs:
+            del self.shared_content[content_ref]
+        self._save_shared_content(dict(self.shared_content))
+        logger.info(f"Удалено {len(unused_refs)} неиспользуемых записей общей таблицы содержимого")
+
+    def _resolve_message(self, msg: Dict[str, Any]) -> Dict[str, Any]:
+        """Подставляет текст из общей таблицы вместо ссылки"""
+        if "content_ref" not in msg:
+            return msg
+        resolved = {k: v for k, v in msg.items() if k != "content_ref"}
+        resolved["content"] = self.shared_content.get(msg["content_ref"], "")
+        return resolved
+
     def _load_all_dialogs(self) -> None:
         """Загружает все существующие диалоги в кэш"""
         if not os.path.exists(self.data_dir):
@@ -39,11 +117,14 @@ class DialogManager:
             if filename.startswith("dialog_") and filename.endswith(".json"):
                 try:
                     user_id = int(filename[7:-5])  # Извлекаем ID из имени файла
+                    if self.user_filter and not self.user_filter(user_id):
+                        continue
                     self.dialogs_cache[user_id] = self._load_dialog_from_file(user_id)
                 except Exception as e:
                     logger.error(f"Ошибка при загрузке диалога из файла {filename}: {e}")
         
         logger.info(f"Загружено {len(self.dialogs_cache)} диалогов из файлов")
+        self._prune_shared_content()
     
     def _load_dialog_from_file(self, user_id: int) -> Dict[str, Any]:
         """Загружает диалог пользователя из файла"""
@@ -63,16 +144,30 @@ class DialogManager:
         if user_id not in self.dialogs_cache:
             return
             
+        dialog_data = self.dialogs_cache[user_id].copy()
+        dialog_data["last_updated"] = datetime.now().isoformat()
+        self._write_dialog_file(user_id, dialog_data, self._generations.get(user_id, 0))
+
+    def _bump_generation(self, user_id: int) -> int:
+        """Отмечает изменение диалога и возвращает его новый номер"""
+        generation = self._generations.get(user_id, 0) + 1
+        self._generations[user_id] = generation
+        return generation
+
+    def _write_dialog_file(self, user_id: int, dialog_data: Dict[str, Any], generation: int) -> None:
+        """Записывает снимок диалога в файл, если на диске нет более новой версии"""
         file_path = self._get_dialog_file_path(user_id)
-        try:
-            dialog_data = self.dialogs_cache[user_id].copy()
-            dialog_data["last_updated"] = datetime.now().isoformat()
-            
-            with open(file_path, 'w', encoding='utf-8') as f:
-                json.dump(dialog_data, f, ensure_ascii=False, indent=2)
-            logger.debug(f"Диалог пользователя {user_id} сохранен в файл")
-        except Exception as e:
-            logger.error(f"Ошибка при сохранении диалога пользователя {user_id}: {e}")
+        with self._write_lock:
+            if self._written_generations.get(user_id, -1) > generation:
+                logger.debug(f"Пропущена запись устаревшего снимка диалога пользователя {user_id}")
+                return
+            try:
+                with open(file_path, 'w', encoding='utf-8') as f:
+                    json.dump(dialog_data, f, ensure_ascii=False, indent=2)
+                self._written_generations[user_id] = generation
+                logger.debug(f"Диалог пользователя {user_id} сохранен в файл")
+            except Exception as e:
+                logger.error(f"Ошибка при сохранении диалога пользователя {user_id}: {e}")
     
     def get_dialog(self, user_id: int) -> Dict[str, Any]:
         """Получает диалог пользователя"""
@@ -92,19 +187,92 @@ class DialogManager:
         }
         
         self.dialogs_cache[user_id]["messages"].append(message_data)
+        self._bump_generation(user_id)
         self._save_dialog_to_file(user_id)
         logger.debug(f"Добавлено сообщение в диалог пользователя {user_id}: {role} - {content[:50]}...")
     
+    def add_message_bulk(self, user_ids: Iterable[int], role: str, content: str) -> Dict[int, tuple]:
+        """
+        Добавляет одно и то же сообщение в диалоги многих пользователей без записи на диск.
+        Текст кладется в общую таблицу один раз, в истории попадает только ссылка.
+
+        Args:
+            user_ids: ID пользователей
+            role: Роль сообщения
+            content: Содержимое сообщения
+
+        Returns:
+            Снимки диалогов для последующей записи через save_dialog_snapshots
+        """
+        timestamp = datetime.now().isoformat()
+        content_ref = self._put_shared_content(content)
+        snapshots = {}
+        for user_id in user_ids:
+            dialog = self.dialogs_cache.setdefault(user_id, {"messages": []})
+            dialog["messages"].append({
+                "role": role,
+                "content_ref": content_ref,
+                "timestamp": timestamp
+            })
+            # Снимок делается в потоке цикла событий, чтобы запись в другом
+            # потоке не видела параллельных изменений истории
+            snapshots[user_id] = (self._bump_generation(user_id), {
+                **dialog,
+                "messages": list(dialog["messages"]),
+                "last_updated": timestamp
+            })
+        return snapshots
+
+    def save_dialog_snapshots(self, snapshots: Dict[int, tuple], shared_content: Dict[str, str] = None) -> None:
+        """Записывает пачку снимков диалогов на диск"""
+        # Таблица содержимого пишется первой, чтобы ссылки в файлах диалогов всегда разрешались
+        if shared_content is not None:
+            self._save_shared_content(shared_content)
+        for user_id, (generation, dialog_data) in snapshots.items():
+            self._write_dialog_file(user_id, dialog_data, generation)
+        logger.info(f"Пакетно сохранено {len(snapshots)} диалогов")
+
+    async def add_message_bulk_async(self, user_ids: Iterable[int], role: str, content: str) -> None:
+        """
+        Пакетно добавляет сообщение в диалоги многих пользователей.
+        Память обновляется сразу, запись файлов выполняется в отдельном потоке.
+        """
+        snapshots = self.add_message_bulk(user_ids, role, content)
+        if not snapshots:
+            return
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.save_dialog_snapshots, snapshots, dict(self.shared_content))
+
+    def flush(self) -> int:
+        """
+        Дописывает на диск диалоги, последнее изменение которых еще не записано
+        (фоновая запись не завершилась или закончилась ошибкой). Вызывается при остановке бота.
+
+        Returns:
+            int: Количество записанных диалогов
+        """
+        unsaved = [
+            user_id for user_id, generation in list(self._generations.items())
+            if self._written_generations.get(user_id, -1) < generation and user_id in self.dialogs_cache
+        ]
+        if unsaved:
+            self._save_shared_content(dict(self.shared_content))
+            for user_id in unsaved:
+                self._save_dialog_to_file(user_id)
+            logger.info(f"При остановке записано {len(unsaved)} диалогов")
+        return len(unsaved)
+
     def clear_dialog(self, user_id: int) -> None:
         """Очищает диалог пользователя"""
         self.dialogs_cache[user_id] = {"messages": []}
+        self._bump_generation(user_id)
         self._save_dialog_to_file(user_id)
         logger.info(f"Диалог пользователя {user_id} очищен")
     
     def get_messages(self, user_id: int) -> List[Dict[str, str]]:
-        """Получает все сообщения диалога пользователя"""
+        """Получает все сообщения диалога пользователя с разрешенными ссылками на общий текст"""
         dialog = self.get_dialog(user_id)
-        return dialog.get("messages", [])
+        return [self._resolve_message(msg) for msg in dialog.get("messages", [])]
     
     def get_all_users_with_dialogs(self) -> List[int]:
         """Возвращает список всех пользователей, у которых есть диалоги"""
@@ -117,8 +285,13 @@ class DialogManager:
             backup_file = f"dialogs_backup_{timestamp}.json"
         
         try:
+            # В резервную копию попадает полный текст, без ссылок на общую таблицу
+            backup_data = {
+                user_id: {**dialog, "messages": self.get_messages(user_id)}
+                for user_id, dialog in self.dialogs_cache.items()
+            }
             with open(backup_file, 'w', encoding='utf-8') as f:
-                json.dump(self.dialogs_cache, f, ensure_ascii=False, indent=2)
+                json.dump(backup_data, f, ensure_ascii=False, indent=2)
             logger.info(f"Создана резервная копия диалогов: {backup_file}")
             return backup_file
         except Exception as e:
@@ -1,39 +1,16 @@
 import os
-import json
 import logging
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
+from typing import Tuple
+from google_executor import google_executor
+from google_clients import get_service, execute
+from prompt_registry import DEFAULT_PROMPT
 
 logger = logging.getLogger(__name__)
 
 class DocsLoader:
     def __init__(self):
-        # Пытаемся получить учетные данные из переменной окружения
-        google_creds_json = os.getenv('GOOGLE_CREDENTIALS_JSON')
-        
-        if google_creds_json:
-            try:
-                creds_data = json.loads(google_creds_json)
-                logger.info("Используются учетные данные Google из переменной окружения")
-            except json.JSONDecodeError as e:
-                logger.error(f"Ошибка парсинга GOOGLE_CREDENTIALS_JSON: {e}")
-                raise
-        else:
-            # Если переменная окружения не установлена, пытаемся загрузить из файла
-            try:
-                with open('gcreds.json', 'r') as f:
-                    creds_data = json.load(f)
-                logger.info("Используются учетные данные Google из файла gcreds.json")
-            except FileNotFoundError:
-                logger.error("Файл gcreds.json не найден и GOOGLE_CREDENTIALS_JSON не установлена.")
-                raise
-
-        self.credentials = service_account.Credentials.from_service_account_info(
-            creds_data,
-            scopes=['https://www.googleapis.com/auth/documents.readonly']
-        )
-
-        self.service = build('docs', 'v1', credentials=self.credentials) # !!! ИЗМЕНЕНО С 'v4' НА 'v1' !!!
+        # Учетные данные и клиент общие для всех модулей (google_clients)
+        self.service = get_service('docs', 'v1')
 
         self.default_document_id = os.getenv('GOOGLE_DOC_ID')
         if not self.default_document_id or self.default_document_id == 'your_document_id_here':
@@ -42,6 +19,38 @@ class DocsLoader:
 
         logger.info(f"DocsLoader инициализирован. Основной document_id: {self.default_document_id}")
 
+    def fetch_document(self, document_id: str = None) -> Tuple[str, str]:
+        """
+        Загружает текст документа и его revisionId.
+        Заголовки документа помечаются "#", "##", ... в начале строки.
+        В отличие от get_document_content, ошибки не подменяются промптом по умолчанию.
+
+        Returns:
+            Tuple[str, str]: (текст, revisionId)
+        """
+        doc_id_to_fetch = document_id if document_id else self.default_document_id
+        document = execute(self.service.documents().get(documentId=doc_id_to_fetch))
+        content = []
+        for element in document.get('body', {}).get('content', []):
+            if 'paragraph' in element:
+                paragraph = element['paragraph']
+                # Заголовки документа размечаются как в markdown: по ним инструкция делится на разделы
+                style = paragraph.get('paragraphStyle', {}).get('namedStyleType', '')
+                if style == 'TITLE':
+                    content.append('# ')
+                elif style.startswith('HEADING_'):
+                    content.append('#' * int(style[len('HEADING_'):]) + ' ')
+                for text_element in paragraph.get('elements', []):
+                    if 'textRun' in text_element:
+                        content.append(text_element['textRun']['content'])
+        return ''.join(content).strip(), document.get('revisionId', '')
+
+    def get_revision_id(self, document_id: str = None) -> str:
+        """Запрашивает только revisionId документа (без содержимого)"""
+        doc_id_to_fetch = document_id if document_id else self.default_document_id
+        document = execute(self.service.documents().get(documentId=doc_id_to_fetch, fields='revisionId'))
+        return document.get('revisionId', '')
+
     def get_document_content(self, document_id: str = None):
         doc_id_to_fetch = document_id if document_id else self.default_document_id
 
@@ -50,16 +59,7 @@ class DocsLoader:
             return self._get_default_prompt()
 
         try:
-            document = self.service.documents().get(documentId=doc_id_to_fetch).execute()
-            content = []
-            for element in document.get('body', {}).get('content', []):
-                if 'paragraph' in element:
-                    paragraph = element['paragraph']
-                    for text_element in paragraph.get('elements', []):
-                        if 'textRun' in text_element:
-                            content.append(text_element['textRun']['content'])
-
-            full_text = ''.join(content).strip()
+            full_text, _ = self.fetch_document(doc_id_to_fetch)
             if not full_text:
                 logger.warning(f"Google Doc (ID: {doc_id_to_fetch}) пуст или не содержит текста.")
                 return "" if document_id else self._get_default_prompt() # Возвращаем "" для пустых тематических доков
@@ -71,8 +71,10 @@ class DocsLoader:
             logger.error(f"Ошибка загрузки документа из Google Docs (ID: {doc_id_to_fetch}): {e}", exc_info=True)
             return "" if document_id else self._get_default_prompt()
 
+    async def get_document_content_async(self, document_id: str = None):
+        """Загружает документ в пуле Google, не блокируя event loop"""
+        return await google_executor.run(self.get_document_content, document_id)
+
     def _get_default_prompt(self):
         logger.warning("Используется системный промпт по умолчанию.")
-        return """Я - ассистент, специализирующийся на воспитании детей.
-Моя цель - помочь родителям справиться с трудностями, связанными с воспитанием, обучением, мотивацией, дисциплиной и другими вещами.
-Я даю практические советы, объясняю техники и приемы воспитания, составляю планы и использую все свои знания, чтобы помощь родителям в общении с ребенком."""
\ No newline at end of file
+        return DEFAULT_PROMPT
@@ -0,0 +1,213 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from typing import NamedTuple, Dict, List, Optional, FrozenSet, Any
+
+from google_executor import google_executor
+from prompt_index import tokenize
+from prompt_registry import PROMPT_OFFLINE
+
+logger = logging.getLogger(__name__)
+
+# Описание тематических документов: {"тема": {"doc_id": "...", "keywords": ["сон", "засыпание", ...]}}
+TOPIC_DOCS_FILE = os.getenv('TOPIC_DOCS_FILE', 'topic_docs.json')
+
+# Локальная копия загруженных тематических документов (для быстрого старта и работы без Google)
+TOPIC_DOCS_CACHE_FILE = os.getenv('TOPIC_DOCS_CACHE_FILE', 'topic_docs_cache.json')
+
+# Сколько документов загружается из Google одновременно (пул Google общий с логированием)
+TOPIC_DOCS_CONCURRENCY = int(os.getenv('TOPIC_DOCS_CONCURRENCY', '4'))
+
+# Сколько тематических документов можно добавить к одному запросу
+TOPIC_DOCS_MAX_ATTACHED = int(os.getenv('TOPIC_DOCS_MAX_ATTACHED', '2'))
+
+# Как часто проверять изменения тематических документов (секунд)
+TOPIC_DOCS_POLL_INTERVAL = int(os.getenv('TOPIC_DOCS_POLL_INTERVAL', '300'))
+
+class TopicDocument(NamedTuple):
+    """Загруженный тематический документ (неизменяемый)"""
+    topic: str
+    doc_id: str
+    text: str
+    revision_id: str
+    fetched_at: float
+
+class DocumentRegistry:
+    def __init__(self, docs_loader, config_path: str = TOPIC_DOCS_FILE, cache_path: str = TOPIC_DOCS_CACHE_FILE,
+                 offline: bool = PROMPT_OFFLINE):
+        """
+        Реестр тематических документов Google Docs.
+
+        Документы загружаются параллельно, для каждого отслеживается revisionId,
+        поэтому неизмененные документы повторно не скачиваются. К запросу добавляются
+        только документы, чьи ключевые слова встречаются в вопросе.
+
+        Args:
+            docs_loader: DocsLoader (None — Google Docs недоступен)
+            config_path: Файл с описанием тем
+            cache_path: Путь к локальному кэшу документов
+            offline: Не обращаться к Google Docs, использовать только кэш
+        """
+        self.docs_loader = docs_loader
+        self.cache_path = cache_path
+        self.offline = offline or docs_loader is None
+        self.topics: Dict[str, str] = {}  # тема -> doc_id
+        self.keywords: Dict[str, FrozenSet[str]] = {}  # тема -> основы ключевых слов
+        self.documents: Dict[str, TopicDocument] = {}
+        self.stats = {"fetched": 0, "unchanged": 0, "failed": 0, "matched_requests": 0}
+        self._semaphore = asyncio.Semaphore(TOPIC_DOCS_CONCURRENCY)
+        self._revalidate_task: Optional[asyncio.Task] = None
+        self._load_config(config_path)
+
+    def _load_config(self, config_path: str) -> None:
+        if not os.path.exists(config_path):
+            logger.info(f"[ТЕМЫ] Файл {config_path} не найден, тематические документы не используются")
+            return
+        try:
+            with open(config_path, 'r', encoding='utf-8') as f:
+                config = json.load(f)
+        except Exception as e:
+            logger.error(f"[ТЕМЫ] Ошибка при чтении {config_path}: {e}")
+            return
+        for topic, entry in config.items():
+            doc_id = entry.get("doc_id")
+            if not doc_id:
+                logger.warning(f"[ТЕМЫ] У темы '{topic}' не указан doc_id, тема пропущена")
+                continue
+            self.topics[topic] = doc_id
+            # Название темы тоже считается ключевым словом
+            self.keywords[topic] = frozenset(tokenize(" ".join([topic] + entry.get("keywords", []))))
+        logger.info(f"[ТЕМЫ] Загружено описание {len(self.topics)} тем из {config_path}")
+
+    def load_cached(self) -> int:
+        """
+        Загружает документы из локального кэша (без обращения к сети).
+
+        Returns:
+            int: Количество загруженных документов
+        """
+        if not os.path.exists(self.cache_path):
+            return 0
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except Exception as e:
+            logger.error(f"[ТЕМЫ] Ошибка при загрузке кэша документов из {self.cache_path}: {e}")
+            return 0
+        for topic, doc_id in self.topics.items():
+            cached = data.get(topic)
+            # Кэш действителен, только если тема все еще указывает на тот же документ
+            if cached and cached.get("doc_id") == doc_id:
+                self.documents[topic] = TopicDocument(topic, doc_id, cached["text"], cached.get("revision_id", ""),
+                                                      cached.get("fetched_at", 0.0))
+        logger.info(f"[ТЕМЫ] Из локального кэша загружено {len(self.documents)}/{len(self.topics)} документов")
+        return len(self.documents)
+
+    def _save_cache(self) -> None:
+        """Атомарно сохраняет загруженные документы"""
+        # У каждого процесса свой временный файл: обработчики (sharding) сохраняют кэш независимо
+        tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({document.topic: document._asdict() for document in self.documents.values()},
+                          f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.cache_path)
+        except Exception as e:
+            logger.error(f"[ТЕМЫ] Ошибка при сохранении кэша документов в {self.cache_path}: {e}")
+
+    async def initialize(self) -> None:
+        """Загружает документы из кэша сразу, а проверку актуальности выполняет в фоне"""
+        if not self.topics:
+            return
+        self.load_cached()
+        if self.offline:
+            return
+        if self.documents:
+            self._revalidate_task = asyncio.create_task(self.refresh())
+        else:
+            await self.refresh(force=True)
+
+    async def _refresh_one(self, topic: str, force: bool) -> bool:
+        doc_id = self.topics[topic]
+        current = self.documents.get(topic)
+        async with self._semaphore:
+            try:
+                if not force and current and current.revision_id:
+                    revision_id = await google_executor.run(self.docs_loader.get_revision_id, doc_id)
+                    if revision_id == current.revision_id:
+                        self.stats["unchanged"] += 1
+                        return False
+                text, revision_id = await google_executor.run(self.docs_loader.fetch_document, doc_id)
+            except Exception as e:
+                self.stats["failed"] += 1
+                logger.error(f"[ТЕМЫ] Не удалось загрузить документ темы '{topic}' ({doc_id}): {e}")
+                return False
+
+        self.stats["fetched"] += 1
+        self.documents[topic] = TopicDocument(topic, doc_id, text, revision_id, time.time())
+        logger.info(f"[ТЕМЫ] Документ темы '{topic}' загружен (ревизия {revision_id or '-'}, {len(text)} символов)")
+        return True
+
+    async def refresh(self, force: bool = False) -> List[str]:
+        """
+        Параллельно проверяет и загружает все тематические документы.
+
+        Args:
+            force: Загрузить документы, даже если revisionId не изменился
+
+        Returns:
+            List[str]: Темы, документы которых были загружены заново
+        """
+        if self.offline or not self.topics:
+            return []
+        started = time.perf_counter()
+        topics = list(self.topics)
+        results = await asyncio.gather(*(self._refresh_one(topic, force) for topic in topics))
+        changed = [topic for topic, is_changed in zip(topics, results) if is_changed]
+        if changed:
+            self._save_cache()
+        logger.info(f"[ТЕМЫ] Проверено {len(topics)} документов за {time.perf_counter() - started:.2f}с, загружено заново: {len(changed)}")
+        return changed
+
+    def match(self, query: str, limit: int = TOPIC_DOCS_MAX_ATTACHED) -> List[TopicDocument]:
+        """
+        Подбирает тематические документы к запросу по совпадению ключевых слов.
+
+        Returns:
+            List[TopicDocument]: Документы по убыванию числа совпавших ключевых слов
+        """
+        if not self.documents:
+            return []
+        terms = set(tokenize(query))
+        scored = []
+        for topic, document in self.documents.items():
+            # Пустой документ темы (заготовка) к запросу не добавляется
+            if not document.text:
+                continue
+            score = len(terms & self.keywords.get(topic, frozenset()))
+            if score:
+                scored.append((score, topic))
+        scored.sort(key=lambda item: (-item[0], item[1]))
+        if scored:
+            self.stats["matched_requests"] += 1
+        return [self.documents[topic] for _, topic in scored[:limit]]
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = dict(self.stats)
+        stats["topics"] = len(self.topics)
+        stats["loaded"] = len(self.documents)
+        return stats
+
+    async def poll_revisions(self, interval: int = TOPIC_DOCS_POLL_INTERVAL) -> None:
+        """Фоновая задача: проверяет revisionId документов и загружает изменившиеся"""
+        logger.info(f"[ТЕМЫ] Проверка изменений {len(self.topics)} тематических документов каждые {interval}с")
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"[ТЕМЫ] Ошибка при проверке изменений документов: {e}")
@@ -4,16 +4,27 @@ import logging
 import aiohttp
 from typing import Dict, Any, Optional, List
 
+from metrics import DEEPSEEK_TOKENS, ERRORS
+from tracing import traced, set_attrs
+
 logger = logging.getLogger(__name__)
 
 DEEPSEEK_API_URL = "https://api.deepseek.com/v1/chat/completions"
 DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
 
+# Таймаут запроса к DeepSeek по умолчанию (секунд); обработчик сообщений передает остаток своего бюджета
+DEEPSEEK_REQUEST_TIMEOUT = float(os.getenv("DEEPSEEK_REQUEST_TIMEOUT", "120"))
+
+class DeepSeekAPIError(Exception):
+    """API DeepSeek ответил ошибкой (статус не 200)"""
+
+@traced()
 async def make_deepseek_request(
     messages: List[Dict[str, str]],
     model: str = "deepseek-chat",
     temperature: float = 0.2,
-    max_tokens: Optional[int] = None
+    max_tokens: Optional[int] = None,
+    timeout: Optional[float] = None
 ) -> Dict[str, Any]:
     """
     Отправляет запрос к API DeepSeek.
@@ -23,6 +34,7 @@ async def make_deepseek_request(
         model: Модель для использования
         temperature: Температура генерации (0.0 - 1.0)
         max_tokens: Максимальное количество токенов в ответе
+        timeout: Таймаут запроса в секундах (по умолчанию DEEPSEEK_REQUEST_TIMEOUT)
         
     Returns:
         Dict[str, Any]: Ответ от API в формате JSON
@@ -43,17 +55,32 @@ async def make_deepseek_request(
     
     if max_tokens is not None:
         data["max_tokens"] = max_tokens
+    set_attrs(model=model)
         
     try:
-        async with aiohttp.ClientSession() as session:
+        client_timeout = aiohttp.ClientTimeout(total=timeout if timeout is not None else DEEPSEEK_REQUEST_TIMEOUT)
+        async with aiohttp.ClientSession(timeout=client_timeout) as session:
             async with session.post(DEEPSEEK_API_URL, headers=headers, json=data) as response:
                 if response.status != 200:
                     error_text = await response.text()
+                    ERRORS.labels("deepseek", f"HTTP {response.status}").inc()
                     logger.error(f"Ошибка DeepSeek API: {response.status} - {error_text}")
-                    raise Exception(f"Ошибка DeepSeek API: {response.status} - {error_text}")
+                    raise DeepSeekAPIError(f"Ошибка DeepSeek API: {response.status} - {error_text}")
                     
-                return await response.json()
+                result = await response.json()
+                usage = result.get("usage") or {}
+                set_attrs(
+                    prompt_tokens=usage.get("prompt_tokens"),
+                    completion_tokens=usage.get("completion_tokens"),
+                    cache_hit_tokens=usage.get("prompt_cache_hit_tokens")
+                )
+                DEEPSEEK_TOKENS.labels(model, "prompt").inc(usage.get("prompt_tokens", 0))
+                DEEPSEEK_TOKENS.labels(model, "completion").inc(usage.get("completion_tokens", 0))
+                DEEPSEEK_TOKENS.labels(model, "cache_hit").inc(usage.get("prompt_cache_hit_tokens", 0))
+                return result
                 
     except Exception as e:
+        if not isinstance(e, DeepSeekAPIError):
+            ERRORS.labels("deepseek", type(e).__name__).inc()
         logger.error(f"Ошибка при запросе к DeepSeek API: {str(e)}")
         raise 
\ No newline at end of file
@@ -1,39 +1,36 @@
+import time
 import asyncio
 import logging
-import re
 from typing import Optional, Dict, Any
 from aiogram.types import Message
 
 from ds_models import choose_deepseek_model
 from ds_api import make_deepseek_request
-from ds_utils import send_long_message_safe, format_dialog_history, _split_message_smartly
-from emotion_handler import extract_emotion_from_text, remove_emotion_tags, send_emotion_image
+from ds_utils import format_dialog_history
+from telegram_html import render_markdown
+from emotion_handler import extract_emotion_from_text, remove_emotion_tags
+from reply_delivery import deliver_reply
+from request_context import get_request_context, REASON_RESET, REASON_SHUTDOWN
+from shutdown import shutdown_coordinator
+from metrics import COMPLETION_SECONDS, MARKDOWN_RENDER_SECONDS, HANDLING_SECONDS, ERRORS, FALLBACKS, MESSAGES
+from tracing import traced, span, set_attrs
 
 logger = logging.getLogger(__name__)
 
+# Сколько последних реплик пользователя учитывать при выборе разделов инструкции
+RETRIEVAL_USER_TURNS = 3
+
+# Заменяет заглушку 'Надо подумать...', если ответ прерван остановкой бота
+SHUTDOWN_NOTICE = "🔄 Бот перезапускается и не успел ответить. Пожалуйста, повторите вопрос через минуту."
+
 def convert_markdown_to_html(text: str) -> str:
     """
     Конвертирует markdown разметку в HTML-теги, поддерживаемые Telegram.
+    Результат всегда экранирован и сбалансирован (см. telegram_html.render_markdown).
     """
-    # Конвертируем жирный текст **text** и __text__ в <b>text</b>
-    text = re.sub(r'\*\*(.*?)\*\*', r'<b>\1</b>', text)
-    text = re.sub(r'__(.*?)__', r'<b>\1</b>', text)
-
-    # Конвертируем курсив *text* и _text_ в <i>text</i>
-    text = re.sub(r'\*(.*?)\*', r'<i>\1</i>', text)
-    text = re.sub(r'_(.*?)_', r'<i>\1</i>', text)
-
-    # Конвертируем моноширинный код `text` в <code>text</code>
-    text = re.sub(r'`(.*?)`', r'<code>\1</code>', text)
-
-    # Удаляем блоки кода (они плохо отображаются в Telegram)
-    text = re.sub(r'```.*?```', '', text, flags=re.DOTALL)
-
-    # Конвертируем ссылки [text](url) в <a href="url">text</a>
-    text = re.sub(r'\[([^\]]+)\]\(([^\)]+)\)', r'<a href="\2">\1</a>', text)
-
-    return text
+    return render_markdown(text)
 
+@traced()
 async def handle_deepseek_message(
     message: Message,
     user_data_manager=None,
@@ -45,10 +42,14 @@ async def handle_deepseek_message(
     user_id = message.from_user.id
     start_time = asyncio.get_event_loop().time()
     logger.info(f"[НАЧАЛО_ОБРАБОТКИ] Пользователь {user_id}: {message.text[:50]}...")
+    # Дедлайн обработки делится между этапами: выбор модели, проверка модели, генерация, отправка
+    request = get_request_context(user_id)
+    thinking_message = None
+    outcome = "error"
 
     try:
-        # Устанавливаем общий таймаут на обработку сообщения
-        async with asyncio.timeout(90):  # 1.5 минуты максимум
+        # Общий таймаут на обработку сообщения — бюджет запроса
+        async with asyncio.timeout_at(request.deadline):
             """
             Обрабатывает сообщение пользователя с помощью DeepSeek API.
 
@@ -73,14 +74,28 @@ async def handle_deepseek_message(
 
                 # Выбираем модель
                 logger.info(f"[ДЕТАЛЬНЫЙ_ЛОГ] Начинаем выбор модели для {user_id}")
-                model, model_choice = await choose_deepseek_model(message)
+                try:
+                    async with request.stage("routing"):
+                        model, model_choice = await choose_deepseek_model(message)
+                except TimeoutError:
+                    # Выбор модели не должен съедать время генерации ответа
+                    FALLBACKS.labels("routing_timeout").inc()
+                    logger.warning(f"[DeepSeek] Выбор модели для {user_id} не уложился в бюджет, используется chat")
+                    model, model_choice = "deepseek-chat", "chat"
                 logger.info(f"🧠 Используется модель '{model}' для ответа (выбор: {model_choice})")
+                set_attrs(model_choice=model_choice)
                 logger.info(f"[ДЕТАЛЬНЫЙ_ЛОГ] Модель выбрана: {model}")
 
                 # Проверяем доступность reasoning модели
                 if model_choice == "reasoning":
                     from ds_models import test_model_availability
-                    if not await test_model_availability("deepseek-reasoner"):
+                    try:
+                        async with request.stage("probe"):
+                            reasoner_available = await test_model_availability("deepseek-reasoner")
+                    except TimeoutError:
+                        reasoner_available = False
+                    if not reasoner_available:
+                        FALLBACKS.labels("reasoner_unavailable").inc()
                         logger.warning("[DeepSeek] Reasoning модель недоступна, переключаемся на chat")
                         model = "deepseek-chat"
                         model_choice = "chat"
@@ -91,22 +106,38 @@ async def handle_deepseek_message(
                 else:
                     thinking_message = None
 
-                # Получаем историю диалога
-                from ds_utils import get_dialog_history
-                dialog_history = get_dialog_history(message.from_user.id, message.bot)
-
                 # Добавляем текущее сообщение пользователя в историю
                 from ds_utils import add_message_to_deepseek_dialog
                 add_message_to_deepseek_dialog(message=message, is_user=True)
+                request.committed = True
+
+                # Получаем историю диалога (уже с текущим сообщением; ссылки на общий текст разрешены)
+                from ds_utils import get_dialog_history
+                dialog_history = get_dialog_history(message.from_user.id, message.bot)
 
                 # Форматируем историю диалога
                 formatted_messages = format_dialog_history(dialog_history)
 
                 # Получаем системный промпт из docs_loader
-                from m_prompts import get_system_prompt_content
+                from m_prompts import get_system_prompt, build_request_prompt
                 try:
-                    system_prompt_content = await get_system_prompt_content(docs_loader_instance)
+                    with span("prompt"):
+                        system_prompt = await get_system_prompt(docs_loader_instance)
+                        # Разделы инструкции подбираются по текущему вопросу и последним репликам пользователя
+                        recent_questions = [msg["content"] for msg in formatted_messages if msg["role"] == "user"][-RETRIEVAL_USER_TURNS:]
+                        system_prompt_content, retrieval = build_request_prompt(system_prompt, "\n".join(recent_questions))
+                        set_attrs(version=system_prompt.version, sections=len(retrieval.get("sections") or []))
+                    logger.info(f"[ПРОМПТ] Запрос пользователя {user_id}: версия промпта {system_prompt.version} (ревизия {system_prompt.revision_id or '-'})")
+                    if retrieval.get("topics"):
+                        logger.info(f"[ПРОМПТ] Тематические документы для {user_id}: {retrieval['topics']}")
+                    if retrieval.get("sections") is not None:
+                        logger.info(
+                            f"[ПРОМПТ] Разделы для {user_id}: {retrieval['sections']}, "
+                            f"~{retrieval['full_tokens']} -> ~{retrieval['sent_tokens']} токенов (-{retrieval['saved_percent']}%), "
+                            f"поиск {retrieval['search_ms']:.3f} мс"
+                        )
                 except Exception as e:
+                    FALLBACKS.labels("default_prompt").inc()
                     logger.error(f"Ошибка получения системного промпта: {e}")
                     system_prompt_content = ("Ты — опытный детский психолог и педагог. Твоя задача — помогать родителям в воспитании детей, "
                                            "отвечать на их вопросы о развитии, обучении и поведении детей. Используй научный подход, "
@@ -120,18 +151,31 @@ async def handle_deepseek_message(
 
                 # Отправляем запрос к API
                 logger.info(f"[ДЕТАЛЬНЫЙ_ЛОГ] Отправляем запрос к DeepSeek API для {user_id}")
-                response = await make_deepseek_request(
-                    messages=formatted_messages,
-                    model=model,
-                    temperature=0.05,
-                    max_tokens=None
-                )
+                async with request.stage("completion") as completion_timeout:
+                    response = await make_deepseek_request(
+                        messages=formatted_messages,
+                        model=model,
+                        temperature=0.05,
+                        max_tokens=None,
+                        timeout=completion_timeout
+                    )
+                COMPLETION_SECONDS.labels(model).observe(request.stage_durations["completion"])
 
                 logger.info(f"[ДЕТАЛЬНЫЙ_ЛОГ] Получен ответ от DeepSeek API для {user_id}")
-                logger.info(f"[DeepSeek] Ответ: {response}")
+                if response:
+                    # Полный ответ (с рассуждениями модели) — только на уровне DEBUG, в INFO — расход токенов
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug(f"[DeepSeek] Ответ: {response}")
+                    usage = response.get("usage", {})
+                    finish_reason = response["choices"][0].get("finish_reason") if response.get("choices") else None
+                    logger.info(
+                        f"[DeepSeek] Ответ для {user_id}: токенов {usage.get('prompt_tokens', '-')} + {usage.get('completion_tokens', '-')}, "
+                        f"из кэша {usage.get('prompt_cache_hit_tokens', '-')}, завершение: {finish_reason}"
+                    )
 
                 if not response or "choices" not in response or not response["choices"]:
                     logger.error(f"[ДЕТАЛЬНЫЙ_ЛОГ] ОШИБКА: Не удалось получить ответ от DeepSeek API для {user_id}")
+                    outcome = "empty_response"
                     await message.answer("Извините, произошла ошибка при обработке вашего запроса.")
                     return
 
@@ -145,86 +189,41 @@ async def handle_deepseek_message(
                 response_text = remove_emotion_tags(response_text)
 
                 # Конвертируем markdown в HTML
-                response_text = convert_markdown_to_html(response_text)
+                render_started = time.perf_counter()
+                with span("render_markdown"):
+                    response_text = convert_markdown_to_html(response_text)
+                MARKDOWN_RENDER_SECONDS.observe(time.perf_counter() - render_started)
 
                 # Асинхронно логируем пользовательское сообщение в Google Sheets (не блокируем ответ)
                 if sheets_logger_instance:
-                    asyncio.create_task(sheets_logger_instance.log_message_async(
+                    shutdown_coordinator.track(sheets_logger_instance.log_message_async(
                         user_name=message.from_user.full_name,
                         user_id=message.from_user.id,
                         message_text=message.text,
                         is_user=True
                     ))
 
-                # Удаляем сообщение 'Надо подумать...', если оно было
-                if thinking_message:
-                    try:
-                        await thinking_message.delete()
-                    except Exception:
-                        pass
-
-                # Если есть эмоция, всегда отправляем изображение с текстом как подпись
-                if emotion:
-                    logger.info(f"[ДЕТАЛЬНЫЙ_ЛОГ] Отправляем ответ с эмоцией '{emotion}' для {user_id}")
-                    # Проверяем длину текста (лимит подписи в Telegram - 1024 символа)
-                    if len(response_text) <= 1024:
-                        # Текст помещается в подпись - отправляем одним сообщением
-                        await send_emotion_image(message.bot, message.chat.id, emotion, response_text)
-                        logger.info(f"[ДЕТАЛЬНЫЙ_ЛОГ] Отправлено одно сообщение с картинкой для {user_id}")
-                    else:
-                        # Текст слишком длинный - разбиваем на части и к последней части добавляем картинку
-                        chunks = _split_message_smartly(response_text, 900)  # Оставляем место для индикатора части
-                        logger.info(f"[ДЕТАЛЬНЫЙ_ЛОГ] Разбиваем текст на {len(chunks)} частей для {user_id}")
-
-                        # Отправляем все части кроме последней как обычный текст
-                        for i, chunk in enumerate(chunks[:-1]):
-                            try:
-                                chunk_with_indicator = f"📝 Часть {i+1}/{len(chunks)}:\n\n{chunk}"
-                                logger.info(f"[ДЕТАЛЬНЫЙ_ЛОГ] Отправляем часть {i+1}/{len(chunks)} для {user_id}")
-                                await message.answer(chunk_with_indicator, parse_mode="HTML")
-                                logger.info(f"[ДЕТАЛЬНЫЙ_ЛОГ] Успешно отправлена часть {i+1}/{len(chunks)} для {user_id}")
-
-                                # Добавляем задержку между частями
-                                await asyncio.sleep(0.5)
-
-                            except Exception as e:
-                                logger.error(f"[ДЕТАЛЬНЫЙ_ЛОГ] ОШИБКА при отправке части {i+1}/{len(chunks)} для {user_id}: {e}")
-                                # Пытаемся отправить без HTML разметки
-                                try:
-                                    await message.answer(chunk_with_indicator)
-                                    logger.info(f"[ДЕТАЛЬНЫЙ_ЛОГ] Fallback успешен для части {i+1}/{len(chunks)}")
-                                except Exception as e2:
-                                    logger.error(f"[ДЕТАЛЬНЫЙ_ЛОГ] КРИТИЧЕСКАЯ ОШИБКА части {i+1}/{len(chunks)}: {e2}")
-
-                # Последнюю часть отправляем как подпись к картинке
-                        try:
-                            last_chunk = chunks[-1]
-                            if len(chunks) > 1:
-                                last_chunk_with_indicator = f"📝 Часть {len(chunks)}/{len(chunks)}:\n\n{last_chunk}"
-                            else:
-                                last_chunk_with_indicator = last_chunk
-
-                            logger.info(f"[ДЕТАЛЬНЫЙ_ЛОГ] Отправляем последнюю часть с картинкой для {user_id}")
-                            await send_emotion_image(message.bot, message.chat.id, emotion, last_chunk_with_indicator)
-                            logger.info(f"[ДЕТАЛЬНЫЙ_ЛОГ] Успешно отправлена последняя часть с картинкой для {user_id}")
-                        except Exception as e:
-                            logger.error(f"[ДЕТАЛЬНЫЙ_ЛОГ] ОШИБКА при отправке последней части с картинкой для {user_id}: {e}")
-                else:
-                    logger.info(f"[ДЕТАЛЬНЫЙ_ЛОГ] Отправляем ответ без эмоции для {user_id}")
-                    # Если эмоции нет, отправляем только текст
-                    await send_long_message_safe(message, response_text, parse_mode="HTML")
-                    logger.info(f"[ДЕТАЛЬНЫЙ_ЛОГ] Текстовый ответ отправлен для {user_id}")
+                # Отправляем ответ минимальным числом вызовов: заглушка 'Надо подумать...' редактируется,
+                # длинный текст режется по лимиту Telegram, картинка с эмоцией идет с последней частью
+                logger.info(f"[ДЕТАЛЬНЫЙ_ЛОГ] Отправляем ответ (эмоция: {emotion}) для {user_id}")
+                async with request.stage("delivery"):
+                    calls = await deliver_reply(message, response_text, emotion=emotion, placeholder=thinking_message)
+                logger.info(f"[ДЕТАЛЬНЫЙ_ЛОГ] Ответ отправлен для {user_id}, вызовов Telegram API: {calls}")
 
                 # Асинхронно логируем ответ бота в Google Sheets (не блокируем пользователя)
                 if sheets_logger_instance:
-                    asyncio.create_task(sheets_logger_instance.log_message_async(
+                    shutdown_coordinator.track(sheets_logger_instance.log_message_async(
                         user_name=message.from_user.full_name,
                         user_id=message.from_user.id,
                         message_text=response_text,
                         is_user=False
                     ))
 
-        # Добавляем ответ бота в историю диалога
+                outcome = "ok"
+                # Добавляем ответ бота в историю диалога (если диалог не сбросили, пока ответ отправлялся)
+                if request.cancel_reason == REASON_RESET:
+                    logger.info(f"[ЗАПРОС] Диалог {user_id} сброшен во время отправки, ответ не сохраняется в историю")
+                    return
                 add_message_to_deepseek_dialog(
                     user_id=message.from_user.id,
                     role="assistant", 
@@ -235,6 +234,7 @@ async def handle_deepseek_message(
                 logger.info(f"[ДЕТАЛЬНЫЙ_ЛОГ] УСПЕХ: Обработка сообщения завершена для {user_id}")
 
             except asyncio.TimeoutError:
+                outcome = "timeout"
                 logger.error(f"[ДЕТАЛЬНЫЙ_ЛОГ] ТАЙМАУТ при обработке сообщения для {user_id}")
                 try:
                     await message.answer("⏰ Извините, обработка заняла слишком много времени. Попробуйте еще раз.")
@@ -242,6 +242,7 @@ async def handle_deepseek_message(
                     pass
                 return
             except Exception as e:
+                ERRORS.labels("handler", type(e).__name__).inc()
                 logger.error(f"[ДЕТАЛЬНЫЙ_ЛОГ] ОШИБКА при обработке сообщения для {user_id}: {e}", exc_info=True)
                 try:
                     await message.answer("😔 Извините, произошла ошибка при обработке вашего запроса. Попробуйте еще раз.")
@@ -249,14 +250,32 @@ async def handle_deepseek_message(
                     pass
                 return
 
+    except asyncio.CancelledError:
+        outcome = "cancelled"
+        # Генерация отменена (новое сообщение или /reset): заглушка 'Надо подумать...' больше не нужна,
+        # а при остановке бота пользователь узнает, что вопрос нужно повторить
+        if request.cancel_reason and thinking_message:
+            try:
+                if request.cancel_reason == REASON_SHUTDOWN:
+                    await thinking_message.edit_text(SHUTDOWN_NOTICE)
+                else:
+                    await thinking_message.delete()
+            except Exception:
+                pass
+        raise
     except asyncio.TimeoutError:
+        outcome = "timeout"
         processing_time = asyncio.get_event_loop().time() - start_time
         logger.error(f"⏰ ТАЙМАУТ обработки сообщения от пользователя {user_id} после {processing_time:.2f}с")
         await message.answer("Извините, обработка вашего сообщения заняла слишком много времени. Попробуйте еще раз.")
     except Exception as e:
+        ERRORS.labels("handler", type(e).__name__).inc()
         processing_time = asyncio.get_event_loop().time() - start_time
         logger.error(f"❌ Ошибка при обработке сообщения от пользователя {user_id} за {processing_time:.2f}с: {str(e)}", exc_info=True)
         await message.answer("Произошла ошибка при обработке вашего сообщения. Пожалуйста, попробуйте позже.")
     finally:
         processing_time = asyncio.get_event_loop().time() - start_time
-        logger.info(f"[КОНЕЦ_ОБРАБОТКИ] Пользователь {user_id}: обработка заняла {processing_time:.2f}с")
\ No newline at end of file
+        HANDLING_SECONDS.observe(processing_time)
+        MESSAGES.labels(outcome).inc()
+        set_attrs(outcome=outcome)
+        logger.info(f"[КОНЕЦ_ОБРАБОТКИ] Пользователь {user_id}: обработка заняла {processing_time:.2f}с (этапы: {request.describe()})")
\ No newline at end of file
@@ -2,9 +2,12 @@
 import logging
 from typing import Tuple, Optional
 from ds_api import make_deepseek_request
+from metrics import FALLBACKS
+from tracing import traced
 
 logger = logging.getLogger(__name__)
 
+@traced()
 async def choose_deepseek_model(message) -> tuple[str, str]:
     """
     Выбирает подходящую модель DeepSeek на основе анализа диалога.
@@ -54,7 +57,9 @@ async def choose_deepseek_model(message) -> tuple[str, str]:
             }
         ]
         
-        logger.info(f"[DeepSeek] Запрос на выбор модели: {model_selection_prompt}")
+        # Полный промпт выбора модели пишется только на уровне DEBUG (форматирование не выполняется, если он выключен)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"[DeepSeek] Запрос на выбор модели: {model_selection_prompt}")
         
         # Используем chat модель для выбора модели
         response = await make_deepseek_request(
@@ -64,9 +69,11 @@ async def choose_deepseek_model(message) -> tuple[str, str]:
             max_tokens=10
         )
         
-        logger.info(f"[DeepSeek] Ответ: {response}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"[DeepSeek] Ответ: {response}")
         
         if not response or "choices" not in response or not response["choices"]:
+            FALLBACKS.labels("routing_empty").inc()
             logger.warning("[DeepSeek] Не удалось получить ответ для выбора модели")
             return ("deepseek-chat", "chat")
             
@@ -83,10 +90,12 @@ async def choose_deepseek_model(message) -> tuple[str, str]:
         return (final_model, model_choice)
         
     except Exception as e:
+        FALLBACKS.labels("routing_error").inc()
         logger.error(f"Ошибка при выборе модели: {str(e)}")
         return ("deepseek-chat", "chat")  # Возвращаем chat модель в случае ошибки
 
 
+@traced()
 async def test_model_availability(model: str) -> bool:
     """
     Проверяет доступность модели DeepSeek
@@ -1,61 +1,25 @@
 import logging
 from typing import List, Dict, Any
+from html import escape
 from aiogram.types import Message
+from reply_delivery import deliver_reply, TEXT_LIMIT
 
 logger = logging.getLogger(__name__)
 
-async def send_long_message_safe(message: Message, text: str, parse_mode=None, chunk_size=2000) -> None:
+async def send_long_message_safe(message: Message, text: str, parse_mode=None, chunk_size=TEXT_LIMIT) -> None:
     """
     Безопасно отправляет длинное сообщение, разбивая его на части если необходимо.
 
     Args:
         message: Объект сообщения для ответа
         text: Текст для отправки
-        parse_mode: Режим разметки для отправки сообщения
+        parse_mode: Режим разметки ("HTML" или None для обычного текста)
         chunk_size: Максимальная длина одной части сообщения
     """
     try:
-        if len(text) <= chunk_size:
-            await message.answer(text, parse_mode=parse_mode)
-            return
-
-        # Умная разбивка на части
-        chunks = _split_message_smartly(text, chunk_size)
-        
-        for i, chunk in enumerate(chunks):
-            try:
-                logger.info(f"[ОТПРАВКА_ЧАСТИ] Отправляем часть {i+1}/{len(chunks)} пользователю {message.from_user.id}")
-                # Добавляем индикатор части если частей больше одной
-                if len(chunks) > 1:
-                    chunk_with_indicator = f"📝 Часть {i+1}/{len(chunks)}:\n\n{chunk}"
-                    await message.answer(chunk_with_indicator, parse_mode=parse_mode)
-                else:
-                    await message.answer(chunk, parse_mode=parse_mode)
-                logger.info(f"[ОТПРАВКА_ЧАСТИ] Успешно отправлена часть {i+1}/{len(chunks)} пользователю {message.from_user.id}")
-                
-                # Добавляем небольшую задержку между частями
-                if i < len(chunks) - 1:  # не добавляем задержку после последней части
-                    import asyncio
-                    await asyncio.sleep(0.5)
-                    
-            except Exception as e:
-                # fallback если parse_mode не подошёл
-                logger.error(f"[ОТПРАВКА_ЧАСТИ] Ошибка при отправке части {i+1}/{len(chunks)} пользователю {message.from_user.id}: {e}")
-                try:
-                    if len(chunks) > 1:
-                        chunk_with_indicator = f"📝 Часть {i+1}/{len(chunks)}:\n\n{chunk}"
-                        await message.answer(chunk_with_indicator)
-                    else:
-                        await message.answer(chunk)
-                    logger.info(f"[ОТПРАВКА_ЧАСТИ] Fallback успешен для части {i+1}/{len(chunks)}")
-                except Exception as e2:
-                    logger.error(f"[ОТПРАВКА_ЧАСТИ] КРИТИЧЕСКАЯ ОШИБКА: не удалось отправить часть {i+1}/{len(chunks)}: {e2}")
-                    # Пытаемся отправить хотя бы уведомление об ошибке
-                    try:
-                        await message.answer(f"❌ Не удалось отправить часть {i+1}/{len(chunks)} сообщения")
-                    except:
-                        pass
-
+        # Обычный текст экранируем, чтобы отправлять все одним способом через планировщик доставки
+        html_text = text if parse_mode == "HTML" else escape(text, quote=False)
+        await deliver_reply(message, html_text, text_limit=chunk_size)
     except Exception as e:
         logger.error(f"Ошибка при отправке длинного сообщения: {str(e)}")
         await message.answer("Извините, произошла ошибка при отправке сообщения.")
@@ -87,69 +51,11 @@ def _split_message_into_chunks(text: str, max_length: int) -> List[str]:
 
     return chunks
 
-def _split_message_smartly(text: str, max_length: int) -> List[str]:
-    """
-    Умно разбивает текст на части, стараясь сохранить целостность абзацев и предложений.
-
-    Args:
-        text: Исходный текст
-        max_length: Максимальная длина одной части
-
-    Returns:
-        List[str]: Список частей текста
-    """
-    if len(text) <= max_length:
-        return [text]
-    
-    chunks = []
-    current_chunk = ""
-    
-    # Сначала пробуем разбить по абзацам
-    paragraphs = text.split("\n\n")
-    
-    for paragraph in paragraphs:
-        # Если абзац помещается в текущий chunk
-        if len(current_chunk) + len(paragraph) + 2 <= max_length:
-            if current_chunk:
-                current_chunk += "\n\n" + paragraph
-            else:
-                current_chunk = paragraph
-        else:
-            # Сохраняем текущий chunk если он не пустой
-            if current_chunk:
-                chunks.append(current_chunk.strip())
-            
-            # Если абзац слишком большой, разбиваем его по предложениям
-            if len(paragraph) > max_length:
-                sentences = paragraph.split(". ")
-                temp_chunk = ""
-                
-                for i, sentence in enumerate(sentences):
-                    sentence_with_dot = sentence + ("." if i < len(sentences) - 1 else "")
-                    
-                    if len(temp_chunk) + len(sentence_with_dot) + 1 <= max_length:
-                        if temp_chunk:
-                            temp_chunk += " " + sentence_with_dot
-                        else:
-                            temp_chunk = sentence_with_dot
-                    else:
-                        if temp_chunk:
-                            chunks.append(temp_chunk.strip())
-                        temp_chunk = sentence_with_dot
-                
-                current_chunk = temp_chunk
-            else:
-                current_chunk = paragraph
-    
-    # Добавляем последний chunk
-    if current_chunk:
-        chunks.append(current_chunk.strip())
-    
-    return chunks
-
 def format_dialog_history(messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
     """
     Форматирует историю диалога для отправки в API.
+    Подряд идущие сообщения с одной ролью объединяются: модель получает одну реплику
+    (deepseek-reasoner не принимает две реплики одной роли подряд).
 
     Args:
         messages: Список сообщений в формате [{"role": "...", "content": "..."}]
@@ -161,6 +67,9 @@ def format_dialog_history(messages: List[Dict[str, str]]) -> List[Dict[str, str]
 
     for msg in messages:
         if isinstance(msg, dict) and "role" in msg and "content" in msg:
+            if formatted_messages and formatted_messages[-1]["role"] == msg["role"]:
+                formatted_messages[-1]["content"] += "\n\n" + str(msg["content"])
+                continue
             formatted_messages.append({
                 "role": msg["role"],
                 "content": str(msg["content"])
@@ -214,6 +123,24 @@ def add_message_to_deepseek_dialog(user_id: int = None, role: str = None, conten
     except Exception as e:
         logger.error(f"Ошибка при добавлении сообщения в диалог: {e}")
 
+async def add_broadcast_to_deepseek_dialogs(user_ids: List[int], content: str, bot) -> None:
+    """
+    Пакетно добавляет сообщение рассылки в истории диалогов DeepSeek.
+
+    Args:
+        user_ids: ID пользователей, получивших рассылку
+        content: Текст рассылки
+        bot: Объект бота
+    """
+    try:
+        if hasattr(bot, "dialog_manager"):
+            await bot.dialog_manager.add_message_bulk_async(user_ids, "assistant", content)
+        else:
+            for user_id in user_ids:
+                add_message_to_deepseek_dialog(user_id=user_id, role="assistant", content=content, bot=bot)
+    except Exception as e:
+        logger.error(f"Ошибка при пакетном добавлении рассылки в диалоги: {e}")
+
 def get_dialog_history(user_id: int, bot) -> List[Dict[str, str]]:
     """
     Получает историю диалога пользователя.
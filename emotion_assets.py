@@ -0,0 +1,169 @@
+import io
+import os
+import re
+import hashlib
+import logging
+from typing import Dict, Optional, Any
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow не установлен: изображения отправляются без пережатия
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# Максимальная сторона изображения для фото в Telegram и качество JPEG
+MAX_IMAGE_SIDE = 960
+JPEG_QUALITY = 85
+
+# Минимальная длина фрагмента названия эмоции для частичного совпадения
+MIN_ALIAS_LENGTH = 4
+
+# Разделители составных эмоций ("сочувствие + поддержка", "радость/энтузиазм")
+_COMPOUND_SEPARATORS = re.compile(r'\s*(?:[+,/;&|]|\s и\s)\s*')
+_WORD = re.compile(r'\w+')
+
+class EmotionAssets:
+    def __init__(self, emotion_images: Dict[str, str], max_side: int = MAX_IMAGE_SIDE):
+        """
+        Подготовленные при старте изображения эмоций
+
+        Args:
+            emotion_images: Словарь эмоция -> путь к изображению
+            max_side: Максимальная сторона изображения после пережатия
+        """
+        self.emotion_images = emotion_images
+        self.max_side = max_side
+        self.assets: Dict[str, Dict[str, Any]] = {}  # Путь -> подготовленное изображение
+        self.aliases: Dict[str, str] = {}  # Вариант названия -> эмоция из emotion_images
+        self._resolved: Dict[str, Optional[str]] = {}  # Кэш разбора произвольных названий
+        self.loaded = False
+
+    def load(self) -> None:
+        """
+        Проверяет, пережимает и загружает в память все изображения эмоций.
+
+        Raises:
+            FileNotFoundError: Если хотя бы одно изображение отсутствует
+        """
+        missing = sorted({path for path in self.emotion_images.values() if not os.path.isfile(path)})
+        if missing:
+            raise FileNotFoundError(f"Не найдены изображения эмоций: {', '.join(missing)}")
+
+        if Image is None:
+            logger.warning("Pillow не установлен, изображения эмоций будут отправляться без оптимизации")
+
+        assets = {}
+        for path in sorted(set(self.emotion_images.values())):
+            assets[path] = self._prepare(path)
+        self.assets = assets
+        self.aliases = self._build_aliases()
+        self._resolved = {}
+        self.loaded = True
+
+        original_size = sum(asset["original_size"] for asset in assets.values())
+        optimized_size = sum(len(asset["data"]) for asset in assets.values())
+        logger.info(
+            f"Загружено {len(assets)} изображений эмоций: {original_size // 1024} КБ -> {optimized_size // 1024} КБ, "
+            f"вариантов названий: {len(self.aliases)}"
+        )
+
+    def _prepare(self, path: str) -> Dict[str, Any]:
+        """Читает изображение и пережимает его, если это уменьшает размер"""
+        with open(path, 'rb') as f:
+            original = f.read()
+
+        data = original
+        filename = os.path.basename(path)
+        if Image is not None:
+            try:
+                optimized = self._optimize(original)
+                if len(optimized) < len(original):
+                    data = optimized
+                    filename = os.path.splitext(filename)[0] + ".jpg"
+            except Exception as e:
+                logger.error(f"Не удалось оптимизировать изображение {path}: {e}")
+
+        return {
+            "path": path,
+            "filename": filename,
+            "data": data,
+            "digest": hashlib.sha256(data).hexdigest(),
+            "original_size": len(original)
+        }
+
+    def _optimize(self, data: bytes) -> bytes:
+        """Уменьшает изображение до размеров фото Telegram и кодирует в JPEG"""
+        with Image.open(io.BytesIO(data)) as image:
+            image.thumbnail((self.max_side, self.max_side))
+            if image.mode in ("RGBA", "LA", "P"):
+                # Прозрачность заливаем белым: Telegram все равно хранит фото без альфа-канала
+                rgba = image.convert("RGBA")
+                image = Image.new("RGB", rgba.size, (255, 255, 255))
+                image.paste(rgba, mask=rgba.split()[-1])
+            elif image.mode != "RGB":
+                image = image.convert("RGB")
+
+            output = io.BytesIO()
+            image.save(output, format="JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)
+            return output.getvalue()
+
+    def _build_aliases(self) -> Dict[str, str]:
+        """
+        Строит таблицу вариантов названий эмоций.
+        Порядок совпадает с порядком emotion_images: при конфликте побеждает первая эмоция.
+        """
+        aliases = {}
+        for emotion in self.emotion_images:
+            aliases.setdefault(emotion, emotion)
+        for emotion, path in self.emotion_images.items():
+            # Английское название по имени файла (joy, sad, thinking...)
+            aliases.setdefault(os.path.splitext(os.path.basename(path))[0].lower(), emotion)
+        for emotion in self.emotion_images:
+            # Все фрагменты названия: "сочувств", "уверен" и т.п.
+            for start in range(len(emotion)):
+                for end in range(start + MIN_ALIAS_LENGTH, len(emotion) + 1):
+                    aliases.setdefault(emotion[start:end], emotion)
+        return aliases
+
+    def resolve(self, emotion: str) -> Optional[str]:
+        """
+        Приводит название эмоции от модели (в том числе составное или неполное)
+        к эмоции из emotion_images.
+
+        Returns:
+            str или None: Название эмоции или None, если подходящей нет
+        """
+        if not self.loaded:
+            self.load()
+
+        name = emotion.lower().strip()
+        if name in self.aliases:
+            return self.aliases[name]
+        if name in self._resolved:
+            return self._resolved[name]
+
+        result = None
+        for part in _COMPOUND_SEPARATORS.split(name):
+            result = self.aliases.get(part) or self._resolve_words(part)
+            if result:
+                break
+
+        if len(self._resolved) < 1024:
+            self._resolved[name] = result
+        return result
+
+    def _resolve_words(self, text: str) -> Optional[str]:
+        """Ищет эмоцию по отдельным словам и их основам ("радостное" -> "радость")"""
+        for word in _WORD.findall(text):
+            for end in range(len(word), MIN_ALIAS_LENGTH - 1, -1):
+                emotion = self.aliases.get(word[:end])
+                if emotion:
+                    return emotion
+        return None
+
+    def get(self, emotion: str) -> Dict[str, Any]:
+        """Возвращает подготовленное изображение для эмоции из emotion_images"""
+        if not self.loaded:
+            self.load()
+        return self.assets[self.emotion_images[emotion]]
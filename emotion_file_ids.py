@@ -0,0 +1,69 @@
+import json
+import os
+import logging
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+class EmotionFileIdCache:
+    def __init__(self, file_path: str = "emotion_file_ids.json"):
+        """
+        Постоянный кэш file_id Telegram для изображений эмоций
+
+        Args:
+            file_path: Путь к JSON файлу кэша
+        """
+        self.file_path = file_path
+        # Путь к изображению -> {"sha256": хеш содержимого, "file_id": file_id в Telegram}
+        self.entries: Dict[str, Dict[str, str]] = self._load()
+        logger.info(f"EmotionFileIdCache инициализирован. Загружено {len(self.entries)} file_id.")
+
+    def _load(self) -> Dict[str, Dict[str, str]]:
+        """Загружает кэш из JSON файла"""
+        if not os.path.exists(self.file_path):
+            return {}
+        try:
+            with open(self.file_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке кэша file_id из файла {self.file_path}: {e}")
+            return {}
+
+    def _save(self, removed: Optional[str] = None) -> None:
+        """
+        Атомарно сохраняет кэш в JSON файл.
+        Файл общий для процессов-обработчиков: записи, добавленные другими процессами, сохраняются.
+        """
+        entries = {**self._load(), **self.entries}
+        if removed is not None:
+            entries.pop(removed, None)
+        self.entries = entries
+        tmp_path = f"{self.file_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(entries, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.file_path)
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении кэша file_id в файл {self.file_path}: {e}")
+
+    def get(self, image_path: str, digest: str) -> Optional[str]:
+        """Возвращает file_id, если он получен для текущей версии изображения"""
+        entry = self.entries.get(image_path)
+        if not entry:
+            return None
+        if entry.get("sha256") != digest:
+            logger.info(f"Изображение {image_path} изменилось, кэшированный file_id сброшен")
+            self.invalidate(image_path)
+            return None
+        return entry.get("file_id")
+
+    def set(self, image_path: str, digest: str, file_id: str) -> None:
+        """Запоминает file_id для версии изображения"""
+        self.entries[image_path] = {"sha256": digest, "file_id": file_id}
+        self._save()
+        logger.info(f"Сохранен file_id для изображения {image_path}")
+
+    def invalidate(self, image_path: str) -> None:
+        """Удаляет file_id изображения из кэша"""
+        if self.entries.pop(image_path, None) is not None:
+            self._save(removed=image_path)
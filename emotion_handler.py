@@ -1,9 +1,11 @@
-import os
 import logging
 import re
 from typing import Optional, Dict
 from aiogram import Bot
-from aiogram.types import FSInputFile
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import BufferedInputFile
+
+from emotion_assets import EmotionAssets
 
 logger = logging.getLogger(__name__)
 
@@ -21,6 +23,16 @@ EMOTION_IMAGES = {
     "поддержка": "images/support.png"
 }
 
+# Изображения, подготовленные при старте (см. load_emotion_assets)
+emotion_assets = EmotionAssets(EMOTION_IMAGES)
+
+def load_emotion_assets() -> None:
+    """
+    Проверяет, оптимизирует и загружает в память изображения эмоций.
+    Вызывается при старте бота: отсутствующие файлы должны ронять запуск, а не отдельные ответы.
+    """
+    emotion_assets.load()
+
 def extract_emotion_from_text(text: str) -> Optional[str]:
     """
     Извлекает эмоцию из текста по специальному тегу.
@@ -72,35 +84,16 @@ async def send_emotion_image(bot: Bot, chat_id: int, emotion: str, caption: str
         bool: True если изображение отправлено успешно
     """
     try:
-        # Обработка составных эмоций (например, "сочувствие + поддержка")
-        target_emotion = emotion
-        if emotion not in EMOTION_IMAGES:
-            # Если составная эмоция, берем первую часть
-            if '+' in emotion:
-                target_emotion = emotion.split('+')[0].strip()
-                logger.info(f"Составная эмоция '{emotion}' -> используем '{target_emotion}'")
-            
-            # Если все еще не найдена, ищем по частичному совпадению
-            if target_emotion not in EMOTION_IMAGES:
-                for key in EMOTION_IMAGES.keys():
-                    if target_emotion in key or key in target_emotion:
-                        target_emotion = key
-                        logger.info(f"Найдено частичное совпадение: '{emotion}' -> '{target_emotion}'")
-                        break
-                else:
-                    logger.warning(f"Изображение для эмоции '{emotion}' не найдено")
-                    return False
-
-        image_path = EMOTION_IMAGES[target_emotion]
-
-        # Проверяем существование файла
-        if not os.path.exists(image_path):
-            logger.error(f"Файл изображения не найден: {image_path}")
+        # Составные и неполные названия ("сочувствие + поддержка") разбираются по готовой таблице
+        target_emotion = emotion_assets.resolve(emotion)
+        if not target_emotion:
+            logger.warning(f"Изображение для эмоции '{emotion}' не найдено")
             return False
+        if target_emotion != emotion:
+            logger.info(f"Эмоция '{emotion}' -> используем '{target_emotion}'")
 
         # Отправляем изображение с подписью
-        photo = FSInputFile(image_path)
-        await bot.send_photo(chat_id=chat_id, photo=photo, caption=caption, parse_mode="HTML")
+        await _send_image(bot, chat_id, emotion_assets.get(target_emotion), caption)
 
         logger.info(f"Изображение с эмоцией '{emotion}' отправлено в чат {chat_id}")
         return True
@@ -109,6 +102,62 @@ async def send_emotion_image(bot: Bot, chat_id: int, emotion: str, caption: str
         logger.error(f"Ошибка при отправке изображения с эмоцией '{emotion}': {e}")
         return False
 
+async def _send_image(bot: Bot, chat_id: int, asset: Dict, caption: str = None, **kwargs):
+    """
+    Отправляет подготовленное изображение, по возможности ссылаясь на уже загруженный в Telegram file_id.
+
+    Кэш file_id берется из bot.emotion_file_ids. Если Telegram не принимает
+    сохраненный file_id, изображение загружается заново и кэш обновляется.
+    """
+    file_id_cache = getattr(bot, "emotion_file_ids", None)
+    image_path = asset["path"]
+
+    if file_id_cache:
+        file_id = file_id_cache.get(image_path, asset["digest"])
+        if file_id:
+            try:
+                return await bot.send_photo(chat_id=chat_id, photo=file_id, caption=caption, parse_mode="HTML", **kwargs)
+            except TelegramBadRequest as e:
+                if "file identifier" not in str(e).lower():
+                    raise
+                logger.warning(f"Telegram отклонил file_id для {image_path}: {e}. Загружаем файл заново")
+                file_id_cache.invalidate(image_path)
+
+    photo = BufferedInputFile(asset["data"], filename=asset["filename"])
+    sent_message = await bot.send_photo(chat_id=chat_id, photo=photo, caption=caption, parse_mode="HTML", **kwargs)
+    if file_id_cache and sent_message.photo:
+        file_id_cache.set(image_path, asset["digest"], sent_message.photo[-1].file_id)
+    return sent_message
+
+async def warm_up_emotion_file_ids(bot: Bot, chat_id: int) -> None:
+    """
+    Заранее загружает в Telegram изображения, для которых еще нет file_id.
+    Изображения отправляются в служебный чат (например, администратора) и сразу удаляются.
+
+    Args:
+        bot: Экземпляр бота
+        chat_id: ID чата для загрузки
+    """
+    file_id_cache = getattr(bot, "emotion_file_ids", None)
+    if not file_id_cache:
+        return
+
+    uploaded = 0
+    for image_path, asset in emotion_assets.assets.items():
+        try:
+            if file_id_cache.get(image_path, asset["digest"]):
+                continue
+            sent_message = await _send_image(bot, chat_id, asset, disable_notification=True)
+            uploaded += 1
+            try:
+                await sent_message.delete()
+            except Exception:
+                pass
+        except Exception as e:
+            logger.error(f"Ошибка при предварительной загрузке изображения {image_path}: {e}")
+
+    logger.info(f"Предварительная загрузка изображений эмоций завершена, загружено: {uploaded}")
+
 def get_available_emotions() -> str:
     """
     Возвращает список доступных эмоций для использования в промпте.
@@ -0,0 +1,136 @@
+import os
+import json
+import asyncio
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, Tuple, Optional
+
+import httplib2
+from google.oauth2 import service_account
+from google.auth.transport.requests import Request
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.discovery import build
+
+from google_executor import google_executor
+
+logger = logging.getLogger(__name__)
+
+# Все области доступа, нужные боту: одни учетные данные для Sheets и Docs
+GOOGLE_SCOPES = [
+    'https://www.googleapis.com/auth/spreadsheets',
+    'https://www.googleapis.com/auth/documents.readonly'
+]
+
+# Таймаут HTTP-запросов к Google API
+GOOGLE_HTTP_TIMEOUT = 30
+
+# Токен обновляется заранее, если до его истечения осталось меньше этого времени
+TOKEN_REFRESH_MARGIN = timedelta(minutes=5)
+TOKEN_CHECK_INTERVAL = 60  # секунд
+
+_credentials = None
+_credentials_lock = threading.Lock()
+_services: Dict[Tuple[str, str], object] = {}
+_services_lock = threading.Lock()
+_thread_local = threading.local()
+
+def get_credentials() -> service_account.Credentials:
+    """
+    Возвращает учетные данные сервисного аккаунта (разбираются один раз на процесс).
+
+    Источник: переменная окружения GOOGLE_CREDENTIALS_JSON или файл gcreds.json.
+    """
+    global _credentials
+    if _credentials is not None:
+        return _credentials
+
+    with _credentials_lock:
+        if _credentials is not None:
+            return _credentials
+
+        google_creds_json = os.getenv('GOOGLE_CREDENTIALS_JSON')
+        if google_creds_json:
+            try:
+                creds_data = json.loads(google_creds_json)
+                logger.info("Используются учетные данные Google из переменной окружения")
+            except json.JSONDecodeError as e:
+                logger.error(f"Ошибка парсинга GOOGLE_CREDENTIALS_JSON: {e}")
+                raise
+        else:
+            # Если переменная окружения не установлена, пытаемся загрузить из файла
+            try:
+                with open('gcreds.json', 'r') as f:
+                    creds_data = json.load(f)
+                logger.info("Используются учетные данные Google из файла gcreds.json")
+            except FileNotFoundError:
+                logger.error("Файл gcreds.json не найден и GOOGLE_CREDENTIALS_JSON не установлена.")
+                raise
+
+        _credentials = service_account.Credentials.from_service_account_info(creds_data, scopes=GOOGLE_SCOPES)
+        return _credentials
+
+def get_http() -> AuthorizedHttp:
+    """
+    Авторизованный HTTP-транспорт текущего потока.
+
+    httplib2 не потокобезопасен, поэтому у каждого потока пула Google свой транспорт;
+    внутри потока соединения с Google переиспользуются (keep-alive).
+    """
+    http = getattr(_thread_local, "http", None)
+    if http is None:
+        http = AuthorizedHttp(get_credentials(), http=httplib2.Http(timeout=GOOGLE_HTTP_TIMEOUT))
+        _thread_local.http = http
+    return http
+
+def get_service(name: str, version: str):
+    """
+    Клиент Google API, созданный один раз на процесс по встроенному (статическому)
+    discovery-документу — без сетевого запроса при создании.
+    """
+    key = (name, version)
+    service = _services.get(key)
+    if service is not None:
+        return service
+
+    with _services_lock:
+        if key not in _services:
+            _services[key] = build(
+                name, version,
+                http=AuthorizedHttp(get_credentials(), http=httplib2.Http(timeout=GOOGLE_HTTP_TIMEOUT)),
+                static_discovery=True,
+                cache_discovery=False
+            )
+            logger.info(f"Создан клиент Google API {name} {version}")
+        return _services[key]
+
+def execute(request):
+    """Выполняет запрос googleapiclient через транспорт текущего потока"""
+    return request.execute(http=get_http())
+
+def refresh_token_if_needed(force: bool = False) -> bool:
+    """
+    Обновляет токен доступа, если он скоро истечет.
+
+    Returns:
+        bool: True, если токен был обновлен
+    """
+    credentials = get_credentials()
+    expiry: Optional[datetime] = credentials.expiry  # naive UTC
+    if not force and credentials.token and expiry and expiry - datetime.utcnow() > TOKEN_REFRESH_MARGIN:
+        return False
+    with _credentials_lock:
+        credentials.refresh(Request())
+    logger.info(f"Токен доступа Google обновлен, действует до {credentials.expiry} UTC")
+    return True
+
+async def refresh_token_periodically() -> None:
+    """Фоновая задача: обновляет токен заранее, чтобы он не истек посреди запроса"""
+    while True:
+        try:
+            await google_executor.run(refresh_token_if_needed)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка при обновлении токена Google: {e}")
+        await asyncio.sleep(TOKEN_CHECK_INTERVAL)
@@ -0,0 +1,112 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Callable
+
+logger = logging.getLogger(__name__)
+
+# Потоки для вызовов Google API и предел задач, ожидающих свободный поток
+GOOGLE_EXECUTOR_WORKERS = int(os.getenv('GOOGLE_EXECUTOR_WORKERS', '4'))
+GOOGLE_EXECUTOR_MAX_PENDING = int(os.getenv('GOOGLE_EXECUTOR_MAX_PENDING', '64'))
+
+class GoogleExecutorSaturated(RuntimeError):
+    """Очередь исполнителя Google API заполнена: вызов отклонен, а не поставлен в ожидание"""
+
+class GoogleExecutor:
+    def __init__(self, max_workers: int = GOOGLE_EXECUTOR_WORKERS, max_pending: int = GOOGLE_EXECUTOR_MAX_PENDING):
+        """
+        Отдельный ограниченный пул потоков для блокирующих вызовов googleapiclient.
+
+        Стандартный executor event loop используется и для DNS-запросов aiohttp,
+        поэтому медленный Google не должен занимать его потоки.
+
+        Args:
+            max_workers: Количество потоков
+            max_pending: Сколько задач может ждать свободный поток; сверх этого вызовы отклоняются
+        """
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="google-io")
+        self.pending = 0  # Отправлено в пул и еще не завершено
+        # running и время ожидания/выполнения меняются в потоках пула
+        self._lock = threading.Lock()
+        self.running = 0
+        self.stats = {"submitted": 0, "completed": 0, "failed": 0, "rejected": 0, "peak_pending": 0}
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.run_total = 0.0
+
+    async def run(self, func: Callable, *args, **kwargs) -> Any:
+        """
+        Выполняет func(*args, **kwargs) в пуле Google и ждет результат.
+
+        Raises:
+            GoogleExecutorSaturated: Если в очереди уже max_pending задач
+        """
+        if self.pending >= self.max_workers + self.max_pending:
+            self.stats["rejected"] += 1
+            raise GoogleExecutorSaturated(
+                f"Исполнитель Google API перегружен: {self.pending} задач в работе и в очереди"
+            )
+
+        submitted = time.monotonic()
+
+        def call():
+            started = time.monotonic()
+            wait = started - submitted
+            with self._lock:
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+                self.running += 1
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.running -= 1
+                    self.run_total += time.monotonic() - started
+
+        self.pending += 1
+        self.stats["submitted"] += 1
+        self.stats["peak_pending"] = max(self.stats["peak_pending"], self.pending)
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self.executor, call)
+            self.stats["completed"] += 1
+            return result
+        except Exception:
+            self.stats["failed"] += 1
+            raise
+        finally:
+            self.pending -= 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        Метрики загрузки пула.
+
+        Returns:
+            Dict: Счетчики задач, текущая очередь, занятые потоки, доля занятости
+                  и время ожидания/выполнения в секундах
+        """
+        finished = self.stats["completed"] + self.stats["failed"]
+        stats = dict(self.stats)
+        with self._lock:
+            running, wait_total, wait_max, run_total = self.running, self.wait_total, self.wait_max, self.run_total
+        stats.update({
+            "workers": self.max_workers,
+            "running": running,
+            "queued": max(0, self.pending - running),
+            "saturation": round(self.pending / self.max_workers, 2),
+            "wait_avg": wait_total / finished if finished else 0.0,
+            "wait_max": wait_max,
+            "run_avg": run_total / finished if finished else 0.0
+        })
+        return stats
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Останавливает пул"""
+        self.executor.shutdown(wait=wait)
+
+# Общий исполнитель для SheetsLogger и DocsLoader
+google_executor = GoogleExecutor()
@@ -4,6 +4,8 @@ import logging
 import aiohttp
 from datetime import datetime
 from m_config import TELEGRAM_TOKEN
+from google_executor import google_executor
+from user_inbox import user_inbox
 
 logger = logging.getLogger(__name__)
 
@@ -37,7 +39,32 @@ class BotHealthChecker:
             
             self.last_successful_check = datetime.now()
             logger.info(f"💚 Бот здоров: @{me.username} (время ответа: {response_time:.2f}с)")
-            
+
+            # Метрики планировщика исходящих сообщений
+            scheduler = getattr(self.bot, "outbound_scheduler", None)
+            if scheduler:
+                stats = scheduler.get_stats()
+                logger.info(
+                    f"📤 Очередь отправки: {stats['queue_depth']} {stats['queue_depth_by_priority']}, "
+                    f"в работе {stats['in_flight']}, отправлено {stats['sent']}, повторов {stats['retries']}, "
+                    f"ошибок {stats['failed']}, задержка ср. {stats['latency_avg']:.2f}с / p95 {stats['latency_p95']:.2f}с"
+                )
+
+            # Загрузка пула потоков Google API
+            stats = google_executor.get_stats()
+            logger.info(
+                f"🧵 Пул Google API: занято {stats['running']}/{stats['workers']}, в очереди {stats['queued']}, "
+                f"отклонено {stats['rejected']}, ожидание ср. {stats['wait_avg']:.2f}с / макс. {stats['wait_max']:.2f}с"
+            )
+
+            # Очередь входящих сообщений: сколько запросов к модели сэкономлено объединением
+            stats = user_inbox.get_stats()
+            logger.info(
+                f"📥 Входящие: получено {stats['received']}, запросов к модели {stats['turns']}, "
+                f"объединено {stats['coalesced']}, отменено генераций {stats['superseded'] + stats['reset']}, "
+                f"в очереди {stats['queued']} от {stats['active_users']} пользователей"
+            )
+
             # Проверяем доступность внешних API
             await self._check_external_apis()
             
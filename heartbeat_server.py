@@ -1,52 +1,70 @@
 # heartbeat_server.py
-from flask import Flask
-import logging
 import os
-import signal
-import sys
-from dotenv import load_dotenv
-
-load_dotenv()
-
-# Настраиваем логирование для Flask-сервера
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-    ]
-)
+import asyncio
+import logging
+from typing import Optional
+
+from aiohttp import web
+
+from metrics import REGISTRY
+
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
+# Адрес сервера /heartbeat и /metrics (FLASK_* — прежние имена переменных)
+METRICS_HOST = os.getenv('METRICS_HOST', os.getenv('FLASK_HOST', '0.0.0.0'))
+METRICS_PORT = int(os.getenv('METRICS_PORT', os.getenv('FLASK_PORT', '5001')))
 
-@app.route('/heartbeat')
-def heartbeat():
-    """
-    Эндпоинт для проверки состояния сервера.
-    Возвращает "OK" и статус 200, если сервер доступен.
-    """
-    logger.info("Получен запрос на /heartbeat")
-    return "OK", 200
+# Тип ответа /metrics по спецификации текстового формата Prometheus
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
 
-if __name__ == '__main__':
-    # Обработка сигналов для graceful shutdown
-    def signal_handler(signum, frame):
-        logger.info(f"Получен сигнал {signum}. Завершение работы heartbeat сервера...")
-        sys.exit(0)
+class HeartbeatServer:
+    def __init__(self):
+        """
+        HTTP-сервер внутри процесса бота (aiohttp, в том же event loop):
+        /heartbeat — проверка доступности, /metrics — метрики в формате Prometheus.
+        """
+        self.runner: Optional[web.AppRunner] = None
 
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
+    async def heartbeat(self, request: web.Request) -> web.Response:
+        """
+        Эндпоинт для проверки состояния сервера.
+        Возвращает "OK" и статус 200, если сервер доступен.
+        """
+        return web.Response(text="OK")
 
-    # Используем порт из переменных окружения или по умолчанию 5000
-    port = int(os.getenv("FLASK_PORT", 5001))
-    host = os.getenv("FLASK_HOST", "0.0.0.0")
+    async def metrics(self, request: web.Request) -> web.Response:
+        return web.Response(body=REGISTRY.render().encode("utf-8"),
+                            headers={"Content-Type": METRICS_CONTENT_TYPE, "X-Content-Type-Options": "nosniff"})
 
-    logger.info(f"Запускаю Heartbeat Server на {host}:{port}/heartbeat")
+    async def start(self, host: str = METRICS_HOST, port: int = METRICS_PORT) -> None:
+        app = web.Application()
+        app.router.add_get('/heartbeat', self.heartbeat)
+        app.router.add_get('/metrics', self.metrics)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        logger.info(f"Heartbeat и метрики доступны на {host}:{port} (/heartbeat, /metrics)")
+
+    async def stop(self) -> None:
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+
+async def _serve_forever() -> None:
+    server = HeartbeatServer()
+    await server.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+if __name__ == '__main__':
+    # Отдельный запуск: только /heartbeat (метрики бота отдает сервер внутри main.py)
+    from dotenv import load_dotenv
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    logger.info(f"Запускаю Heartbeat Server на {METRICS_HOST}:{METRICS_PORT}/heartbeat")
     try:
-        app.run(host=host, port=port, debug=False)
+        asyncio.run(_serve_forever())
     except KeyboardInterrupt:
         logger.info("Heartbeat сервер остановлен через KeyboardInterrupt.")
-    except Exception as e:
-        logger.critical(f"Ошибка при запуске Flask Heartbeat сервера: {e}", exc_info=True)
-        exit(1)
\ No newline at end of file
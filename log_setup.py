@@ -0,0 +1,151 @@
+import os
+import zlib
+import gzip
+import queue
+import atexit
+import shutil
+import logging
+import itertools
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Dict, Optional
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+LOG_FILE = os.getenv('LOG_FILE', 'logs/bot.log')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+
+# Уровни отдельных логгеров: "ds_models=WARNING,sheets_spool=DEBUG".
+# По умолчанию приглушен aiogram.event, который пишет строку на каждый апдейт
+LOG_LEVELS = os.getenv('LOG_LEVELS', 'aiogram.event=WARNING')
+
+# Ротация: при достижении размера файл сжимается в bot.log.1.gz, хранится LOG_BACKUP_COUNT архивов
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', str(10 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', '10'))
+
+# Подробные строки о каждом сообщении пишутся выборочно: для одного из LOG_SAMPLE_EVERY запросов —
+# все строки с этими метками, для остальных — ни одной
+LOG_SAMPLED_TAGS = tuple(tag for tag in os.getenv('LOG_SAMPLED_TAGS', '[ДЕТАЛЬНЫЙ_ЛОГ]').split(',') if tag)
+LOG_SAMPLE_EVERY = int(os.getenv('LOG_SAMPLE_EVERY', '10'))
+
+# Длинные сообщения (ответы модели, промпты) обрезаются до этого размера; traceback не обрезается
+LOG_MAX_MESSAGE_CHARS = int(os.getenv('LOG_MAX_MESSAGE_CHARS', '2000'))
+
+# Предел очереди записей: при переполнении записи отбрасываются, а не блокируют event loop
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+
+_listener: Optional[QueueListener] = None
+
+# Идентификатор запроса, по которому решается, попадут ли в лог его подробные строки
+_sample_key: ContextVar[Optional[str]] = ContextVar("log_sample_key", default=None)
+
+def set_sample_key(key: str) -> None:
+    """Задает идентификатор запроса для выборочного логирования в текущей задаче"""
+    _sample_key.set(key)
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, tags=LOG_SAMPLED_TAGS, every: int = LOG_SAMPLE_EVERY):
+        """
+        Пропускает записи с метками tags для одного из every запросов: решение принимается
+        по хешу идентификатора запроса (set_sample_key), поэтому строки одного запроса
+        сохраняются или отбрасываются вместе. Вне запроса — одна из every записей каждой метки.
+        """
+        super().__init__()
+        self.tags = tags
+        self.every = max(1, every)
+        self.counters: Dict[str, itertools.count] = {tag: itertools.count() for tag in tags}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        message = record.msg
+        if not isinstance(message, str) or not message.startswith(self.tags) or record.levelno >= logging.WARNING:
+            return True
+        key = _sample_key.get()
+        if key is not None:
+            return zlib.crc32(key.encode()) % self.every == 0
+        for tag in self.tags:
+            if message.startswith(tag):
+                return next(self.counters[tag]) % self.every == 0
+        return True
+
+class TruncatingQueueHandler(QueueHandler):
+    """
+    Передает записи в очередь; в файл и консоль их пишет QueueListener в отдельном потоке.
+    Слишком длинные сообщения обрезаются перед постановкой в очередь.
+    """
+    def __init__(self, log_queue: queue.Queue, max_chars: int = LOG_MAX_MESSAGE_CHARS):
+        super().__init__(log_queue)
+        self.max_chars = max_chars
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        message = record.getMessage()
+        if len(message) > self.max_chars:
+            record.msg = f"{message[:self.max_chars]}… [обрезано {len(message) - self.max_chars} символов]"
+            record.args = None
+        return super().prepare(record)
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def _gzip_namer(name: str) -> str:
+    return name + ".gz"
+
+def _gzip_rotator(source: str, dest: str) -> None:
+    with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+def _parse_levels(spec: str) -> Dict[str, str]:
+    levels = {}
+    for item in spec.split(','):
+        if '=' in item:
+            name, level = item.split('=', 1)
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+def setup_logging() -> None:
+    """
+    Настраивает логирование процесса: консоль и файл с ротацией и сжатием.
+
+    Запись в файл выполняется в потоке QueueListener, поэтому event loop
+    не ждет диска. Повторный вызов ничего не делает.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    os.makedirs(os.path.dirname(LOG_FILE) or '.', exist_ok=True)
+    formatter = logging.Formatter(LOG_FORMAT)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+    file_handler = RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+    file_handler.setFormatter(formatter)
+    file_handler.namer = _gzip_namer
+    file_handler.rotator = _gzip_rotator
+
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    queue_handler = TruncatingQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter())
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(LOG_LEVEL.upper())
+    for name, level in _parse_levels(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level)
+
+    _listener = QueueListener(log_queue, stream_handler, file_handler, respect_handler_level=True)
+    _listener.start()
+    # Оставшиеся в очереди записи дописываются при завершении процесса
+    atexit.register(stop_logging)
+
+def stop_logging() -> None:
+    """Дописывает записи из очереди и останавливает поток логирования"""
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    _listener = None
@@ -1,11 +1,15 @@
 from aiogram import Router, F
-from aiogram.types import Message
+from aiogram.types import Message, FSInputFile
 from aiogram.filters import CommandStart, Command
 from m_config import logger, ADMIN_IDS, BOT_NAME, BOT_USERNAME, TELEGRAM_TOKEN
 from m_utils import get_bot_info
 from ds_utils import add_message_to_deepseek_dialog, send_long_message_safe
 from ds_message_handler import handle_deepseek_message
+from user_inbox import user_inbox
+from sharding import get_shard_cluster, shard_path
+from tracing import trace_recorder, start_trace, format_trace, TRACE_EXPORT_FILE
 from datetime import datetime
+import time
 
 router = Router()
 
@@ -48,6 +52,8 @@ async def reset_dialog_handler(message: Message, user_data_manager=None):
     try:
         # Очищаем диалог используя новую функцию
         from ds_utils import clear_dialog_history
+        # Ответ, который еще генерируется, и ждущие сообщения больше не нужны
+        user_inbox.reset(user_id)
         clear_dialog_history(user_id, message.bot)
 
         await message.answer("Диалог сброшен. Давайте начнем заново! 😊")
@@ -67,22 +73,27 @@ async def reload_prompts(message: Message, docs_loader_instance):
         return
     try:
         await message.answer("🔄 Обновляю кешированные инструкции...")
-        load_all_prompts(docs_loader_instance)
-        await message.answer("✅ Кешированные инструкции успешно обновлены!")
+        await load_all_prompts(docs_loader_instance)
+        from m_prompts import prompt_registry
+        if prompt_registry.offline:
+            await message.answer(f"⚠️ Google Docs недоступен, используется локальный кэш. Версия: {prompt_registry.get().version}")
+            return
+        await message.answer(f"✅ Кешированные инструкции успешно обновлены! Версия: {prompt_registry.get().version}")
     except Exception as e:
         logger.error(f"Ошибка при обновлении кешированных инструкций: {e}")
         await message.answer("❌ Произошла ошибка при обновлении инструкций.")
 
 async def show_prompt(message: Message, docs_loader_instance):
     """Обработчик команды /show_prompt."""
-    from m_prompts import get_system_prompt_content
+    from m_prompts import get_system_prompt
 
     if message.from_user.id not in ADMIN_IDS:
         await message.answer("У вас нет доступа к этой команде.")
         return
     try:
-        prompt = await get_system_prompt_content(docs_loader_instance)
-        await send_long_message_safe(message, prompt, parse_mode=None)
+        prompt = await get_system_prompt(docs_loader_instance)
+        header = f"Версия промпта: {prompt.version} (ревизия документа: {prompt.revision_id or '-'})\n\n"
+        await send_long_message_safe(message, header + prompt.text, parse_mode=None)
     except Exception as e:
         logger.error(f"Ошибка при показе промпта: {e}")
         await message.answer("Произошла ошибка при получении промпта.")
@@ -98,7 +109,12 @@ async def cmd_user_info(message: Message, user_data_manager):
         return
     try:
         user_id = int(args[1])
-        user_data = user_data_manager.get_user_data(user_id)
+        cluster = get_shard_cluster()
+        if cluster:
+            # Данные пользователя хранит обработчик, которому он принадлежит
+            user_data = await cluster.call_user(user_id, "user_info", user_id=user_id)
+        else:
+            user_data = user_data_manager.get_user_data(user_id)
         info = (
             f"📊 Информация о пользователе {user_id}\n\n"
             f"🆕 Создан: {user_data['created_at']}\n"
@@ -120,7 +136,15 @@ async def cmd_all_users(message: Message, user_data_manager):
         await message.answer("У вас нет доступа к этой команде.")
         return
     try:
-        users_data = user_data_manager.get_all_users_data()
+        cluster = get_shard_cluster()
+        if cluster:
+            # Каждый обработчик возвращает своих пользователей парами (user_id, данные)
+            results = await cluster.call_all("all_users")
+            users_data = {user_id: data for pairs in results.values() for user_id, data in pairs}
+            if len(results) < cluster.count:
+                await message.answer(f"⚠️ Ответили {len(results)} из {cluster.count} обработчиков: список неполный.")
+        else:
+            users_data = user_data_manager.get_all_users_data()
         if not users_data:
             await message.answer("Нет данных о пользователях.")
             return
@@ -136,24 +160,83 @@ async def cmd_all_users(message: Message, user_data_manager):
         logger.error(f"Ошибка при получении списка пользователей: {e}")
         await message.answer("Произошла ошибка при получении списка пользователей.")
 
+# Сколько трасс показывает /slow_traces по умолчанию
+SLOW_TRACES_DEFAULT = 5
+
+async def cmd_slow_traces(message: Message):
+    """Обработчик команды /slow_traces [N | export]."""
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("У вас нет доступа к этой команде.")
+        return
+    args = message.text.split()
+    try:
+        cluster = get_shard_cluster()
+        if len(args) == 2 and args[1] == "export":
+            # Каждый обработчик выгружает свой буфер в свой файл
+            if cluster:
+                exports = list((await cluster.call_all("export_traces")).values())
+            else:
+                exports = [export_traces()]
+            for export in exports:
+                await message.answer_document(
+                    FSInputFile(export["path"]), caption=f"Трасс: {export['count']}"
+                )
+            return
+        limit = int(args[1]) if len(args) == 2 else SLOW_TRACES_DEFAULT
+        if cluster:
+            results = await cluster.call_all("slow_traces", limit=limit)
+            traces = [trace for shard_traces in results.values() for trace in shard_traces]
+            traces = sorted(traces, key=lambda trace: trace["duration_ms"], reverse=True)[:limit]
+        else:
+            traces = trace_recorder.slowest(limit)
+        if not traces:
+            await message.answer("Трасс пока нет.")
+            return
+        text = f"🐢 Самые медленные из последних запросов ({len(traces)}):\n\n"
+        text += "\n\n".join(format_trace(trace) for trace in traces)
+        await send_long_message_safe(message, text, parse_mode=None)
+    except ValueError:
+        await message.answer("Использование: /slow_traces [количество | export]")
+    except Exception as e:
+        logger.error(f"Ошибка при получении трасс: {e}")
+        await message.answer("Произошла ошибка при получении трасс.")
+
+def export_traces() -> dict:
+    """Выгружает буфер трасс процесса в JSONL"""
+    path = shard_path(TRACE_EXPORT_FILE)
+    return {"path": path, "count": trace_recorder.export_jsonl(path)}
+
 @router.message()
 async def deepseek_router(message: Message, docs_loader_instance, sheets_logger_instance=None, user_data_manager=None, user_manager=None):
     """Обработчик сообщений для DeepSeek."""
     user_id = message.from_user.id
+    received = time.perf_counter()
     logger.info(f"[ВХОДЯЩЕЕ_СООБЩЕНИЕ] От пользователя {user_id}: '{message.text}' (message_id: {message.message_id})")
     
     if user_data_manager:
         user_data_manager.update_last_interaction(user_id)
     logger.info(f"Получено сообщение от пользователя {user_id}: {message.text[:50]}...")
-    try:
-        await handle_deepseek_message(
-            message=message,
-            user_data_manager=user_data_manager,
-            user_manager=user_manager,
-            sheets_logger_instance=sheets_logger_instance,
-            docs_loader_instance=docs_loader_instance
-        )
-    except Exception as e:
-        logger.error(f"Ошибка в deepseek_router: {str(e)}")
-        await message.answer("Произошла ошибка при обработке вашего сообщения. Пожалуйста, попробуйте позже.")
-        raise
\ No newline at end of file
+
+    async def process(merged_message: Message):
+        # Трасса начинается с получения сообщения (при склейке — последнего из присланных подряд):
+        # ожидание в очереди пользователя (пауза склейки, предыдущий ответ) — первый этап
+        with start_trace("deepseek_router", user_id, started=received) as trace:
+            trace.add_span("inbox", received, time.perf_counter())
+            await handle(merged_message)
+
+    async def handle(merged_message: Message):
+        try:
+            await handle_deepseek_message(
+                message=merged_message,
+                user_data_manager=user_data_manager,
+                user_manager=user_manager,
+                sheets_logger_instance=sheets_logger_instance,
+                docs_loader_instance=docs_loader_instance
+            )
+        except Exception as e:
+            logger.error(f"Ошибка в deepseek_router: {str(e)}")
+            await merged_message.answer("Произошла ошибка при обработке вашего сообщения. Пожалуйста, попробуйте позже.")
+            raise
+
+    # Сообщения пользователя обрабатываются по очереди, присланные подряд — одним запросом
+    user_inbox.submit(message, process)
\ No newline at end of file
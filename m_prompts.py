@@ -1,8 +1,14 @@
-from typing import Dict
-from docs_loader import DocsLoader
+import asyncio
+from functools import lru_cache
+from typing import Optional, Tuple, Dict, Any, TYPE_CHECKING
 from m_config import logger
+from prompt_registry import PromptRegistry, PromptVersion
+from prompt_index import PromptIndex
+from document_registry import DocumentRegistry, TopicDocument
 
-cached_prompts: Dict[str, str] = {}
+if TYPE_CHECKING:
+    # Клиенты Google импортируются только при создании DocsLoader (см. startup)
+    from docs_loader import DocsLoader
 
 def format_prompt_with_link(prompt: str) -> str:
     """Форматирует промпт, заменяя ссылку на правильный формат."""
@@ -13,28 +19,8 @@ def format_prompt_with_link(prompt: str) -> str:
     )
     return prompt
 
-def load_all_prompts(docs_loader_instance: DocsLoader) -> None:
-    """Загружает основной промпт из Google Docs."""
-    global cached_prompts
-    try:
-        main_prompt = docs_loader_instance.get_document_content()
-        cached_prompts["main"] = format_prompt_with_link(main_prompt)
-    except Exception as e:
-        logger.error(f"Ошибка загрузки основной инструкции: {e}")
-        cached_prompts["main"] = docs_loader_instance._get_default_prompt()
-
-async def get_system_prompt_content(docs_loader_instance: DocsLoader) -> str:
-    """Получает системный промпт."""
-    if not cached_prompts.get("main"):
-        try:
-            main_prompt = docs_loader_instance.get_document_content()
-            cached_prompts["main"] = format_prompt_with_link(main_prompt)
-        except Exception as e:
-            logger.error(f"Ошибка при загрузке системного промпта: {e}")
-            return "Ты - помощник для родителей. Отвечай на вопросы вежливо и профессионально."
-
-    # Добавляем строгие инструкции против фантазирования
-    strict_instructions = """
+# Строгие инструкции против фантазирования
+STRICT_INSTRUCTIONS = """
 
 КРИТИЧЕСКИ ВАЖНО - СТРОГИЕ ПРАВИЛА ОТВЕТОВ:
 
@@ -52,6 +38,9 @@ async def get_system_prompt_content(docs_loader_instance: DocsLoader) -> str:
 "Извините, но этот вопрос выходит за рамки моей специализации. Рекомендую обратиться к детскому психологу или специалисту."
 """
 
+@lru_cache(maxsize=1)
+def _instructions_suffix() -> str:
+    """Строгие правила и инструкции по эмоциям (не зависят от документа, собираются один раз)."""
     # Добавляем инструкции по эмоциям
     from emotion_handler import get_available_emotions
     emotion_instructions = f"""
@@ -74,4 +63,82 @@ async def get_system_prompt_content(docs_loader_instance: DocsLoader) -> str:
 Пример: "Рекомендую попробовать этот подход... [emotion:уверенность]"
 """
 
-    return cached_prompts["main"] + strict_instructions + emotion_instructions
\ No newline at end of file
+    return STRICT_INSTRUCTIONS + emotion_instructions
+
+def build_system_prompt(main_prompt: str) -> str:
+    """Собирает системный промпт из текста документа, строгих правил и инструкций по эмоциям."""
+    return format_prompt_with_link(main_prompt) + _instructions_suffix()
+
+def format_topic_document(document: TopicDocument) -> str:
+    """Оформляет тематический документ как дополнение к инструкции."""
+    return f"\n\nДополнительные материалы по теме «{document.topic}»:\n{document.text}"
+
+def build_request_prompt(prompt: PromptVersion, query: str) -> Tuple[str, Dict[str, Any]]:
+    """
+    Собирает системный промпт для конкретного запроса: вводная часть инструкции,
+    только подходящие запросу разделы (если документ достаточно большой)
+    и подходящие тематические документы.
+
+    Returns:
+        Tuple: (текст промпта, сведения о выбранных разделах, темах и экономии токенов)
+    """
+    info: Dict[str, Any] = {}
+    document = None
+    if prompt.index is not None and prompt.index.enabled:
+        document, info = prompt.index.select(query)
+
+    topics = document_registry.match(query) if document_registry else []
+    if topics:
+        if document is None:
+            document = prompt.document_text
+        document += "".join(format_topic_document(topic) for topic in topics)
+        info["topics"] = [topic.topic for topic in topics]
+
+    if document is None:
+        return prompt.text, info
+    text = build_system_prompt(document)
+    if prompt.index is not None:
+        info.update(prompt.index.record_saving(prompt.text, text))
+    return text, info
+
+prompt_registry: Optional[PromptRegistry] = None
+document_registry: Optional[DocumentRegistry] = None
+
+def get_prompt_registry(docs_loader_instance: 'DocsLoader') -> PromptRegistry:
+    """Возвращает реестр версий системного промпта (создается при первом обращении)."""
+    global prompt_registry
+    if prompt_registry is None:
+        prompt_registry = PromptRegistry(docs_loader_instance, build_system_prompt, build_index=PromptIndex)
+    return prompt_registry
+
+def get_document_registry(docs_loader_instance: 'DocsLoader') -> DocumentRegistry:
+    """Возвращает реестр тематических документов (создается при первом обращении)."""
+    global document_registry
+    if document_registry is None:
+        document_registry = DocumentRegistry(docs_loader_instance)
+    return document_registry
+
+async def init_prompts(docs_loader_instance: Optional['DocsLoader']) -> None:
+    """Загружает промпт при запуске: из локального кэша сразу, обновление из Google Docs — в фоне."""
+    await asyncio.gather(
+        get_prompt_registry(docs_loader_instance).initialize(),
+        get_document_registry(docs_loader_instance).initialize()
+    )
+
+async def load_all_prompts(docs_loader_instance: 'DocsLoader') -> None:
+    """Загружает основной промпт и тематические документы из Google Docs (параллельно)."""
+    await asyncio.gather(
+        get_prompt_registry(docs_loader_instance).refresh(force=True),
+        get_document_registry(docs_loader_instance).refresh(force=True)
+    )
+
+async def get_system_prompt(docs_loader_instance: 'DocsLoader') -> PromptVersion:
+    """Получает текущую версию системного промпта."""
+    registry = get_prompt_registry(docs_loader_instance)
+    if registry.current is None:
+        await registry.refresh(force=True)
+    return registry.get()
+
+async def get_system_prompt_content(docs_loader_instance: 'DocsLoader') -> str:
+    """Получает системный промпт."""
+    return (await get_system_prompt(docs_loader_instance)).text
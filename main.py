@@ -1,9 +1,11 @@
 import asyncio
-import signal
 import sys
+import os
 from aiogram import Bot, Dispatcher, Router
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.filters import CommandStart, Command
-from m_config import logger, TELEGRAM_TOKEN
+from aiogram.types import Update
+from m_config import logger, TELEGRAM_TOKEN, TELEGRAM_CONNECTION_LIMIT, BOT_MODE
 from m_handlers import (
     start_router,
     reset_dialog_handler,
@@ -11,20 +13,81 @@ from m_handlers import (
     show_prompt,
     cmd_user_info,
     cmd_all_users,
+    cmd_slow_traces,
+    export_traces,
     deepseek_router
 )
-from broadcaster import broadcast_command_handler
-from docs_loader import DocsLoader
-from sheets_logger import SheetsLogger
+from broadcaster import broadcast_command_handler, send_broadcast_message
 from user_manager import UserManager
 from user_data_manager import UserDataManager
-from m_prompts import load_all_prompts
+from m_prompts import get_prompt_registry, get_document_registry
 from m_utils import get_bot_info
 from dialog_manager import DialogManager
+from emotion_file_ids import EmotionFileIdCache
+from emotion_handler import load_emotion_assets, warm_up_emotion_file_ids
+from telegram_sender import setup_outbound_scheduler
+from google_executor import google_executor
+from shutdown import shutdown_coordinator, install_signal_handlers
+from user_inbox import user_inbox
+from heartbeat_server import HeartbeatServer, METRICS_PORT
+from metrics import IN_FLIGHT, QUEUE_DEPTH, CACHE_SIZE
+from tracing import trace_recorder, TRACE_SLOW_LOG
+from startup import StartupReport, connect_telegram, init_prompts_phase, init_sheets_phase, start_sheets_phase
+from sharding import (
+    SHARD_COUNT, SHARD_INDEX, sharding_enabled, is_shard_worker, owns_user, shard_path,
+    ShardServer, ShardCluster, set_shard_cluster, get_shard_cluster, run_ingress
+)
 
 # Глобальная переменная для бота
 bot = None
 
+def init_local_state():
+    """Загружает локальные данные: изображения эмоций, пользователей и диалоги"""
+    # Изображения эмоций проверяются и готовятся заранее: отсутствующий файл должен ронять запуск
+    load_emotion_assets()
+    if is_shard_worker():
+        # Обработчик владеет только своими пользователями; список для рассылки при первом запуске
+        # берется из общего файла
+        return (
+            UserManager(shard_path('user_ids.json'), seed_path='user_ids.json', user_filter=owns_user),
+            UserDataManager(user_filter=owns_user),
+            DialogManager(user_filter=owns_user, shared_content_name=shard_path("shared_content.json"))
+        )
+    return UserManager(), UserDataManager(), DialogManager()
+
+def register_metric_sources(bot, dialog_manager, sheets_logger_instance, document_registry):
+    """Подключает источники текущих значений для /metrics (читаются только при запросе метрик)"""
+    IN_FLIGHT.set_function(lambda: len(user_inbox.active))
+    QUEUE_DEPTH.set_function(lambda: {
+        "inbox": user_inbox.get_stats()["queued"],
+        "outbound": sum(bot.outbound_scheduler.queued.values()),
+        "google_executor": google_executor.get_stats()["queued"]
+    })
+    if sheets_logger_instance:
+        QUEUE_DEPTH.set_function(lambda: {"sheets_spool_bytes": sheets_logger_instance.spool.pending_bytes()})
+    CACHE_SIZE.set_function(lambda: {
+        "dialogs": len(dialog_manager.dialogs_cache),
+        "emotion_file_ids": len(bot.emotion_file_ids.entries),
+        "telegram_chats": len(bot.outbound_scheduler.chats),
+        "topic_documents": len(document_registry.documents)
+    })
+
+async def start_heartbeat_server():
+    """
+    Запускает /heartbeat и /metrics. Обработчики (sharding) слушают следующие порты:
+    METRICS_PORT + 1 + SHARD_INDEX. Занятый порт не мешает работе бота.
+    """
+    if METRICS_PORT <= 0:
+        return None
+    port = METRICS_PORT + 1 + SHARD_INDEX if is_shard_worker() else METRICS_PORT
+    server = HeartbeatServer()
+    try:
+        await server.start(port=port)
+    except OSError as e:
+        logger.error(f"Не удалось запустить сервер /heartbeat и /metrics на порту {port}: {e}")
+        return None
+    return server
+
 async def main():
     """Основная функция запуска бота."""
     global bot
@@ -35,55 +98,93 @@ async def main():
 
     # Настройка обработки сигналов для graceful shutdown
     shutdown_event = asyncio.Event()
-    
-    def signal_handler(sig, frame):
-        logger.info(f"🛑 Получен сигнал {sig}. Инициация graceful shutdown...")
-        shutdown_event.set()
+    install_signal_handlers(shutdown_event)
+
+    # Все исходящие запросы идут через общий пул соединений и планировщик с лимитами Telegram
+    bot = Bot(token=TELEGRAM_TOKEN, session=AiohttpSession(limit=TELEGRAM_CONNECTION_LIMIT))
 
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
+    if sharding_enabled() and not is_shard_worker():
+        # Входной процесс: только получает обновления и передает их обработчикам по user_id
+        heartbeat_server = await start_heartbeat_server()
+        try:
+            await connect_telegram(bot)
+            await run_ingress(bot, BOT_MODE, os.path.abspath(__file__), shutdown_event)
+        except Exception as e:
+            logger.critical(f"Критическая ошибка входного процесса: {e}", exc_info=True)
+            sys.exit(1)
+        finally:
+            await bot.session.close()
+            if heartbeat_server:
+                await heartbeat_server.stop()
+        return
 
-    bot = Bot(token=TELEGRAM_TOKEN)
+    # Лимит Telegram общий для бота: обработчики делят его поровну
+    setup_outbound_scheduler(bot, share=SHARD_COUNT if is_shard_worker() else 1)
     dp = Dispatcher()
     router = Router()
     
     # Добавляем диагностическое логирование
     logger.info("🚀 Инициализация бота началась...")
-    
-    # Проверяем соединение с Telegram API с повторными попытками
-    max_connection_attempts = 3
-    for attempt in range(max_connection_attempts):
-        try:
-            bot_info = await bot.get_me()
-            logger.info(f"✅ Соединение с Telegram API установлено. Бот: @{bot_info.username}")
-            break
-        except Exception as e:
-            logger.error(f"❌ Ошибка соединения с Telegram API (попытка {attempt + 1}/{max_connection_attempts}): {e}")
-            if attempt == max_connection_attempts - 1:
-                logger.critical("Не удалось установить соединение с Telegram API после всех попыток")
-                await bot.session.close()
-                sys.exit(1)
-            await asyncio.sleep(5)
+    startup_report = StartupReport()
 
+    # Независимые шаги запуска выполняются параллельно: соединение с Telegram,
+    # загрузка промпта, создание клиентов Google (в пуле Google) и чтение локальных данных
     try:
-        # Инициализация компонентов
-        docs_loader_instance = DocsLoader()
-        load_all_prompts(docs_loader_instance)
+        _, docs_loader_instance, sheets_logger_instance, local_state = await asyncio.gather(
+            startup_report.run("telegram", connect_telegram, bot),
+            startup_report.run("промпт", init_prompts_phase),
+            startup_report.run("google sheets", init_sheets_phase),
+            startup_report.run("локальные данные", asyncio.to_thread, init_local_state)
+        )
+    except Exception as e:
+        startup_report.log("Запуск прерван")
+        logger.critical(f"Не удалось запустить бота: {e}", exc_info=True)
+        await bot.session.close()
+        sys.exit(1)
 
-        try:
-            sheets_logger_instance = SheetsLogger()
-            sheets_logger_instance.create_headers_if_needed()
-        except Exception as e:
-            logger.error(f"Не удалось инициализировать SheetsLogger: {e}. Логирование в Google Sheets будет недоступно.", exc_info=True)
-            sheets_logger_instance = None
+    try:
+        # Токен Google обновляется заранее в фоне, чтобы не истекать посреди запроса
+        from google_clients import refresh_token_periodically
+        token_refresh_task = asyncio.create_task(refresh_token_periodically())
+        # Новая версия инструкции подхватывается автоматически при изменении документа
+        prompt_registry = get_prompt_registry(docs_loader_instance)
+        prompt_poll_task = None if prompt_registry.offline else asyncio.create_task(prompt_registry.poll_revisions())
+        document_registry = get_document_registry(docs_loader_instance)
+        topic_poll_task = None if document_registry.offline or not document_registry.topics else asyncio.create_task(document_registry.poll_revisions())
 
-        user_manager = UserManager()
-        user_data_manager = UserDataManager()
-        dialog_manager = DialogManager()
+        # Заголовки таблицы читаются уже после запуска polling; до этого сообщения копятся в спуле
+        if sheets_logger_instance:
+            sheets_start_task = startup_report.background("google sheets: старт", start_sheets_phase, sheets_logger_instance)
+
+        user_manager, user_data_manager, dialog_manager = local_state
+
+        # При остановке дописывается все накопленное; данные пользователей пишутся сразу и не требуют записи
+        shutdown_coordinator.add_flusher("диалоги", lambda: asyncio.to_thread(dialog_manager.flush))
+        if sheets_logger_instance:
+            async def flush_sheets():
+                await sheets_logger_instance.close()
+                pending = sheets_logger_instance.spool.pending_bytes()
+                return f"в спуле осталось {pending} байт" if pending else None
+            shutdown_coordinator.add_flusher("google sheets", flush_sheets)
+
+        # Последние трассы сохраняются при остановке; медленные запросы пишутся сразу
+        if is_shard_worker():
+            trace_recorder.slow_log = shard_path(TRACE_SLOW_LOG)
+        async def flush_traces():
+            export = await asyncio.to_thread(export_traces)
+            return f"{export['count']} трасс в {export['path']}"
+        shutdown_coordinator.add_flusher("трассы", flush_traces)
 
         # Добавляем DialogManager в объект бота для доступа из других модулей
         bot.dialog_manager = dialog_manager
 
+        # Кэш file_id изображений эмоций: загружаем недостающие картинки заранее в чат администратора
+        bot.emotion_file_ids = EmotionFileIdCache()
+        from m_config import ADMIN_IDS
+        # При разделении на процессы изображения загружает только обработчик чата администратора
+        if ADMIN_IDS and owns_user(ADMIN_IDS[0]):
+            asyncio.create_task(warm_up_emotion_file_ids(bot, ADMIN_IDS[0]))
+
         # Регистрация обработчиков
         router.message.register(start_router, CommandStart())
         # Создаем обертки для обработчиков с зависимостями
@@ -110,17 +211,19 @@ async def main():
         router.message.register(show_prompt_wrapper, Command("show_prompt"))
         router.message.register(user_info_wrapper, Command("user_info"))
         router.message.register(all_users_wrapper, Command("all_users"))
+        router.message.register(cmd_slow_traces, Command("slow_traces"))
 
         # Регистрация команды broadcast
         async def broadcast_handler_wrapper(message):
             from m_config import ADMIN_IDS
-            await broadcast_command_handler(
+            # Рассылку остановка дожидается (в пределах SHUTDOWN_DRAIN_SECONDS), как и ответы пользователям
+            await shutdown_coordinator.track(broadcast_command_handler(
                 message=message,
                 bot=bot,
                 sheets_logger_instance=sheets_logger_instance,
                 user_manager=user_manager,
                 ADMIN_IDS=ADMIN_IDS
-            )
+            ))
 
         router.message.register(broadcast_handler_wrapper, Command("broadcast"))
         router.message.register(deepseek_wrapper)
@@ -139,14 +242,29 @@ async def main():
         bot_info = get_bot_info()
         logger.info(f"🤖 Запускается {bot_info['name']}...")
 
-        # Настройка graceful shutdown
+        # Настройка graceful shutdown: прием обновлений, ответы, запись накопленного (shutdown.py),
+        # затем фоновые задачи и сессия бота
         async def on_shutdown():
             logger.info("🛑 Завершение работы бота...")
+            await shutdown_coordinator.shutdown()
+            token_refresh_task.cancel()
+            if prompt_poll_task:
+                prompt_poll_task.cancel()
+            if topic_poll_task:
+                topic_poll_task.cancel()
+            google_executor.shutdown(wait=False)
             try:
                 await bot.session.close()
                 logger.info("✅ Сессия бота закрыта")
             except Exception as e:
                 logger.error(f"Ошибка при закрытии сессии бота: {e}")
+            # /heartbeat отвечает до конца остановки
+            if heartbeat_server:
+                await heartbeat_server.stop()
+
+        # Метрики обработки сообщений, очередей и кэшей
+        register_metric_sources(bot, dialog_manager, sheets_logger_instance, document_registry)
+        heartbeat_server = await start_heartbeat_server()
             
         # Запускаем мониторинг состояния
         from health_checker import BotHealthChecker
@@ -154,31 +272,81 @@ async def main():
         health_task = asyncio.create_task(health_checker.start_monitoring())
         
         try:
+            if is_shard_worker():
+                # Обработчик: обновления своих пользователей приходят от входного процесса,
+                # запросы рассылки и админских команд — от других обработчиков
+                shard_server = ShardServer(SHARD_INDEX)
+
+                async def handle_update(update):
+                    await dp.feed_update(bot, Update.model_validate(update, context={"bot": bot}))
+
+                async def broadcast(text):
+                    return await send_broadcast_message(bot, user_manager, text)
+
+                async def all_users():
+                    return list(user_data_manager.get_all_users_data().items())
+
+                async def user_info(user_id):
+                    return user_data_manager.get_user_data(user_id)
+
+                async def slow_traces(limit):
+                    return trace_recorder.slowest(limit)
+
+                async def export_shard_traces():
+                    return await asyncio.to_thread(export_traces)
+
+                shard_server.register("update", handle_update)
+                shard_server.register("broadcast", broadcast)
+                shard_server.register("all_users", all_users)
+                shard_server.register("user_info", user_info)
+                shard_server.register("slow_traces", slow_traces)
+                shard_server.register("export_traces", export_shard_traces)
+                set_shard_cluster(ShardCluster(local=shard_server))
+                await shard_server.start()
+                shutdown_coordinator.add_intake("обработчик", shard_server.stop)
+                shutdown_coordinator.add_flusher("соединения с обработчиками", get_shard_cluster().close)
+                startup_report.log(f"Обработчик {SHARD_INDEX}/{SHARD_COUNT} готов к приему обновлений")
+                await shutdown_event.wait()
+                return
+
+            if BOT_MODE == "webhook":
+                # Обновления принимает встроенный aiohttp-сервер; работаем до сигнала остановки
+                from webhook_server import WebhookServer
+                webhook_server = WebhookServer(dp, bot)
+                await webhook_server.start()
+                shutdown_coordinator.add_intake("webhook", webhook_server.stop)
+                QUEUE_DEPTH.set_function(lambda: {"webhook": webhook_server.queue.qsize()})
+                startup_report.log("Бот принимает обновления через webhook")
+                await shutdown_event.wait()
+                return
+
+            startup_report.log("Бот готов к запуску polling")
             logger.info("🔄 Запуск polling...")
+            # После работы в режиме webhook getUpdates недоступен, пока webhook не удален
+            await bot.delete_webhook()
             
-            # Создаем задачу для polling
+            # Создаем задачу для polling. Сигналы и закрытие сессии остаются за shutdown_coordinator:
+            # иначе aiogram закрыл бы сессию сразу после сигнала, не дав дописать начатые ответы
             polling_task = asyncio.create_task(dp.start_polling(
                 bot, 
                 polling_timeout=20,  # Таймаут для long polling
                 request_timeout=15,  # Таймаут для HTTP запросов
-                skip_updates=True    # Пропускаем накопленные сообщения при перезапуске
+                skip_updates=True,   # Пропускаем накопленные сообщения при перезапуске
+                handle_signals=False,
+                close_bot_session=False
             ))
+
+            async def stop_polling():
+                polling_task.cancel()
+                await asyncio.gather(polling_task, return_exceptions=True)
+                logger.info("📊 Polling остановлен")
+
+            shutdown_coordinator.add_intake("polling", stop_polling)
             
             # Ждем либо завершения polling, либо сигнала остановки
-            done, pending = await asyncio.wait(
-                [polling_task, asyncio.create_task(shutdown_event.wait())],
-                return_when=asyncio.FIRST_COMPLETED
-            )
-            
-            # Отменяем незавершенные задачи
-            for task in pending:
-                task.cancel()
-                try:
-                    await task
-                except asyncio.CancelledError:
-                    pass
-                    
-            logger.info("📊 Polling остановлен")
+            shutdown_task = asyncio.create_task(shutdown_event.wait())
+            await asyncio.wait([polling_task, shutdown_task], return_when=asyncio.FIRST_COMPLETED)
+            shutdown_task.cancel()
             
         except Exception as e:
             logger.error(f"❌ Критическая ошибка в polling: {e}", exc_info=True)
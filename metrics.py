@@ -0,0 +1,198 @@
+"""
+Метрики бота в формате Prometheus (text exposition 0.0.4), отдаются по /metrics (heartbeat_server.py).
+
+Запись метрики на горячем пути — словарь по меткам и сложение (гистограмма — еще bisect по границам),
+поэтому инструментирование не заметно на фоне запросов к DeepSeek и Telegram. Размеры очередей
+и кэшей не обновляются при каждом изменении, а читаются функциями в момент запроса /metrics.
+"""
+import math
+import bisect
+import logging
+from typing import Callable, Dict, List, Sequence, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+# Границы гистограмм (секунд)
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 90.0, 120.0)
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25)
+
+GaugeValue = Union[float, Dict[str, float]]
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children: Dict[Tuple[str, ...], object] = {}
+        REGISTRY.register(self)
+
+    def labels(self, *values: str):
+        """Значение метрики для набора меток (создается при первом обращении)"""
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return "\n".join(lines)
+
+class _CounterValue:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.value += amount
+
+class Counter(_Metric):
+    """Монотонный счетчик"""
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterValue()
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.labels().inc(amount)
+
+    def _samples(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}"
+            for values, child in list(self.children.items())
+        ]
+
+class _HistogramValue:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Последний — больше верхней границы
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Histogram(_Metric):
+    """Распределение длительностей по границам buckets"""
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def _samples(self) -> List[str]:
+        lines = []
+        for values, child in list(self.children.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), child.counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, values, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, values)
+            lines.append(f"{self.name}_sum{labels} {_format_value(child.sum)}")
+            lines.append(f"{self.name}_count{labels} {child.count}")
+        return lines
+
+class Gauge(_Metric):
+    """
+    Текущее значение, которое читается функцией в момент запроса /metrics.
+    Функция возвращает число или (для метрики с одной меткой) словарь значение метки -> число.
+    """
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.callbacks: List[Callable[[], GaugeValue]] = []
+
+    def set_function(self, callback: Callable[[], GaugeValue]) -> None:
+        """Добавляет источник значений (несколько источников нужны, например, для разных кэшей)"""
+        self.callbacks.append(callback)
+
+    def _samples(self) -> List[str]:
+        lines = []
+        for callback in self.callbacks:
+            try:
+                value = callback()
+            except Exception as e:
+                logger.debug(f"Метрика {self.name} недоступна: {e}")
+                continue
+            items = value.items() if isinstance(value, dict) else [((), value)]
+            for label_values, number in items:
+                if not isinstance(label_values, tuple):
+                    label_values = (label_values,)
+                lines.append(f"{self.name}{_format_labels(self.labelnames, label_values)} {_format_value(number)}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> None:
+        if metric.name in self.metrics:
+            raise ValueError(f"Метрика {metric.name} уже зарегистрирована")
+        self.metrics[metric.name] = metric
+
+    def render(self) -> str:
+        """Все метрики в текстовом формате Prometheus"""
+        return "\n".join(metric.render() for metric in self.metrics.values()) + "\n"
+
+REGISTRY = Registry()
+
+# Длительности обработки сообщения
+STAGE_SECONDS = Histogram(
+    "bot_stage_seconds", "Длительность этапа обработки сообщения (routing, probe, completion, delivery)", ["stage"]
+)
+COMPLETION_SECONDS = Histogram("bot_deepseek_completion_seconds", "Генерация ответа DeepSeek", ["model"])
+MARKDOWN_RENDER_SECONDS = Histogram(
+    "bot_markdown_render_seconds", "Преобразование ответа модели в HTML Telegram", buckets=FAST_BUCKETS
+)
+TELEGRAM_SEND_SECONDS = Histogram(
+    "bot_telegram_send_seconds", "Отправка запроса в Telegram с ожиданием в очереди планировщика", ["method"]
+)
+HANDLING_SECONDS = Histogram("bot_handling_seconds", "Полная обработка сообщения пользователя")
+
+# Счетчики
+DEEPSEEK_TOKENS = Counter("bot_deepseek_tokens_total", "Токены DeepSeek (prompt, completion, cache_hit)", ["model", "kind"])
+ERRORS = Counter("bot_errors_total", "Ошибки по месту и классу исключения", ["component", "error"])
+FALLBACKS = Counter("bot_fallbacks_total", "Переходы на запасной вариант (модель chat, промпт по умолчанию)", ["kind"])
+MESSAGES = Counter("bot_messages_total", "Обработанные сообщения пользователей по результату", ["outcome"])
+
+# Текущие значения (источники подключаются в main.py)
+IN_FLIGHT = Gauge("bot_requests_in_flight", "Сообщения, ответ на которые сейчас генерируется или отправляется")
+QUEUE_DEPTH = Gauge("bot_queue_depth", "Глубина очередей", ["queue"])
+CACHE_SIZE = Gauge("bot_cache_entries", "Размеры кэшей в памяти", ["cache"])
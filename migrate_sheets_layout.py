@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Перенос лога Google Sheets из раскладки "columns" (столбец на пользователя на Sheet1)
+в раскладку "rows" (строка на сообщение во вкладках по месяцам).
+
+Использование:
+    python migrate_sheets_layout.py --dry-run   # только посчитать сообщения и вкладки
+    python migrate_sheets_layout.py             # выполнить перенос
+
+Исходный лист не изменяется. После переноса установите SHEETS_LAYOUT=rows.
+"""
+import sys
+import shutil
+import asyncio
+import tempfile
+import logging
+import argparse
+from dotenv import load_dotenv
+
+from sheets_logger import SheetsLogger, parse_column_cell
+from google_clients import execute
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Сколько строк отправлять одним values.append
+MIGRATION_CHUNK_SIZE = 1000
+
+def read_column_layout(sheets_logger: SheetsLogger, source_sheet: str):
+    """Читает лист прежнего формата по столбцам и возвращает записи, отсортированные по времени"""
+    result = execute(sheets_logger.sheet.values().get(
+        spreadsheetId=sheets_logger.spreadsheet_id,
+        range=source_sheet,
+        majorDimension='COLUMNS'
+    ))
+
+    records = []
+    for column in result.get('values', []):
+        if not column or not column[0]:
+            continue
+        user_key = column[0]
+        last_timestamp = ""
+        for cell in column[1:]:
+            if not cell:
+                continue
+            record = parse_column_cell(user_key, cell)
+            # Ячейки без метки времени остаются рядом с предыдущим сообщением пользователя
+            if record["timestamp"]:
+                last_timestamp = record["timestamp"]
+            else:
+                record["timestamp"] = last_timestamp
+            records.append(record)
+
+    # Сортировка устойчивая: порядок сообщений одного пользователя в одну секунду сохраняется
+    records.sort(key=lambda record: record["timestamp"])
+    return records
+
+async def migrate(source_sheet: str, dry_run: bool, force: bool) -> int:
+    # Записи отправляются напрямую; отдельный спул не пересекается со спулом работающего бота
+    spool_dir = tempfile.mkdtemp(prefix="sheets_migration_spool_")
+    try:
+        sheets_logger = SheetsLogger(layout="rows", spool_dir=spool_dir)
+        try:
+            return await _migrate(sheets_logger, source_sheet, dry_run, force)
+        finally:
+            sheets_logger.spool.close()
+    finally:
+        shutil.rmtree(spool_dir, ignore_errors=True)
+
+async def _migrate(sheets_logger: SheetsLogger, source_sheet: str, dry_run: bool, force: bool) -> int:
+    records = read_column_layout(sheets_logger, source_sheet)
+    logger.info(f"Прочитано {len(records)} сообщений из листа {source_sheet}")
+
+    tabs = await sheets_logger.get_log_tabs()
+    if tabs and not force:
+        logger.error(f"В таблице уже есть вкладки лога ({', '.join(sorted(tabs))}). "
+                     f"Повторный перенос создаст дубликаты; используйте --force, если это ожидаемо")
+        return 1
+
+    if dry_run:
+        months = sorted({record["timestamp"][:7] for record in records if record["timestamp"]})
+        logger.info(f"Пробный запуск: будет записано {len(records)} строк за месяцы: {', '.join(months)}")
+        return 0
+
+    for start in range(0, len(records), MIGRATION_CHUNK_SIZE):
+        chunk = records[start:start + MIGRATION_CHUNK_SIZE]
+        written = await sheets_logger.append_records(chunk)
+        while written < len(chunk):
+            logger.warning("Временная ошибка Google Sheets, повтор через 10 сек...")
+            await asyncio.sleep(10)
+            written += await sheets_logger.append_records(chunk[written:])
+        logger.info(f"Перенесено {min(start + MIGRATION_CHUNK_SIZE, len(records))}/{len(records)}")
+
+    stats = sheets_logger.get_stats()
+    logger.info(f"Перенос завершен: {stats['records']} строк, отклонено {stats['rejected']}, вызовов API: {stats['api_calls']}")
+    return 0 if not stats['rejected'] else 1
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Перенос лога Google Sheets в построчную раскладку")
+    parser.add_argument("--source-sheet", default="Sheet1", help="Лист в прежней раскладке (по умолчанию Sheet1)")
+    parser.add_argument("--dry-run", action="store_true", help="Только показать, что будет перенесено")
+    parser.add_argument("--force", action="store_true", help="Переносить, даже если вкладки лога уже существуют")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(migrate(args.source_sheet, args.dry_run, args.force)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+import os
+import re
+import math
+import time
+import logging
+from collections import Counter
+from typing import List, Dict, Tuple, Any
+
+logger = logging.getLogger(__name__)
+
+# Сколько наиболее подходящих разделов инструкции добавлять к запросу
+PROMPT_RETRIEVAL_TOP_K = int(os.getenv('PROMPT_RETRIEVAL_TOP_K', '4'))
+
+# Инструкцию короче этого размера выгоднее отправлять целиком
+PROMPT_RETRIEVAL_MIN_CHARS = int(os.getenv('PROMPT_RETRIEVAL_MIN_CHARS', '6000'))
+
+# Размер раздела, если в документе нет заголовков
+FALLBACK_SECTION_CHARS = 1500
+
+# Параметры BM25
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# Слова сравниваются по первым символам (грубая основа: "мотивации" и "мотивация" совпадают)
+STEM_LENGTH = 6
+
+_HEADING = re.compile(r'^(#{1,6})\s+(.+)$')
+_WORD = re.compile(r'\w+')
+_STOP_WORDS = frozenset(
+    "и в во не что он на я с со как а то все она так его но да ты к у же вы за бы по только ее мне было вот от "
+    "меня еще нет о из ему теперь когда даже ну вдруг ли если уже или ни быть был него до вас нибудь опять уж "
+    "вам ведь там потом себя ничего ей может они тут где есть надо ней для мы тебя их чем была сам чтоб без "
+    "будто чего раз тоже себе под будет ж тогда кто этот того потому этого какой совсем ним здесь этом один "
+    "почти мой тем чтобы нее сейчас были куда зачем всех никогда можно при наконец два об другой хоть после "
+    "над больше тот через эти нас про всего них какая много разве три эту моя впрочем хорошо свою этой перед "
+    "иногда лучше чуть том нельзя такой им более всегда конечно всю между это".split()
+)
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов (для русского текста ~3 символа на токен)"""
+    return len(text) // 3 + 1
+
+def tokenize(text: str) -> List[str]:
+    """Слова текста в нижнем регистре, без стоп-слов, обрезанные до основы"""
+    return [word[:STEM_LENGTH] for word in _WORD.findall(text.lower()) if word not in _STOP_WORDS and not word.isdigit()]
+
+def split_sections(document_text: str) -> Tuple[str, List[Dict[str, str]]]:
+    """
+    Делит документ на вводную часть и разделы по заголовкам ("# ...", "## ...").
+    Если заголовков нет, делит текст на куски по абзацам.
+
+    Returns:
+        Tuple: (вводная часть, список разделов {"title", "text"})
+    """
+    lines = document_text.split("\n")
+    if any(_HEADING.match(line) for line in lines):
+        preamble: List[str] = []
+        sections: List[Dict[str, str]] = []
+        for line in lines:
+            heading = _HEADING.match(line)
+            if heading:
+                sections.append({"title": heading.group(2).strip(), "text": line})
+            elif sections:
+                sections[-1]["text"] += "\n" + line
+            else:
+                preamble.append(line)
+        for section in sections:
+            section["text"] = section["text"].strip()
+        return "\n".join(preamble).strip(), sections
+
+    sections = []
+    current = ""
+    for paragraph in re.split(r'\n\s*\n', document_text):
+        if current and len(current) + len(paragraph) > FALLBACK_SECTION_CHARS:
+            sections.append(current)
+            current = ""
+        current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current:
+        sections.append(current)
+    # Без заголовков вводной частью считаем первый кусок
+    preamble = sections.pop(0) if sections else ""
+    return preamble, [{"title": section.split("\n", 1)[0][:80], "text": section} for section in sections]
+
+class PromptIndex:
+    def __init__(self, document_text: str):
+        """
+        Локальный BM25-индекс разделов инструкции.
+        Строится один раз на версию промпта.
+
+        Args:
+            document_text: Текст документа с инструкцией
+        """
+        started = time.perf_counter()
+        self.document_text = document_text
+        self.preamble, self.sections = split_sections(document_text)
+        self.enabled = len(document_text) >= PROMPT_RETRIEVAL_MIN_CHARS and len(self.sections) > PROMPT_RETRIEVAL_TOP_K
+
+        # Обратный индекс: основа слова -> [(номер раздела, частота)]
+        self.postings: Dict[str, List[Tuple[int, int]]] = {}
+        self.lengths: List[int] = []
+        for number, section in enumerate(self.sections):
+            # Заголовок учитываем дважды: он лучше всего описывает раздел
+            terms = tokenize(section["title"]) * 2 + tokenize(section["text"])
+            self.lengths.append(len(terms))
+            for term, count in Counter(terms).items():
+                self.postings.setdefault(term, []).append((number, count))
+
+        total = len(self.sections)
+        self.average_length = sum(self.lengths) / total if total else 0.0
+        self.idf = {
+            term: math.log(1 + (total - len(postings) + 0.5) / (len(postings) + 0.5))
+            for term, postings in self.postings.items()
+        }
+
+        self.stats = {"requests": 0, "misses": 0, "full_tokens": 0, "sent_tokens": 0, "search_seconds": 0.0}
+        logger.info(
+            f"[ПРОМПТ] Индекс инструкции: {len(self.sections)} разделов, {len(self.postings)} терминов, "
+            f"поиск {'включен' if self.enabled else 'выключен (документ небольшой)'}, "
+            f"построен за {(time.perf_counter() - started) * 1000:.1f} мс"
+        )
+
+    def search(self, query: str, top_k: int = PROMPT_RETRIEVAL_TOP_K) -> List[Tuple[int, float]]:
+        """
+        Находит разделы, наиболее подходящие к запросу.
+
+        Returns:
+            List[Tuple[int, float]]: (номер раздела, оценка BM25) по убыванию оценки
+        """
+        scores: Dict[int, float] = {}
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = self.idf[term]
+            for number, count in postings:
+                norm = 1 - BM25_B + BM25_B * self.lengths[number] / self.average_length
+                scores[number] = scores.get(number, 0.0) + idf * count * (BM25_K1 + 1) / (count + BM25_K1 * norm)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+
+    def select(self, query: str, top_k: int = PROMPT_RETRIEVAL_TOP_K) -> Tuple[str, Dict[str, Any]]:
+        """
+        Собирает сокращенный документ: вводная часть и подходящие запросу разделы (в исходном порядке).
+
+        Returns:
+            Tuple: (текст документа для промпта, сведения о выборе и экономии)
+        """
+        if not self.enabled:
+            return self.document_text, {"sections": None, "search_ms": 0.0}
+
+        started = time.perf_counter()
+        found = self.search(query, top_k)
+        elapsed = time.perf_counter() - started
+
+        self.stats["requests"] += 1
+        self.stats["search_seconds"] += elapsed
+        if not found:
+            # Ни один раздел не подошел (приветствие, вопрос не по теме, опечатки):
+            # без разделов модель осталась бы почти без инструкции, поэтому отправляется весь документ
+            self.stats["misses"] += 1
+            logger.info("[ПРОМПТ] Подходящих разделов не найдено, отправляется вся инструкция")
+            return self.document_text, {"sections": None, "miss": True, "search_ms": elapsed * 1000}
+
+        numbers = sorted(number for number, _ in found)
+        parts = [self.preamble] if self.preamble else []
+        parts.extend(self.sections[number]["text"] for number in numbers)
+        document = "\n\n".join(parts)
+        return document, {
+            "sections": [self.sections[number]["title"] for number in numbers],
+            "search_ms": elapsed * 1000
+        }
+
+    def record_saving(self, full_prompt: str, sent_prompt: str) -> Dict[str, int]:
+        """Учитывает экономию токенов на запросе и возвращает оценки для лога"""
+        full_tokens, sent_tokens = estimate_tokens(full_prompt), estimate_tokens(sent_prompt)
+        self.stats["full_tokens"] += full_tokens
+        self.stats["sent_tokens"] += sent_tokens
+        return {
+            "full_tokens": full_tokens,
+            "sent_tokens": sent_tokens,
+            "saved_percent": round(100 * (1 - sent_tokens / full_tokens)) if full_tokens else 0
+        }
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Накопленная статистика: запросы, промахи поиска, токены полного и отправленного промпта, среднее время поиска"""
+        stats = dict(self.stats)
+        requests = stats["requests"]
+        stats["average_search_ms"] = stats.pop("search_seconds") * 1000 / requests if requests else 0.0
+        stats["saved_percent"] = round(100 * (1 - stats["sent_tokens"] / stats["full_tokens"])) if stats["full_tokens"] else 0
+        return stats
+
+if __name__ == "__main__":
+    # Проверка выбора разделов: python prompt_index.py
+    sample = "Вводная часть инструкции.\n\n" + "\n\n".join(
+        f"## {title}\n" + f"Как помочь ребенку, если {title.lower()}. " * 40
+        for title in ("Ребенок не хочет учиться", "Истерики перед сном", "Ссоры братьев и сестер",
+                      "Страх школы", "Зависимость от телефона", "Подростковая грубость")
+    )
+    index = PromptIndex(sample)
+    assert index.enabled
+
+    document, info = index.select("Что делать с истериками перед сном?")
+    assert info["sections"] and "Истерики перед сном" in info["sections"], info
+    assert len(document) < len(sample)
+
+    # Запрос без совпадений получает весь документ, а не одну вводную часть
+    document, info = index.select("Привет!")
+    assert document == sample and info["miss"], info
+    document, info = index.select("qwerty zxcvb")
+    assert document == sample and info["miss"], info
+
+    print(f"OK: {index.get_stats()}")
@@ -0,0 +1,178 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from typing import NamedTuple, Callable, Optional, Any
+
+from google_executor import google_executor
+
+logger = logging.getLogger(__name__)
+
+# Как часто проверять, не изменился ли документ с инструкцией (секунд)
+PROMPT_POLL_INTERVAL = int(os.getenv('PROMPT_POLL_INTERVAL', '60'))
+
+# Последний успешно загруженный документ хранится локально для быстрого старта и работы без Google
+PROMPT_CACHE_FILE = os.getenv('PROMPT_CACHE_FILE', 'prompt_cache.json')
+
+# PROMPT_OFFLINE=1: не обращаться к Google Docs, работать только из локального кэша
+PROMPT_OFFLINE = os.getenv('PROMPT_OFFLINE', '0') == '1'
+
+# Промпт на случай, если инструкцию из Google Docs загрузить не удалось
+DEFAULT_PROMPT = """Я - ассистент, специализирующийся на воспитании детей.
+Моя цель - помочь родителям справиться с трудностями, связанными с воспитанием, обучением, мотивацией, дисциплиной и другими вещами.
+Я даю практические советы, объясняю техники и приемы воспитания, составляю планы и использую все свои знания, чтобы помощь родителям в общении с ребенком."""
+
+class PromptVersion(NamedTuple):
+    """Полностью собранный системный промпт (неизменяемый)"""
+    text: str
+    version: str  # Короткий хеш текста
+    revision_id: str  # revisionId документа Google Docs ("" для промпта по умолчанию)
+    fetched_at: float  # Когда документ был загружен из Google Docs
+    source: str  # "docs", "cache" или "default"
+    index: Any = None  # Индекс разделов документа для выбора частей инструкции под запрос
+    document_text: str = ""  # Исходный текст документа (из него промпт пересобирается с тематическими документами)
+
+class PromptRegistry:
+    def __init__(self, docs_loader, assemble: Callable[[str], str], cache_path: str = PROMPT_CACHE_FILE,
+                 offline: bool = PROMPT_OFFLINE, build_index: Optional[Callable[[str], Any]] = None):
+        """
+        Хранит текущую версию системного промпта.
+
+        Промпт собирается один раз при загрузке документа; новая версия подменяет старую
+        одним присваиванием, поэтому запрос всегда видит целиком одну из версий.
+
+        Args:
+            docs_loader: DocsLoader основного документа (None — Google Docs недоступен)
+            assemble: Функция, собирающая системный промпт из текста документа
+            cache_path: Путь к локальному кэшу документа
+            offline: Не обращаться к Google Docs, использовать только кэш
+            build_index: Функция, строящая индекс документа (вызывается один раз на версию)
+        """
+        self.docs_loader = docs_loader
+        self.assemble = assemble
+        self.build_index = build_index
+        self.cache_path = cache_path
+        self.offline = offline or docs_loader is None
+        self.current: Optional[PromptVersion] = None
+        self._revalidate_task: Optional[asyncio.Task] = None
+
+    def _make_version(self, document_text: str, revision_id: str, fetched_at: float, source: str) -> PromptVersion:
+        text = self.assemble(document_text)
+        version = hashlib.sha256(text.encode("utf-8")).hexdigest()[:12]
+        index = self.build_index(document_text) if self.build_index else None
+        return PromptVersion(text=text, version=version, revision_id=revision_id, fetched_at=fetched_at, source=source, index=index,
+                             document_text=document_text)
+
+    def load_cached(self) -> bool:
+        """
+        Загружает промпт из локального кэша (без обращения к сети).
+
+        Returns:
+            bool: True, если кэш найден и загружен
+        """
+        if not os.path.exists(self.cache_path):
+            return False
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            cached_version = self._make_version(data["document_text"], data.get("revision_id", ""), data.get("fetched_at", 0.0), "cache")
+        except Exception as e:
+            logger.error(f"[ПРОМПТ] Ошибка при загрузке кэша промпта из {self.cache_path}: {e}")
+            return False
+        age_hours = (time.time() - cached_version.fetched_at) / 3600
+        self._swap(cached_version, f"локальный кэш, загружен из Google Docs {age_hours:.1f} ч назад")
+        return True
+
+    def _save_cache(self, document_text: str, revision_id: str, fetched_at: float) -> None:
+        """Атомарно сохраняет последний успешно загруженный документ"""
+        # У каждого процесса свой временный файл: обработчики (sharding) сохраняют кэш независимо
+        tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({"document_text": document_text, "revision_id": revision_id, "fetched_at": fetched_at},
+                          f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.cache_path)
+        except Exception as e:
+            logger.error(f"[ПРОМПТ] Ошибка при сохранении кэша промпта в {self.cache_path}: {e}")
+
+    async def initialize(self) -> None:
+        """
+        Загружает промпт при старте: из кэша мгновенно, а проверку актуальности выполняет в фоне
+        (stale-while-revalidate). Без кэша ждет загрузки из Google Docs.
+        """
+        if self.load_cached():
+            if not self.offline:
+                self._revalidate_task = asyncio.create_task(self.refresh())
+            return
+        if self.offline:
+            logger.warning("[ПРОМПТ] Режим без Google Docs, но локального кэша нет")
+        await self.refresh(force=True)
+
+    def _swap(self, new_version: PromptVersion, reason: str) -> None:
+        old_version = self.current
+        self.current = new_version
+        if old_version is None or old_version.version != new_version.version:
+            logger.info(
+                f"[ПРОМПТ] Версия {old_version.version if old_version else '-'} -> {new_version.version} [{new_version.source}] "
+                f"(ревизия {new_version.revision_id or '-'}, {len(new_version.text)} символов, {reason})"
+            )
+
+    async def refresh(self, force: bool = False) -> bool:
+        """
+        Загружает документ и собирает новую версию промпта, если документ изменился.
+
+        Args:
+            force: Загрузить документ, даже если revisionId не изменился
+
+        Returns:
+            bool: True, если версия промпта сменилась
+        """
+        current = self.current
+        if self.offline:
+            if current is None:
+                self._swap(self._make_version(DEFAULT_PROMPT, "", 0.0, "default"), "промпт по умолчанию")
+                return True
+            return False
+
+        try:
+            if not force and current and current.revision_id:
+                revision_id = await google_executor.run(self.docs_loader.get_revision_id)
+                if revision_id == current.revision_id:
+                    return False
+
+            document_text, revision_id = await google_executor.run(self.docs_loader.fetch_document)
+            if not document_text:
+                raise ValueError("документ пуст")
+        except Exception as e:
+            logger.error(f"[ПРОМПТ] Не удалось загрузить инструкцию из Google Docs: {e}")
+            if current is None:
+                self._swap(self._make_version(DEFAULT_PROMPT, "", 0.0, "default"), "промпт по умолчанию")
+                return True
+            return False
+
+        fetched_at = time.time()
+        self._save_cache(document_text, revision_id, fetched_at)
+        new_version = self._make_version(document_text, revision_id, fetched_at, "docs")
+        changed = current is None or new_version.version != current.version
+        self._swap(new_version, "принудительное обновление" if force else "изменился документ")
+        return changed
+
+    def get(self) -> PromptVersion:
+        """Текущая версия промпта"""
+        if self.current is None:
+            raise RuntimeError("Системный промпт еще не загружен")
+        return self.current
+
+    async def poll_revisions(self, interval: int = PROMPT_POLL_INTERVAL) -> None:
+        """Фоновая задача: проверяет revisionId документа и обновляет промпт при изменениях"""
+        logger.info(f"[ПРОМПТ] Проверка изменений инструкции каждые {interval}с")
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"[ПРОМПТ] Ошибка при проверке изменений инструкции: {e}")
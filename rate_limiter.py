@@ -0,0 +1,91 @@
+import asyncio
+import heapq
+import itertools
+import time
+from typing import List, Tuple, Optional
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        """
+        Асинхронный token bucket с приоритетной очередью ожидающих
+
+        Args:
+            rate: Скорость пополнения (токенов в секунду)
+            capacity: Максимальный запас токенов (допустимый всплеск)
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        # Ожидающие: (приоритет, порядковый номер, future); меньший приоритет обслуживается раньше
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._counter = itertools.count()
+        self._dispatcher: Optional[asyncio.Task] = None
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _delay(self) -> float:
+        """Сколько ждать до появления токена (0, если токен уже есть)"""
+        self._refill()
+        pause = self.paused_until - time.monotonic()
+        if pause > 0:
+            return pause
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    @property
+    def waiting(self) -> int:
+        """Количество ожидающих токен"""
+        return sum(1 for _, _, future in self._waiters if not future.done())
+
+    @property
+    def idle(self) -> bool:
+        """Bucket полон и никто не ждет: состояние можно забыть без потери информации"""
+        self._refill()
+        return not self._waiters and self.tokens >= self.capacity and self.paused_until <= time.monotonic()
+
+    def try_acquire(self) -> bool:
+        """Забирает токен без ожидания, если он есть и очередь пуста"""
+        if not self._waiters and self._delay() == 0:
+            self.tokens -= 1
+            return True
+        return False
+
+    async def acquire(self, priority: int = 0) -> None:
+        """
+        Ждет токен. Ожидающие обслуживаются по приоритету, при равном приоритете — в порядке очереди.
+
+        Args:
+            priority: Приоритет (меньше — важнее)
+        """
+        if self.try_acquire():
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        await future
+
+    def pause(self, seconds: float) -> None:
+        """Запрещает выдачу токенов на указанное время (например, по retry_after от сервера)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = min(self.tokens, 0.0)
+
+    async def _dispatch(self) -> None:
+        """Раздает токены ожидающим по мере пополнения"""
+        while self._waiters:
+            delay = self._delay()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                # Ожидающий отменен: токен достается следующему
+                continue
+            self.tokens -= 1
+            future.set_result(None)
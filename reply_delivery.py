@@ -0,0 +1,168 @@
+import logging
+import re
+from html import unescape
+from typing import List, Dict, Optional, Any
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import Message
+
+from telegram_html import split_html, split_html_tail, visible_length
+from emotion_handler import send_emotion_image
+
+logger = logging.getLogger(__name__)
+
+# Лимиты Telegram на длину текста сообщения и подписи к фото (после разбора разметки)
+TEXT_LIMIT = 4096
+CAPTION_LIMIT = 1024
+
+# Место под индикатор "📝 Часть i/n:\n\n"
+PART_INDICATOR_RESERVE = 24
+
+def plan_reply(text: str, emotion: Optional[str] = None, has_placeholder: bool = False,
+               text_limit: int = TEXT_LIMIT) -> List[Dict[str, Any]]:
+    """
+    Составляет минимальный план отправки ответа.
+
+    Текст режется на части по лимиту сообщения Telegram. Если есть эмоция, последняя
+    часть (не длиннее лимита подписи) уходит подписью к картинке. Первая текстовая часть
+    заменяет сообщение-заглушку через редактирование, а не удаление и повторную отправку.
+
+    Args:
+        text: HTML Telegram (например, результат render_markdown)
+        emotion: Эмоция для картинки или None
+        has_placeholder: Есть ли сообщение-заглушку ("Надо подумать..."), которое можно заменить
+        text_limit: Максимальная длина текстового сообщения
+
+    Returns:
+        List[Dict]: Шаги вида {"action": "edit" | "send" | "photo" | "delete", "text": ...}
+    """
+    if emotion and visible_length(text) <= CAPTION_LIMIT:
+        text_parts, caption = [], text
+    elif emotion:
+        # Сначала от конца отрезается подпись (до лимита подписи), затем остаток режется по лимиту
+        # сообщения: так частей меньше всего
+        head, caption = split_html_tail(text, CAPTION_LIMIT - PART_INDICATOR_RESERVE)
+        text_parts = split_html(head, text_limit - PART_INDICATOR_RESERVE) if head else []
+    elif visible_length(text) <= text_limit:
+        text_parts, caption = [text], None
+    else:
+        text_parts, caption = split_html(text, text_limit - PART_INDICATOR_RESERVE), None
+
+    total = len(text_parts) + (1 if caption is not None else 0)
+
+    def with_indicator(part: str, number: int) -> str:
+        return f"📝 Часть {number}/{total}:\n\n{part}" if total > 1 else part
+
+    steps = []
+    for i, part in enumerate(text_parts):
+        action = "edit" if has_placeholder and i == 0 else "send"
+        steps.append({"action": action, "text": with_indicator(part, i + 1)})
+
+    if caption is not None:
+        if has_placeholder and not text_parts:
+            # Текстовое сообщение нельзя превратить в фото, поэтому заглушку убираем
+            steps.append({"action": "delete", "text": None})
+        steps.append({"action": "photo", "text": with_indicator(caption, total)})
+
+    return steps
+
+async def deliver_reply(message: Message, text: str, emotion: Optional[str] = None,
+                        placeholder: Optional[Message] = None, text_limit: int = TEXT_LIMIT) -> int:
+    """
+    Отправляет ответ пользователю по плану plan_reply.
+
+    Args:
+        message: Сообщение пользователя, на которое отвечаем
+        text: HTML Telegram
+        emotion: Эмоция для картинки или None
+        placeholder: Сообщение-заглушка, которое нужно заменить ответом
+        text_limit: Максимальная длина текстового сообщения
+
+    Returns:
+        int: Количество вызовов Telegram API
+    """
+    steps = plan_reply(text, emotion, placeholder is not None, text_limit)
+    user_id = message.from_user.id
+    calls = 0
+    logger.info(f"[ДОСТАВКА] План ответа для {user_id}: {[step['action'] for step in steps]}")
+
+    for step in steps:
+        action, part = step["action"], step["text"]
+        try:
+            if action == "edit":
+                calls += 1
+                try:
+                    await placeholder.edit_text(part, parse_mode="HTML")
+                    continue
+                except TelegramBadRequest as e:
+                    if _is_parse_error(e):
+                        raise
+                    # Заглушку удалили или ее уже нельзя редактировать: отправляем новым сообщением
+                    logger.warning(f"[ДОСТАВКА] Не удалось отредактировать заглушку для {user_id}: {e}")
+                calls += 1
+                await _send_text(message, part)
+            elif action == "send":
+                calls += 1
+                await _send_text(message, part)
+            elif action == "delete":
+                calls += 1
+                try:
+                    await placeholder.delete()
+                except Exception:
+                    pass
+            elif action == "photo":
+                calls += 1
+                if not await send_emotion_image(message.bot, message.chat.id, emotion, part):
+                    logger.warning(f"[ДОСТАВКА] Картинка не отправлена для {user_id}, отправляем подпись текстом")
+                    calls += 1
+                    await _send_text(message, part)
+        except TelegramBadRequest as e:
+            if not _is_parse_error(e):
+                raise
+            # Разметка должна быть корректной всегда; сюда попадаем только при ошибке рендера
+            logger.error(f"[ДОСТАВКА] Telegram отклонил разметку для {user_id}: {e}. Отправляем без форматирования")
+            calls += 1
+            await message.answer(_strip_html(part))
+
+    return calls
+
+async def _send_text(message: Message, text: str):
+    """
+    Отправляет текстовую часть ответа.
+    Паузы между частями и повтор после TelegramRetryAfter обеспечивает планировщик отправки (telegram_sender).
+    """
+    return await message.answer(text, parse_mode="HTML")
+
+def _is_parse_error(error: TelegramBadRequest) -> bool:
+    """Проверяет, что Telegram отклонил именно HTML-разметку"""
+    return "can't parse entities" in str(error).lower()
+
+def _strip_html(text: str) -> str:
+    """Убирает HTML-теги и раскрывает сущности"""
+    return unescape(re.sub(r'<[^>]+>', '', text))
+
+if __name__ == "__main__":
+    # Проверка плана отправки: python reply_delivery.py
+    import math
+    from telegram_html import render_markdown
+
+    def visible(html: str) -> int:
+        return visible_length(unescape(re.sub(r"<[^>]+>", "", html)))
+
+    limit = TEXT_LIMIT - PART_INDICATOR_RESERVE
+    sentence = "Попробуйте **спокойно** обсудить с ребенком, что его тревожит. "
+    for length in (500, 1000, 2000, 3600, 4500, 8000, 12000, 20000):
+        text = render_markdown((sentence * (length // len(sentence) + 1))[:length])
+        steps = plan_reply(text, emotion="joy")
+        caption = visible(steps[-1]["text"].split("\n\n", 1)[-1] if len(steps) > 1 else steps[-1]["text"])
+        total = visible(text)
+        # Подпись отрезается первой, остаток — минимальным числом сообщений
+        expected = math.ceil((total - caption) / limit) + 1 if total > CAPTION_LIMIT else 1
+        assert steps[-1]["action"] == "photo" and visible(steps[-1]["text"]) <= CAPTION_LIMIT, steps[-1]
+        assert len(steps) == expected, (length, len(steps), expected)
+        assert all(visible(step["text"]) <= TEXT_LIMIT for step in steps)
+        print(f"{length} символов: вызовов {len(steps)}")
+
+    # Заглушка редактируется первой частью, подпись уходит с картинкой
+    steps = plan_reply(render_markdown(sentence * 20), emotion="joy", has_placeholder=True)
+    assert [step["action"] for step in steps] == ["edit", "photo"], steps
+    print("OK")
@@ -0,0 +1,130 @@
+import os
+import time
+import asyncio
+import logging
+import itertools
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+from log_setup import set_sample_key
+from metrics import STAGE_SECONDS
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+# Общий бюджет на обработку одного сообщения (секунд)
+REQUEST_BUDGET_SECONDS = float(os.getenv('REQUEST_BUDGET_SECONDS', '90'))
+
+# Предельная длительность каждого этапа; фактический таймаут этапа не больше остатка бюджета
+# за вычетом резерва на следующие этапы
+STAGE_LIMITS = {
+    "routing": 10.0,     # выбор модели
+    "probe": 5.0,        # проверка доступности reasoning-модели
+    "completion": 75.0,  # генерация ответа
+    "delivery": 15.0     # отправка ответа в Telegram
+}
+STAGE_ORDER = ["routing", "probe", "completion", "delivery"]
+
+# Сколько времени оставлять на отправку ответа, даже если генерация заняла весь бюджет
+DELIVERY_RESERVE_SECONDS = 10.0
+
+# Причины отмены обработки
+REASON_SUPERSEDED = "пришло новое сообщение"
+REASON_RESET = "сброс диалога"
+REASON_SHUTDOWN = "остановка бота"
+
+# Новое сообщение пользователя отменяет генерацию ответа на предыдущее (ответ на него никто не прочтет)
+CANCEL_SUPERSEDED = os.getenv('CANCEL_SUPERSEDED', '1') == '1'
+
+_request_ids = itertools.count(1)
+
+class RequestContext:
+    def __init__(self, user_id: int, budget: float = REQUEST_BUDGET_SECONDS):
+        """
+        Контекст обработки одного сообщения: дедлайн, этапы и отмена.
+
+        Args:
+            user_id: ID пользователя
+            budget: Бюджет времени на всю обработку (секунд)
+        """
+        self.user_id = user_id
+        self.request_id = f"{user_id}-{next(_request_ids)}"
+        self.started = asyncio.get_running_loop().time()
+        self.deadline = self.started + budget
+        self.task: Optional[asyncio.Task] = None
+        self.cancel_reason: Optional[str] = None
+        # Сообщение пользователя уже записано в историю диалога
+        self.committed = False
+        # Ответ уже отправляется: прерывать его на середине нельзя
+        self.cancellable = True
+        self.stage_durations: Dict[str, float] = {}
+
+    def remaining(self) -> float:
+        return self.deadline - asyncio.get_running_loop().time()
+
+    def stage_timeout(self, stage: str) -> float:
+        """Таймаут этапа: его предел, но не больше остатка бюджета без резерва на отправку ответа"""
+        remaining = self.remaining()
+        if stage != "delivery":
+            remaining -= DELIVERY_RESERVE_SECONDS
+        else:
+            remaining = max(remaining, DELIVERY_RESERVE_SECONDS)
+        return max(0.0, min(STAGE_LIMITS[stage], remaining))
+
+    @asynccontextmanager
+    async def stage(self, stage: str):
+        """
+        Выполняет этап с таймаутом из оставшегося бюджета.
+        При нехватке времени поднимает TimeoutError.
+        """
+        timeout = self.stage_timeout(stage)
+        if stage == "delivery":
+            self.cancellable = False
+        started = time.perf_counter()
+        try:
+            with span(stage, timeout=round(timeout, 1)):
+                async with asyncio.timeout(timeout):
+                    yield timeout
+        finally:
+            duration = time.perf_counter() - started
+            self.stage_durations[stage] = duration
+            STAGE_SECONDS.labels(stage).observe(duration)
+
+    def cancel(self, reason: str) -> bool:
+        """
+        Отменяет обработку, если ответ еще не начал отправляться.
+        Отмена прерывает текущее ожидание (в том числе HTTP-запрос к DeepSeek — соединение закрывается).
+
+        Returns:
+            bool: True, если обработка была отменена
+        """
+        self.cancel_reason = reason
+        if not self.cancellable or self.task is None or self.task.done():
+            return False
+        logger.info(f"[ЗАПРОС] Обработка сообщения пользователя {self.user_id} отменена: {reason}")
+        self.task.cancel(reason)
+        return True
+
+    def describe(self) -> str:
+        """Длительности этапов для лога"""
+        stages = ", ".join(f"{stage} {self.stage_durations[stage]:.2f}с" for stage in STAGE_ORDER if stage in self.stage_durations)
+        return stages or "-"
+
+_current_request: ContextVar[Optional[RequestContext]] = ContextVar("current_request", default=None)
+
+def get_request_context(user_id: int) -> RequestContext:
+    """Контекст текущей обработки; вне очереди сообщений создается новый с полным бюджетом"""
+    context = _current_request.get()
+    if context is None or context.user_id != user_id:
+        context = RequestContext(user_id)
+        context.task = asyncio.current_task()
+        _current_request.set(context)
+        set_sample_key(context.request_id)
+    return context
+
+def set_request_context(context: RequestContext) -> None:
+    """Делает контекст текущим для задачи обработки (вызывается внутри этой задачи)"""
+    context.task = asyncio.current_task()
+    _current_request.set(context)
+    set_sample_key(context.request_id)
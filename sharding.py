@@ -0,0 +1,514 @@
+"""
+Горизонтальное масштабирование: несколько процессов бота, разделенных по user_id.
+
+При SHARD_COUNT > 1 main.py запускается как входной процесс: он один получает обновления
+от Telegram (polling или webhook) и передает каждое процессу-обработчику своего пользователя
+(shard_for(user_id)) через unix-сокет. Обработчики — те же main.py с SHARD_INDEX=i — владеют
+данными только своих пользователей (диалоги, user_data, список для рассылки), поэтому
+очередь сообщений пользователя, его история и отмена генерации остаются внутри одного процесса.
+
+Рассылка и админские команды, которым нужны все пользователи, опрашивают все процессы
+и объединяют ответы (ShardCluster.call_all).
+"""
+import os
+import sys
+import json
+import struct
+import asyncio
+import logging
+import itertools
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from shutdown import SHUTDOWN_TIMEOUT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Количество процессов-обработчиков; 1 — один процесс без разделения (прежний режим)
+SHARD_COUNT = max(1, int(os.getenv('SHARD_COUNT', '1')))
+
+# Номер процесса-обработчика; задается входным процессом при запуске обработчиков
+SHARD_INDEX = int(os.environ['SHARD_INDEX']) if os.getenv('SHARD_INDEX') else None
+
+# Каталог для unix-сокетов обработчиков
+SHARD_SOCKET_DIR = os.getenv('SHARD_SOCKET_DIR', 'run')
+
+# Перезапуск упавшего обработчика (секунд)
+SHARD_RESTART_DELAY = 5.0
+
+# Сколько ждать ответа обработчика на запрос (секунд); рассылка ждет без ограничения
+SHARD_CALL_TIMEOUT = 30.0
+
+# Сколько раз пытаться передать обновление недоступному обработчику (раз в секунду):
+# при перезапуске обработчик загружает промпт и данные, обновления его пользователей ждут
+SHARD_FORWARD_ATTEMPTS = 30
+
+# Сколько обновлений может ждать передачи одному обработчику; пока он перезапускается,
+# копятся только обновления его пользователей, остальные обработчики получают свои без задержки
+SHARD_FORWARD_QUEUE_SIZE = 1000
+
+# Типы обновлений, которые входной процесс запрашивает у Telegram (бот обрабатывает только сообщения)
+INGRESS_ALLOWED_UPDATES = ["message"]
+
+# Предел размера одного кадра протокола
+MAX_FRAME_BYTES = 64 * 1024 * 1024
+
+_FRAME_HEADER = struct.Struct(">I")
+
+ShardMethod = Callable[..., Awaitable[Any]]
+
+class ShardError(Exception):
+    """Обработчик недоступен или вернул ошибку"""
+
+def sharding_enabled() -> bool:
+    return SHARD_COUNT > 1
+
+def is_shard_worker() -> bool:
+    """Процесс запущен как обработчик своей части пользователей"""
+    return sharding_enabled() and SHARD_INDEX is not None
+
+def shard_for(user_id: int, count: int = SHARD_COUNT) -> int:
+    """Номер обработчика, которому принадлежит пользователь"""
+    return user_id % count
+
+def owns_user(user_id: int) -> bool:
+    """Данные пользователя принадлежат текущему процессу"""
+    return not is_shard_worker() or shard_for(user_id) == SHARD_INDEX
+
+def shard_path(path: str) -> str:
+    """
+    Путь к файлу или каталогу состояния текущего обработчика:
+    "user_ids.json" -> "user_ids_shard1.json", "sheets_spool" -> "sheets_spool_shard1".
+    Без разделения возвращает путь без изменений.
+    """
+    if not is_shard_worker():
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}_shard{SHARD_INDEX}{ext}"
+
+def socket_path(index: int) -> str:
+    return os.path.join(SHARD_SOCKET_DIR, f"shard{index}.sock")
+
+def update_user_id(data: Dict[str, Any]) -> Optional[int]:
+    """Отправитель обновления Telegram (поле from у message, callback_query и т.д.)"""
+    for value in data.values():
+        if isinstance(value, dict):
+            sender = value.get("from") or value.get("user")
+            if isinstance(sender, dict) and "id" in sender:
+                return sender["id"]
+    return None
+
+async def read_frame(reader: asyncio.StreamReader) -> Any:
+    """Читает кадр: 4 байта длины и JSON"""
+    header = await reader.readexactly(_FRAME_HEADER.size)
+    (size,) = _FRAME_HEADER.unpack(header)
+    if size > MAX_FRAME_BYTES:
+        raise ShardError(f"Слишком большой кадр: {size} байт")
+    return json.loads(await reader.readexactly(size))
+
+def encode_frame(payload: Any) -> bytes:
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    return _FRAME_HEADER.pack(len(body)) + body
+
+class ShardServer:
+    def __init__(self, index: int, path: Optional[str] = None):
+        """
+        Сервер обработчика: принимает обновления и запросы от входного процесса и других обработчиков.
+
+        Запрос — {"id", "method", "params"}; ответ — {"id", "result"} или {"id", "error"}.
+        Запрос без id (передача обновления) выполняется без ответа.
+
+        Args:
+            index: Номер обработчика
+            path: Путь к unix-сокету
+        """
+        self.index = index
+        self.path = path or socket_path(index)
+        self.methods: Dict[str, ShardMethod] = {}
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.connections: set = set()
+        self.tasks: set = set()
+
+    def register(self, name: str, method: ShardMethod) -> None:
+        """Регистрирует метод; параметры запроса передаются как именованные аргументы"""
+        self.methods[name] = method
+
+    async def start(self) -> None:
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        # Сокет мог остаться от упавшего процесса
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.server = await asyncio.start_unix_server(self._serve, path=self.path)
+        logger.info(f"[ШАРД] Обработчик {self.index}/{SHARD_COUNT} слушает {self.path}")
+
+    async def stop(self) -> None:
+        if self.server:
+            self.server.close()
+            # Открытые соединения не закрываются вместе с сервером
+            for writer in list(self.connections):
+                writer.close()
+            await self.server.wait_closed()
+            self.server = None
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    async def call_local(self, method: str, params: Dict[str, Any]) -> Any:
+        if method not in self.methods:
+            raise ShardError(f"Неизвестный метод: {method}")
+        return await self.methods[method](**params)
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.connections.add(writer)
+        try:
+            while True:
+                request = await read_frame(reader)
+                # Запросы выполняются параллельно: долгая рассылка не задерживает обновления
+                task = asyncio.create_task(self._dispatch(request, writer))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            logger.error(f"[ШАРД] Ошибка соединения с обработчиком {self.index}: {e}", exc_info=True)
+        finally:
+            self.connections.discard(writer)
+            writer.close()
+
+    async def _dispatch(self, request: Dict[str, Any], writer: asyncio.StreamWriter) -> None:
+        request_id = request.get("id")
+        try:
+            response = {"id": request_id, "result": await self.call_local(request["method"], request.get("params") or {})}
+        except Exception as e:
+            logger.error(f"[ШАРД] Ошибка метода {request.get('method')} в обработчике {self.index}: {e}", exc_info=True)
+            response = {"id": request_id, "error": str(e)}
+        if request_id is None or writer.is_closing():
+            return
+        writer.write(encode_frame(response))
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+class ShardClient:
+    def __init__(self, index: int, path: Optional[str] = None):
+        """
+        Соединение с обработчиком. Подключается при первом запросе и переподключается
+        после обрыва (перезапуска обработчика).
+        """
+        self.index = index
+        self.path = path or socket_path(index)
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.reader_task: Optional[asyncio.Task] = None
+        self.pending: Dict[int, asyncio.Future] = {}
+        self.request_ids = itertools.count(1)
+        self.connect_lock = asyncio.Lock()
+
+    async def _connection(self) -> Tuple[asyncio.StreamWriter, Dict[int, asyncio.Future]]:
+        """Текущее соединение (подключается при необходимости) и ожидающие ответа запросы этого соединения"""
+        async with self.connect_lock:
+            if self.writer is None or self.writer.is_closing():
+                try:
+                    reader, writer = await asyncio.open_unix_connection(self.path)
+                except OSError as e:
+                    raise ShardError(f"Обработчик {self.index} недоступен: {e}") from e
+                # У каждого соединения свои ожидающие запросы: обрыв старого соединения не трогает новое
+                self.reader, self.writer, self.pending = reader, writer, {}
+                self.reader_task = asyncio.create_task(self._read_responses(reader, writer, self.pending))
+            return self.writer, self.pending
+
+    async def _read_responses(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                              pending: Dict[int, asyncio.Future]) -> None:
+        try:
+            while True:
+                response = await read_frame(reader)
+                future = pending.pop(response.get("id"), None)
+                if future is None or future.done():
+                    continue
+                if "error" in response:
+                    future.set_exception(ShardError(f"Обработчик {self.index}: {response['error']}"))
+                else:
+                    future.set_result(response.get("result"))
+        except (asyncio.IncompleteReadError, ConnectionError, ShardError):
+            pass
+        finally:
+            self._disconnect(writer)
+            error = ShardError(f"Соединение с обработчиком {self.index} разорвано")
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(error)
+            pending.clear()
+
+    def _disconnect(self, writer: asyncio.StreamWriter) -> None:
+        """Закрывает соединение; состояние клиента сбрасывается, только если это текущее соединение"""
+        writer.close()
+        if self.writer is writer:
+            self.reader = self.writer = None
+
+    async def _write(self, writer: asyncio.StreamWriter, payload: Dict[str, Any]) -> None:
+        try:
+            writer.write(encode_frame(payload))
+            await writer.drain()
+        except ConnectionError as e:
+            # Ожидающие ответа запросы этого соединения завершит его задача чтения
+            self._disconnect(writer)
+            raise ShardError(f"Обработчик {self.index} недоступен: {e}") from e
+
+    async def notify(self, method: str, params: Dict[str, Any]) -> None:
+        """Передает запрос без ожидания ответа"""
+        writer, _ = await self._connection()
+        await self._write(writer, {"method": method, "params": params})
+
+    async def call(self, method: str, params: Dict[str, Any], timeout: Optional[float] = SHARD_CALL_TIMEOUT) -> Any:
+        """Выполняет метод в обработчике и возвращает результат"""
+        request_id = next(self.request_ids)
+        writer, pending = await self._connection()
+        future = asyncio.get_running_loop().create_future()
+        pending[request_id] = future
+        try:
+            await self._write(writer, {"id": request_id, "method": method, "params": params})
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError as e:
+            raise ShardError(f"Обработчик {self.index} не ответил за {timeout}с на {method}") from e
+        finally:
+            pending.pop(request_id, None)
+
+    async def close(self) -> None:
+        if self.writer is not None:
+            self._disconnect(self.writer)
+        if self.reader_task:
+            self.reader_task.cancel()
+            await asyncio.gather(self.reader_task, return_exceptions=True)
+            self.reader_task = None
+
+class ShardCluster:
+    def __init__(self, count: int = SHARD_COUNT, local: Optional[ShardServer] = None):
+        """
+        Все обработчики. Запрос к собственному обработчику (local) выполняется без сокета.
+
+        Args:
+            count: Количество обработчиков
+            local: Сервер текущего процесса, если он сам обработчик
+        """
+        self.count = count
+        self.local = local
+        self.clients = {index: ShardClient(index) for index in range(count) if local is None or index != local.index}
+        self.forward_queues: Dict[int, asyncio.Queue] = {}
+        self.forward_tasks: Dict[int, asyncio.Task] = {}
+
+    async def call(self, index: int, method: str, timeout: Optional[float] = SHARD_CALL_TIMEOUT, **params) -> Any:
+        if self.local is not None and index == self.local.index:
+            return await self.local.call_local(method, params)
+        return await self.clients[index].call(method, params, timeout)
+
+    async def call_user(self, user_id: int, method: str, timeout: Optional[float] = SHARD_CALL_TIMEOUT, **params) -> Any:
+        """Выполняет метод в обработчике, которому принадлежит пользователь"""
+        return await self.call(shard_for(user_id, self.count), method, timeout, **params)
+
+    async def call_all(self, method: str, timeout: Optional[float] = SHARD_CALL_TIMEOUT, **params) -> Dict[int, Any]:
+        """
+        Выполняет метод во всех обработчиках параллельно.
+
+        Returns:
+            Dict[int, Any]: Номер обработчика -> результат; недоступные обработчики пропускаются (с записью в лог)
+        """
+        indexes = list(range(self.count))
+        results = await asyncio.gather(
+            *(self.call(index, method, timeout, **params) for index in indexes),
+            return_exceptions=True
+        )
+        merged = {}
+        for index, result in zip(indexes, results):
+            if isinstance(result, Exception):
+                logger.error(f"[ШАРД] {method} не выполнен в обработчике {index}: {result}")
+            else:
+                merged[index] = result
+        return merged
+
+    async def forward_update(self, data: Dict[str, Any]) -> int:
+        """
+        Ставит обновление Telegram в очередь обработчика его отправителя и сразу возвращается:
+        недоступный обработчик задерживает только обновления своих пользователей.
+
+        Returns:
+            int: Номер обработчика
+
+        Raises:
+            ShardError: Очередь обработчика переполнена (обновление не принято)
+        """
+        user_id = update_user_id(data)
+        index = shard_for(user_id, self.count) if user_id is not None else 0
+        queue = self.forward_queues.get(index)
+        if queue is None:
+            queue = self.forward_queues[index] = asyncio.Queue(SHARD_FORWARD_QUEUE_SIZE)
+            self.forward_tasks[index] = asyncio.create_task(self._forward_worker(index, queue))
+        try:
+            queue.put_nowait(data)
+        except asyncio.QueueFull:
+            raise ShardError(f"Очередь обработчика {index} переполнена ({SHARD_FORWARD_QUEUE_SIZE} обновлений)")
+        return index
+
+    async def _forward_worker(self, index: int, queue: asyncio.Queue) -> None:
+        """Передает обновления из очереди одному обработчику по порядку; при его недоступности повторяет попытки, пока тот перезапускается"""
+        client = self.clients[index]
+        while True:
+            data = await queue.get()
+            try:
+                for attempt in range(SHARD_FORWARD_ATTEMPTS):
+                    try:
+                        await client.notify("update", {"update": data})
+                        break
+                    except ShardError as e:
+                        if attempt == SHARD_FORWARD_ATTEMPTS - 1:
+                            logger.error(f"[ШАРД] Обновление {data.get('update_id')} потеряно: {e}")
+                        else:
+                            if attempt == 0:
+                                logger.warning(f"[ШАРД] {e}; обновление {data.get('update_id')} ждет перезапуска обработчика "
+                                               f"(в очереди еще {queue.qsize()})")
+                            await asyncio.sleep(1)
+            finally:
+                queue.task_done()
+
+    async def close(self, timeout: float = SHUTDOWN_TIMEOUT_SECONDS) -> None:
+        """Дожидается передачи обновлений из очередей (не дольше timeout) и закрывает соединения"""
+        if self.forward_queues:
+            joins = [asyncio.create_task(queue.join()) for queue in self.forward_queues.values()]
+            _, not_done = await asyncio.wait(joins, timeout=timeout)
+            for task in not_done:
+                task.cancel()
+            lost = sum(queue.qsize() for queue in self.forward_queues.values())
+            if lost:
+                logger.error(f"[ШАРД] При остановке не переданы обработчикам {lost} обновлений")
+        for task in self.forward_tasks.values():
+            task.cancel()
+        await asyncio.gather(*self.forward_tasks.values(), return_exceptions=True)
+        await asyncio.gather(*(client.close() for client in self.clients.values()))
+
+_cluster: Optional[ShardCluster] = None
+
+def set_shard_cluster(cluster: Optional[ShardCluster]) -> None:
+    global _cluster
+    _cluster = cluster
+
+def get_shard_cluster() -> Optional[ShardCluster]:
+    """Кластер обработчиков для команд, которым нужны все пользователи (None без разделения)"""
+    return _cluster
+
+class ShardSupervisor:
+    def __init__(self, script: str, count: int = SHARD_COUNT):
+        """
+        Запускает обработчики (script с SHARD_INDEX=i) и перезапускает упавшие.
+
+        Args:
+            script: Путь к main.py
+            count: Количество обработчиков
+        """
+        self.script = script
+        self.count = count
+        self.processes: Dict[int, asyncio.subprocess.Process] = {}
+        self.watch_tasks: List[asyncio.Task] = []
+        self.restarts = 0
+        self.stopping = False
+
+    def _worker_env(self, index: int) -> Dict[str, str]:
+        env = dict(os.environ)
+        env["SHARD_INDEX"] = str(index)
+        log_root, log_ext = os.path.splitext(os.getenv('LOG_FILE', 'logs/bot.log'))
+        env["LOG_FILE"] = f"{log_root}_shard{index}{log_ext}"
+        return env
+
+    async def _watch(self, index: int) -> None:
+        while not self.stopping:
+            process = await asyncio.create_subprocess_exec(sys.executable, self.script, env=self._worker_env(index))
+            self.processes[index] = process
+            logger.info(f"[ШАРД] Запущен обработчик {index} (pid {process.pid})")
+            code = await process.wait()
+            if self.stopping:
+                return
+            self.restarts += 1
+            logger.error(f"[ШАРД] Обработчик {index} завершился с кодом {code}, перезапуск через {SHARD_RESTART_DELAY}с")
+            await asyncio.sleep(SHARD_RESTART_DELAY)
+
+    def start(self) -> None:
+        self.watch_tasks = [asyncio.create_task(self._watch(index)) for index in range(self.count)]
+
+    async def stop(self, timeout: float = SHUTDOWN_TIMEOUT_SECONDS) -> None:
+        """
+        Останавливает обработчики сигналом SIGTERM: они дописывают начатые ответы и накопленные данные.
+        По истечении timeout — SIGKILL.
+        """
+        self.stopping = True
+        running = [process for process in self.processes.values() if process.returncode is None]
+        for process in running:
+            process.terminate()
+        try:
+            await asyncio.wait_for(asyncio.gather(*(process.wait() for process in running)), timeout)
+        except asyncio.TimeoutError:
+            for process in running:
+                if process.returncode is None:
+                    logger.error(f"[ШАРД] Обработчик (pid {process.pid}) не остановился за {timeout}с, завершаем принудительно")
+                    process.kill()
+        for task in self.watch_tasks:
+            task.cancel()
+        await asyncio.gather(*self.watch_tasks, return_exceptions=True)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.count,
+            "running": sum(1 for process in self.processes.values() if process.returncode is None),
+            "restarts": self.restarts
+        }
+
+async def poll_updates(bot, cluster: ShardCluster, stop_event: asyncio.Event) -> None:
+    """Long polling во входном процессе: обновления без разбора ставятся в очереди обработчиков"""
+    offset = None
+    while not stop_event.is_set():
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=20, allowed_updates=INGRESS_ALLOWED_UPDATES, request_timeout=30)
+        except Exception as e:
+            logger.error(f"[ШАРД] Ошибка получения обновлений: {e}")
+            await asyncio.sleep(5)
+            continue
+        for update in updates:
+            try:
+                await cluster.forward_update(update.model_dump(mode="json", by_alias=True, exclude_none=True))
+            except ShardError as e:
+                logger.error(f"[ШАРД] Обновление {update.update_id} потеряно: {e}")
+            offset = update.update_id + 1
+
+async def run_ingress(bot, mode: str, script: str, stop_event: asyncio.Event) -> None:
+    """
+    Входной процесс: запускает обработчики и передает им обновления до сигнала остановки.
+
+    Args:
+        bot: Бот (только для получения обновлений и регистрации webhook)
+        mode: "polling" или "webhook"
+        script: Путь к main.py для запуска обработчиков
+        stop_event: Событие остановки
+    """
+    supervisor = ShardSupervisor(script)
+    cluster = ShardCluster()
+    supervisor.start()
+    logger.info(f"[ШАРД] Входной процесс: {SHARD_COUNT} обработчиков, прием обновлений: {mode}")
+    try:
+        if mode == "webhook":
+            from webhook_server import WebhookServer
+            webhook_server = WebhookServer(None, bot, forward=cluster.forward_update, allowed_updates=INGRESS_ALLOWED_UPDATES)
+            await webhook_server.start()
+            try:
+                await stop_event.wait()
+            finally:
+                await webhook_server.stop()
+        else:
+            # Накопленные обновления пропускаются, как и в режиме без разделения
+            await bot.delete_webhook(drop_pending_updates=True)
+            polling_task = asyncio.create_task(poll_updates(bot, cluster, stop_event))
+            await stop_event.wait()
+            polling_task.cancel()
+            await asyncio.gather(polling_task, return_exceptions=True)
+    finally:
+        await cluster.close()
+        await supervisor.stop()
+        logger.info(f"[ШАРД] Входной процесс остановлен: {supervisor.get_stats()}")
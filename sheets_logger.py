@@ -1,91 +1,98 @@
 import os
-import json
 import logging
 import asyncio
 from datetime import datetime
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 import re
+from rate_limiter import TokenBucket
+from sheets_spool import SheetsSpool
+from google_executor import google_executor
+from google_clients import get_service, execute
 
-class SheetsLogger:
-    def __init__(self):
-        # Пытаемся получить учетные данные из переменной окружения
-        google_creds_json = os.getenv('GOOGLE_CREDENTIALS_JSON')
-        
-        if google_creds_json:
-            try:
-                creds_data = json.loads(google_creds_json)
-                logging.info("Используются учетные данные Google из переменной окружения")
-            except json.JSONDecodeError as e:
-                logging.error(f"Ошибка парсинга GOOGLE_CREDENTIALS_JSON: {e}")
-                raise
-        else:
-            # Если переменная окружения не установлена, пытаемся загрузить из файла
-            try:
-                with open('gcreds.json', 'r') as f:
-                    creds_data = json.load(f)
-                logging.info("Используются учетные данные Google из файла gcreds.json")
-            except FileNotFoundError:
-                logging.error("Файл gcreds.json не найден и GOOGLE_CREDENTIALS_JSON не установлена.")
-                raise
-
-        self.credentials = service_account.Credentials.from_service_account_info(
-            creds_data,
-            scopes=['https://www.googleapis.com/auth/spreadsheets']
-        )
-
-        self.service = build('sheets', 'v4', credentials=self.credentials)
-        self.sheet = self.service.spreadsheets()
+# Пакет записывается, когда накопилось столько сообщений или прошло столько секунд с первого из них
+SHEETS_BATCH_SIZE = 50
+SHEETS_FLUSH_INTERVAL = 5.0
 
-        self.spreadsheet_id = os.getenv('GOOGLE_SHEET_ID')
-        if not self.spreadsheet_id or self.spreadsheet_id == 'your_spreadsheet_id_here':
-            logging.warning("Переменная окружения GOOGLE_SHEET_ID не установлена или содержит значение по умолчанию. Логирование в Google Sheets будет ограничено.")
-            raise ValueError("GOOGLE_SHEET_ID не установлен или неверен.")
+# Квота Sheets API — 60 запросов в минуту на пользователя: держим темп ниже нее
+SHEETS_REQUESTS_PER_SECOND = 0.8
+SHEETS_REQUESTS_BURST = 5
 
-        self.user_columns = {}
-        logging.info(f"SheetsLogger инициализирован с spreadsheet_id: {self.spreadsheet_id}")
+# Пауза перед повторной отправкой при недоступности Google (растет вдвое до максимума)
+SHEETS_RETRY_DELAY = 1.0
+SHEETS_MAX_RETRY_DELAY = 300.0
 
-    def get_user_column(self, user_name, user_id):
-        user_key = f"{user_name} (ID: {user_id})"
+# Сколько ждать отправки накопленного при остановке; неотправленное останется в спуле
+SHEETS_CLOSE_TIMEOUT = 10.0
 
-        if user_key in self.user_columns:
-            return self.user_columns[user_key]
+# Раскладка лога: "columns" — столбец на пользователя на Sheet1 (прежний формат),
+# "rows" — строка на сообщение во вкладках по месяцам (Log_2025_01, Log_2025_01_2, ...)
+SHEETS_LAYOUT = os.getenv('SHEETS_LAYOUT', 'columns')
 
-        try:
-            result = self.sheet.values().get(
-                spreadsheetId=self.spreadsheet_id,
-                range='Sheet1!1:1' # Явно указываем лист и строку
-            ).execute()
+# Сколько строк писать в одну вкладку, прежде чем начать следующую за тот же месяц
+SHEETS_ROWS_PER_TAB = int(os.getenv('SHEETS_ROWS_PER_TAB', '200000'))
 
-            headers = result.get('values', [[]])[0] if result.get('values') else []
+ROWS_HEADER = ["timestamp", "user_id", "name", "direction", "text"]
 
-            for i, header in enumerate(headers):
-                if header == user_key:
-                    self.user_columns[user_key] = i
-                    logging.info(f"Найден существующий столбец для пользователя '{user_key}' в позиции {i}")
-                    return i
+# Ячейка прежнего формата: "2025-01-31 12:00:00 👤 текст"
+_COLUMN_CELL = re.compile(r'^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}) (👤|🤖) (.*)$', re.DOTALL)
+_COLUMN_HEADER = re.compile(r'(.+) \(ID: (\d+)\)')
 
-            new_column = len(headers)
-            self.user_columns[user_key] = new_column
+# Вкладка раскладки "rows": Log_2025_01, Log_2025_01_2, ...
+_LOG_TAB = re.compile(r'^(Log_\d{4}_\d{2})(?:_(\d+))?$')
 
-            column_letter = self._get_column_letter(new_column)
-            self.sheet.values().update(
-                spreadsheetId=self.spreadsheet_id,
-                range=f'Sheet1!{column_letter}1', # Явно указываем лист, столбец и строку
-                valueInputOption='RAW',
-                body={'values': [[user_key]]}
-            ).execute()
-            logging.info(f"Создан новый столбец '{user_key}' в позиции {new_column} ({column_letter})")
+def parse_column_cell(user_key, cell):
+    """
+    Разбирает заголовок столбца и ячейку прежнего формата в запись лога.
 
-            return new_column
+    Returns:
+        dict: {"timestamp", "user_id", "user_name", "direction", "text"}
+    """
+    header = _COLUMN_HEADER.match(user_key)
+    user_name, user_id = (header.group(1), int(header.group(2))) if header else (user_key, None)
+    match = _COLUMN_CELL.match(cell)
+    if not match:
+        return {"timestamp": "", "user_id": user_id, "user_name": user_name, "direction": "", "text": cell}
+    return {
+        "timestamp": match.group(1),
+        "user_id": user_id,
+        "user_name": user_name,
+        "direction": "user" if match.group(2) == "👤" else "bot",
+        "text": match.group(3)
+    }
 
-        except HttpError as e:
-            logging.error(f"Ошибка Google Sheets API при получении/создании столбца для пользователя: {e.content}", exc_info=True)
-            return 0
-        except Exception as e:
-            logging.error(f"Непредвиденная ошибка при получении/создании столбца для пользователя: {e}", exc_info=True)
-            return 0
+class SheetsLogger:
+    def __init__(self, layout=None, spool_dir="sheets_spool", requests_per_second=SHEETS_REQUESTS_PER_SECOND):
+        # Учетные данные и клиент общие для всех модулей (google_clients)
+        self.service = get_service('sheets', 'v4')
+        self.sheet = self.service.spreadsheets()
+
+        self.spreadsheet_id = os.getenv('GOOGLE_SHEET_ID')
+        if not self.spreadsheet_id or self.spreadsheet_id == 'your_spreadsheet_id_here':
+            logging.warning("Переменная окружения GOOGLE_SHEET_ID не установлена или содержит значение по умолчанию. Логирование в Google Sheets будет ограничено.")
+            raise ValueError("GOOGLE_SHEET_ID не установлен или неверен.")
+
+        self.layout = layout or SHEETS_LAYOUT
+        if self.layout not in ("columns", "rows"):
+            raise ValueError(f"Неизвестная раскладка SHEETS_LAYOUT: {self.layout}")
+
+        self.user_columns = {}  # Заголовок столбца пользователя -> номер столбца
+        self.next_rows = {}  # Номер столбца -> первая свободная строка
+        self.header_count = 0  # Количество заполненных ячеек в строке заголовков
+        self.tabs = None  # Раскладка "rows": название вкладки -> количество строк (None — еще не загружено)
+
+        # Квота Sheets API: запросы на запись ограничены в минуту, поэтому ограничиваем их темп
+        self.rate_limiter = TokenBucket(requests_per_second, SHEETS_REQUESTS_BURST)
+        # Записи сначала попадают в локальный спул и отправляются в таблицу фоновой задачей
+        self.spool = SheetsSpool(spool_dir)
+        self._wakeup = None
+        self._worker_task = None
+        self._new_records = 0  # Записей добавлено с момента, когда спул был пуст
+        self._flush_waiters = []
+        # Сколько первых записей пакета на позиции чтения спула уже записано (или отклонено) при разборе
+        # отклоненного пакета: при повторе после временной ошибки они не отправляются второй раз
+        self._handled = 0
+        self.stats = {"records": 0, "batches": 0, "api_calls": 0, "rejected": 0, "failed_attempts": 0}
+        logging.info(f"SheetsLogger инициализирован с spreadsheet_id: {self.spreadsheet_id}, раскладка: {self.layout}")
 
     def _get_column_letter(self, column_number):
         letter = ""
@@ -94,79 +101,386 @@ class SheetsLogger:
             column_number = column_number // 26 - 1
         return letter
 
+    def start(self):
+        """Запускает фоновую отправку спула в таблицу (вызывать из работающего event loop)"""
+        if self._worker_task is None or self._worker_task.done():
+            self._wakeup = asyncio.Event()
+            self._worker_task = asyncio.create_task(self._worker())
+            logging.info(f"Пакетная запись в Google Sheets запущена: до {SHEETS_BATCH_SIZE} записей или раз в {SHEETS_FLUSH_INTERVAL}с")
+
     def log_message(self, user_name, user_id, message_text, is_user=True):
-        """Логирует сообщение в Google Sheets в столбец пользователя"""
-        max_retries = 3
-        retry_delay = 1  # секунд
-        
-        for attempt in range(max_retries):
+        """Записывает сообщение в локальный спул; в таблицу оно уйдет в фоне (без ожидания Google)"""
+        record = {
+            "timestamp": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            "user_id": user_id,
+            "user_name": user_name,
+            "direction": "user" if is_user else "bot",
+            "text": message_text
+        }
+        try:
+            self.spool.append(record)
+        except OSError as e:
+            logging.error(f"Не удалось записать сообщение пользователя {user_name} в спул Google Sheets: {e}")
+            return
+
+        self._new_records += 1
+        if self._worker_task is None:
+            self.start()
+        self._wakeup.set()
+
+    async def log_message_async(self, user_name, user_id, message_text, is_user=True):
+        """Асинхронно логирует сообщение в Google Sheets в столбец пользователя"""
+        self.log_message(user_name, user_id, message_text, is_user)
+
+    async def flush(self):
+        """Немедленно пытается отправить все записи спула"""
+        if self._worker_task is None or self._worker_task.done():
+            return
+        done = asyncio.get_running_loop().create_future()
+        self._flush_waiters.append(done)
+        self._wakeup.set()
+        await done
+
+    async def close(self):
+        """Отправляет накопленное (с ограничением по времени) и останавливает фоновую запись"""
+        try:
+            await asyncio.wait_for(self.flush(), SHEETS_CLOSE_TIMEOUT)
+        except asyncio.TimeoutError:
+            logging.warning(f"Google Sheets не ответил за {SHEETS_CLOSE_TIMEOUT}с, неотправленные записи останутся в спуле до следующего запуска")
+        if self._worker_task:
+            self._worker_task.cancel()
             try:
-                timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                sender = "👤" if is_user else "🤖"
+                await self._worker_task
+            except asyncio.CancelledError:
+                pass
+            self._worker_task = None
+        self.spool.close()
+        logging.info(f"SheetsLogger остановлен. Статистика: {self.get_stats()}")
 
-                column_num = self.get_user_column(user_name, user_id)
-                column_letter = self._get_column_letter(column_num)
+    async def append_records(self, records):
+        """
+        Записывает записи в таблицу сразу, минуя спул (перенос лога и другие разовые загрузки).
 
-                formatted_message = f"{timestamp} {sender} {message_text}"
+        Returns:
+            int: Сколько первых записей записано или отклонено как некорректные; остальные
+                 не отправлены из-за временной ошибки и могут быть переданы повторно
+        """
+        return await self._write_batch(records)
 
-                result = self.sheet.values().get(
-                    spreadsheetId=self.spreadsheet_id,
-                    range=f'Sheet1!{column_letter}:{column_letter}' # Явно указываем лист и диапазон столбца
-                ).execute()
+    async def get_log_tabs(self):
+        """Вкладки лога раскладки "rows" и число заполненных строк в них (перечитываются из таблицы)"""
+        await self._load_tabs()
+        return dict(self.tabs)
+
+    def get_stats(self):
+        """Счетчики записи: сообщения, пакеты, вызовы API на сообщение и состояние спула"""
+        stats = dict(self.stats)
+        stats["api_calls_per_record"] = round(stats["api_calls"] / stats["records"], 3) if stats["records"] else 0.0
+        stats["spool"] = self.spool.get_stats()
+        return stats
+
+    def _resolve_flush_waiters(self):
+        for waiter in self._flush_waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self._flush_waiters = []
 
-                values = result.get('values', [])
-                next_row = len(values) + 1
+    async def _worker(self):
+        """Отправляет записи спула пакетами; при недоступности Google повторяет с растущей паузой"""
+        loop = asyncio.get_running_loop()
+        retry_delay = SHEETS_RETRY_DELAY
+        while True:
+            records, position = self.spool.read_batch(SHEETS_BATCH_SIZE)
+            if not records:
+                if position != self.spool.cursor:
+                    # Пропущены поврежденные строки или пустые сегменты
+                    self.spool.commit(position, 0)
+                self._resolve_flush_waiters()
+                self._new_records = 0
+                self._wakeup.clear()
+                await self._wakeup.wait()
 
-                self.sheet.values().update(
+                # Копим пакет: до SHEETS_BATCH_SIZE записей или SHEETS_FLUSH_INTERVAL секунд
+                deadline = loop.time() + SHEETS_FLUSH_INTERVAL
+                while self._new_records < SHEETS_BATCH_SIZE and not self._flush_waiters and loop.time() < deadline:
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), deadline - loop.time())
+                    except asyncio.TimeoutError:
+                        break
+                continue
+
+            self._handled += await self._write_batch(records[self._handled:])
+            if self._handled >= len(records):
+                self._handled = 0
+                self.spool.commit(position, len(records))
+                retry_delay = SHEETS_RETRY_DELAY
+                continue
+
+            # Google недоступен: записи остаются в спуле и будут отправлены позже
+            self.stats["failed_attempts"] += 1
+            self._resolve_flush_waiters()
+            logging.warning(f"Google Sheets недоступен, в спуле {self.spool.pending_bytes()} байт. Повтор через {retry_delay:.0f} сек...")
+            await asyncio.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, SHEETS_MAX_RETRY_DELAY)
+
+    async def _write_batch(self, records):
+        """
+        Записывает пакет: в раскладке "columns" одним values.batchUpdate,
+        в раскладке "rows" одним values.append на вкладку.
+
+        Если Google отклоняет пакет (HTTP 400, например ячейка больше лимита Sheets), пакет делится
+        пополам, пока не останется некорректная запись: отбрасывается только она.
+
+        Returns:
+            int: Сколько первых записей пакета записано или отклонено как некорректные (повторять бессмысленно);
+                 остальные не отправлены из-за временной ошибки
+        """
+        new_keys = []
+        batch = [self._column_entry(record) for record in records]
+        try:
+            if self.layout == "rows":
+                await self._append_rows(records)
+            else:
+                data = await self._build_batch_data(batch, new_keys)
+                await self._execute(self.sheet.values().batchUpdate(
                     spreadsheetId=self.spreadsheet_id,
-                    range=f'Sheet1!{column_letter}{next_row}', # Явно указываем лист, столбец и строку
-                    valueInputOption='RAW',
-                    body={'values': [[formatted_message]]}
-                ).execute()
-
-                logging.info(f"Записано сообщение в столбец {column_letter} строку {next_row} для пользователя {user_name}")
-                return  # Успешно записали, выходим
-
-            except (AttributeError, ConnectionError, OSError) as e:
-                # Ошибки соединения, включая 'NoneType' object has no attribute 'read'
-                if attempt < max_retries - 1:
-                    logging.warning(f"Ошибка соединения при записи в Google Sheets (попытка {attempt + 1}/{max_retries}): {e}. Повторяем через {retry_delay} сек...")
-                    import time
-                    time.sleep(retry_delay)
-                    retry_delay *= 2  # Увеличиваем задержку
-                    continue
-                else:
-                    logging.error(f"Не удалось записать в Google Sheets после {max_retries} попыток: {e}")
-                    
-            except HttpError as e:
-                logging.error(f"Ошибка Google Sheets API при логировании сообщения: {e.content}", exc_info=True)
-                break  # Не повторяем для API ошибок
-                
-            except Exception as e:
-                if attempt < max_retries - 1:
-                    logging.warning(f"Непредвиденная ошибка при записи в Google Sheets (попытка {attempt + 1}/{max_retries}): {e}. Повторяем...")
-                    import time
-                    time.sleep(retry_delay)
-                    retry_delay *= 2
-                    continue
-                else:
-                    logging.error(f"Непредвиденная ошибка при логировании в Google Sheets: {e}", exc_info=True)
+                    body={'valueInputOption': 'RAW', 'data': data}
+                ))
+            self.stats["records"] += len(records)
+            self.stats["batches"] += 1
+            logging.info(
+                f"Записано {len(records)} сообщений в Google Sheets (раскладка {self.layout}, "
+                f"новых столбцов: {len(new_keys)}, вызовов API на сообщение: {self.get_stats()['api_calls_per_record']})"
+            )
+            return len(records)
+        except Exception as e:
+            # Состояние таблицы после ошибки неизвестно: перечитываем счетчики строк, заголовки и вкладки
+            if self.layout == "rows":
+                self.tabs = None
+            else:
+                self._forget_columns(batch, new_keys)
+            if isinstance(e, HttpError) and e.resp.status == 400:
+                return await self._isolate_rejected(records, e)
+            logging.warning(f"Ошибка при пакетной записи в Google Sheets: {e}")
+            return 0
 
-    async def log_message_async(self, user_name, user_id, message_text, is_user=True):
-        """Асинхронно логирует сообщение в Google Sheets в столбец пользователя"""
-        def _log_sync():
-            return self.log_message(user_name, user_id, message_text, is_user)
-        
-        # Запускаем синхронную операцию в отдельном потоке
-        loop = asyncio.get_event_loop()
-        await loop.run_in_executor(None, _log_sync)
+    async def _isolate_rejected(self, records, error):
+        """Делит отклоненный пакет пополам и записывает половины по очереди"""
+        if len(records) == 1:
+            # Текст сообщения в лог не пишется: только кто и когда
+            timestamp, user_id = self._row_entry(records[0])[:2]
+            logging.error(
+                f"Google Sheets отклонил сообщение пользователя {user_id} от {timestamp}, "
+                f"оно не будет записано: {error.reason}"
+            )
+            self.stats["rejected"] += 1
+            return 1
+        logging.warning(f"Google Sheets отклонил пакет из {len(records)} сообщений ({error.reason}), ищем некорректное")
+        middle = len(records) // 2
+        written = await self._write_batch(records[:middle])
+        if written < middle:
+            return written
+        return written + await self._write_batch(records[middle:])
+
+    def _column_entry(self, record):
+        """Заголовок столбца пользователя и текст ячейки в прежнем формате"""
+        if "user_key" in record:
+            # Запись из спула, сделанная до появления раскладки "rows"
+            return record["user_key"], record["text"]
+        sender = "👤" if record["direction"] == "user" else "🤖"
+        return f"{record['user_name']} (ID: {record['user_id']})", f"{record['timestamp']} {sender} {record['text']}"
+
+    def _row_entry(self, record):
+        """Строка раскладки "rows": timestamp, user_id, name, direction, text"""
+        if "user_key" in record:
+            record = parse_column_cell(record["user_key"], record["text"])
+        return [record["timestamp"], record["user_id"], record["user_name"], record["direction"], record["text"]]
+
+    async def _append_rows(self, records):
+        """Дописывает строки во вкладки текущего месяца; новые вкладки создаются одним batchUpdate"""
+        if self.tabs is None:
+            await self._load_tabs()
+
+        rows_by_tab = {}
+        new_tabs = []
+        for record in records:
+            row = self._row_entry(record)
+            tab = self._tab_for(row[0], new_tabs)
+            if self.tabs[tab] == 0:
+                # Пустая вкладка, созданная вручную: сначала заголовок
+                rows_by_tab.setdefault(tab, []).append(ROWS_HEADER)
+                self.tabs[tab] = 1
+            rows_by_tab.setdefault(tab, []).append(row)
+            self.tabs[tab] += 1
+
+        if new_tabs:
+            await self._execute(self.sheet.batchUpdate(
+                spreadsheetId=self.spreadsheet_id,
+                body={'requests': [
+                    {'addSheet': {'properties': {'title': tab, 'gridProperties': {'rowCount': 1, 'columnCount': len(ROWS_HEADER)}}}}
+                    for tab in new_tabs
+                ]}
+            ))
+            logging.info(f"Созданы вкладки лога: {', '.join(new_tabs)}")
+
+        for tab, rows in rows_by_tab.items():
+            if tab in new_tabs:
+                rows = [ROWS_HEADER] + rows
+            await self._execute(self.sheet.values().append(
+                spreadsheetId=self.spreadsheet_id,
+                range=f"'{tab}'!A1",
+                valueInputOption='RAW',
+                insertDataOption='INSERT_ROWS',
+                body={'values': rows}
+            ))
+
+    def _tab_for(self, timestamp, new_tabs):
+        """Вкладка для сообщения: по месяцу, со следующим номером, если текущая заполнена"""
+        month = timestamp[:7].replace("-", "_") if timestamp else datetime.now().strftime('%Y_%m')
+        base = f"Log_{month}"
+        index = 1
+        while f"{base}_{index + 1}" in self.tabs:
+            index += 1
+        tab = base if index == 1 else f"{base}_{index}"
+        if tab in self.tabs and self.tabs[tab] >= SHEETS_ROWS_PER_TAB:
+            tab = f"{base}_{index + 1}"
+        if tab not in self.tabs:
+            self.tabs[tab] = 1  # Строка заголовка
+            new_tabs.append(tab)
+        return tab
+
+    async def _load_tabs(self):
+        """
+        Загружает список вкладок лога и число заполненных строк.
+
+        gridProperties.rowCount — размер сетки, а не число строк с данными (у вкладки, созданной
+        вручную, это 1000 пустых строк), поэтому строки считаются по столбцу A. Читается только
+        последняя вкладка каждого месяца: в предыдущие больше не пишем, они уже заполнены.
+        """
+        result = await self._execute(self.sheet.get(
+            spreadsheetId=self.spreadsheet_id,
+            fields='sheets.properties.title'
+        ))
+        titles = [
+            sheet['properties']['title'] for sheet in result.get('sheets', [])
+            if sheet['properties']['title'].startswith('Log_')
+        ]
+
+        last_tabs = {}  # Вкладка месяца -> (номер, название последней вкладки)
+        for title in titles:
+            match = _LOG_TAB.match(title)
+            base, index = (match.group(1), int(match.group(2) or 1)) if match else (title, 1)
+            if base not in last_tabs or index > last_tabs[base][0]:
+                last_tabs[base] = (index, title)
+
+        tabs = {title: SHEETS_ROWS_PER_TAB for title in titles}
+        current = [title for _, title in last_tabs.values()]
+        if current:
+            ranges = await self._execute(self.sheet.values().batchGet(
+                spreadsheetId=self.spreadsheet_id,
+                ranges=[f"'{title}'!A:A" for title in current],
+                majorDimension='COLUMNS'
+            ))
+            for title, value_range in zip(current, ranges.get('valueRanges', [])):
+                values = value_range.get('values')
+                tabs[title] = len(values[0]) if values else 0
+        self.tabs = tabs
+
+    async def _build_batch_data(self, batch, new_keys):
+        """Готовит диапазоны для batchUpdate: заголовки новых столбцов и сообщения подряд по столбцам"""
+        await self._ensure_columns({user_key for user_key, _ in batch}, new_keys)
+
+        columns = {self.user_columns[user_key] for user_key, _ in batch}
+        await self._ensure_next_rows(columns)
+
+        data = [
+            {'range': f'Sheet1!{self._get_column_letter(self.user_columns[user_key])}1', 'values': [[user_key]]}
+            for user_key in new_keys
+        ]
+
+        # Сообщения одного столбца идут подряд, поэтому записываются одним диапазоном
+        rows_by_column = {}
+        for user_key, formatted_message in batch:
+            rows_by_column.setdefault(self.user_columns[user_key], []).append([formatted_message])
+        for column, rows in rows_by_column.items():
+            column_letter = self._get_column_letter(column)
+            first_row = self.next_rows[column]
+            data.append({
+                'range': f'Sheet1!{column_letter}{first_row}:{column_letter}{first_row + len(rows) - 1}',
+                'values': rows
+            })
+            self.next_rows[column] = first_row + len(rows)
+        return data
+
+    async def _ensure_columns(self, user_keys, new_keys):
+        """Находит столбцы пользователей; для новых пользователей назначает столбцы в конце строки заголовков"""
+        unknown = [user_key for user_key in sorted(user_keys) if user_key not in self.user_columns]
+        if not unknown:
+            return
+
+        result = await self._execute(self.sheet.values().get(
+            spreadsheetId=self.spreadsheet_id,
+            range='Sheet1!1:1' # Явно указываем лист и строку
+        ))
+        headers = result.get('values', [[]])[0] if result.get('values') else []
+        for i, header in enumerate(headers):
+            if header:
+                self.user_columns.setdefault(header, i)
+        self.header_count = max(self.header_count, len(headers))
+
+        for user_key in unknown:
+            if user_key in self.user_columns:
+                logging.info(f"Найден существующий столбец для пользователя '{user_key}' в позиции {self.user_columns[user_key]}")
+                continue
+            column = self.header_count
+            self.header_count += 1
+            self.user_columns[user_key] = column
+            self.next_rows[column] = 2
+            new_keys.append(user_key)
+            logging.info(f"Создается новый столбец '{user_key}' в позиции {column} ({self._get_column_letter(column)})")
+
+    async def _ensure_next_rows(self, columns):
+        """Узнает первую свободную строку для столбцов, которых еще нет в кэше, одним batchGet"""
+        unknown = sorted(column for column in columns if column not in self.next_rows)
+        if not unknown:
+            return
+
+        ranges = [f'Sheet1!{self._get_column_letter(column)}:{self._get_column_letter(column)}' for column in unknown]
+        result = await self._execute(self.sheet.values().batchGet(
+            spreadsheetId=self.spreadsheet_id,
+            ranges=ranges
+        ))
+        for column, value_range in zip(unknown, result.get('valueRanges', [])):
+            self.next_rows[column] = len(value_range.get('values', [])) + 1
+
+    def _forget_columns(self, batch, new_keys):
+        """Сбрасывает кэш столбцов и строк, затронутых неудачной записью"""
+        # Новые столбцы назначаются подряд в конце строки заголовков: возвращаем их номера
+        for user_key in new_keys:
+            column = self.user_columns.pop(user_key)
+            self.next_rows.pop(column, None)
+            self.header_count = min(self.header_count, column)
+        for user_key, _ in batch:
+            column = self.user_columns.get(user_key)
+            if column is not None:
+                self.next_rows.pop(column, None)
+
+    async def _execute(self, request):
+        """Выполняет запрос к API в пуле Google (не на event loop), соблюдая квоту Sheets"""
+        await self.rate_limiter.acquire()
+        self.stats["api_calls"] += 1
+        return await google_executor.run(execute, request)
 
     def create_headers_if_needed(self):
+        if self.layout == "rows":
+            # Вкладки по месяцам создаются при первой записи
+            return
         try:
-            result = self.sheet.values().get(
+            result = execute(self.sheet.values().get(
                 spreadsheetId=self.spreadsheet_id,
                 range='Sheet1!1:1' # Явно указываем лист и строку
-            ).execute()
+            ))
 
             values = result.get('values', [])
 
@@ -174,6 +488,7 @@ class SheetsLogger:
                 logging.info("Электронная таблица пуста. Столбцы будут созданы по мере того, как пользователи начнут общаться.")
             else:
                 logging.info("Заголовки таблицы уже существуют.")
+                self.header_count = len(values[0])
                 for i, header in enumerate(values[0]):
                     match = re.match(r'(.+) \(ID: (\d+)\)', header)
                     if match:
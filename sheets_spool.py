@@ -0,0 +1,194 @@
+import os
+import json
+import logging
+from typing import List, Dict, Tuple, Any
+
+logger = logging.getLogger(__name__)
+
+# Размер одного сегмента и общий предел спула на диске
+SPOOL_SEGMENT_MAX_BYTES = 1024 * 1024
+SPOOL_MAX_TOTAL_BYTES = 50 * 1024 * 1024
+
+class SheetsSpool:
+    def __init__(self, directory: str = "sheets_spool", segment_max_bytes: int = SPOOL_SEGMENT_MAX_BYTES,
+                 max_total_bytes: int = SPOOL_MAX_TOTAL_BYTES):
+        """
+        Локальный журнал записей для Google Sheets (сегменты JSONL + сохраненная позиция чтения).
+
+        Каждая запись сначала дописывается на диск, а уже потом отправляется в таблицу,
+        поэтому сбой Google или перезапуск бота не приводят к потере строк лога.
+
+        Args:
+            directory: Директория со спулом
+            segment_max_bytes: Размер сегмента, после которого начинается новый
+            max_total_bytes: Предел размера спула; при превышении удаляются самые старые сегменты
+        """
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self.max_total_bytes = max_total_bytes
+        self.cursor_path = os.path.join(directory, "cursor.json")
+        os.makedirs(directory, exist_ok=True)
+
+        self.stats = {"appended": 0, "shipped": 0, "dropped_records": 0, "dropped_segments": 0, "corrupt_lines": 0}
+        self.segment_sizes: Dict[int, int] = {
+            self._segment_number(name): os.path.getsize(os.path.join(directory, name))
+            for name in os.listdir(directory) if name.startswith("segment_") and name.endswith(".jsonl")
+        }
+
+        # После перезапуска всегда пишем в новый сегмент: недописанная строка старого сегмента
+        # (если процесс упал во время записи) тогда просто пропускается при чтении
+        self.current_segment = max(self.segment_sizes, default=0) + 1
+        self.segment_sizes[self.current_segment] = 0
+        self._file = None
+        self.cursor = self._load_cursor()
+
+        pending = self.pending_bytes()
+        if pending:
+            logger.info(f"Спул Google Sheets: найдено {pending} байт неотправленных записей, отправка будет продолжена")
+
+    def _segment_number(self, name: str) -> int:
+        return int(name[len("segment_"):-len(".jsonl")])
+
+    def _segment_path(self, number: int) -> str:
+        return os.path.join(self.directory, f"segment_{number:06d}.jsonl")
+
+    def _load_cursor(self) -> Tuple[int, int]:
+        """Загружает позицию чтения (номер сегмента, смещение в байтах)"""
+        first_segment = min(self.segment_sizes)
+        try:
+            with open(self.cursor_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            segment, offset = int(data["segment"]), int(data["offset"])
+        except FileNotFoundError:
+            return first_segment, 0
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке позиции спула из {self.cursor_path}: {e}. Читаем с начала")
+            return first_segment, 0
+        if segment not in self.segment_sizes:
+            # Сегмент уже удален (например, по пределу размера): продолжаем со следующего
+            return min(n for n in self.segment_sizes if n > segment or n == self.current_segment), 0
+        return segment, offset
+
+    def _save_cursor(self) -> None:
+        """Атомарно сохраняет позицию чтения"""
+        tmp_path = self.cursor_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"segment": self.cursor[0], "offset": self.cursor[1]}, f)
+        os.replace(tmp_path, self.cursor_path)
+
+    def append(self, record: Dict[str, Any]) -> None:
+        """Дописывает запись в текущий сегмент"""
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+
+        if self.segment_sizes[self.current_segment] + len(line) > self.segment_max_bytes and self.segment_sizes[self.current_segment]:
+            self._rotate()
+
+        if self._file is None:
+            self._file = open(self._segment_path(self.current_segment), 'ab')
+        self._file.write(line)
+        self._file.flush()
+        self.segment_sizes[self.current_segment] += len(line)
+        self.stats["appended"] += 1
+
+        self._enforce_limit()
+
+    def _rotate(self) -> None:
+        """Закрывает текущий сегмент и начинает новый"""
+        if self._file:
+            self._file.close()
+            self._file = None
+        self.current_segment += 1
+        self.segment_sizes[self.current_segment] = 0
+
+    def _enforce_limit(self) -> None:
+        """Удаляет самые старые сегменты, пока спул не уложится в предел размера"""
+        while self.pending_bytes() > self.max_total_bytes:
+            oldest = min(self.segment_sizes)
+            if oldest == self.current_segment:
+                break
+            dropped = self._count_lines(oldest, self.cursor[1] if self.cursor[0] == oldest else 0)
+            self._remove_segment(oldest)
+            if self.cursor[0] <= oldest:
+                self.cursor = (min(self.segment_sizes), 0)
+                self._save_cursor()
+            self.stats["dropped_records"] += dropped
+            self.stats["dropped_segments"] += 1
+            logger.error(f"Спул Google Sheets превысил {self.max_total_bytes} байт: удален сегмент {oldest}, потеряно записей: {dropped}")
+
+    def _count_lines(self, segment: int, offset: int) -> int:
+        try:
+            with open(self._segment_path(segment), 'rb') as f:
+                f.seek(offset)
+                return sum(1 for _ in f)
+        except OSError:
+            return 0
+
+    def _remove_segment(self, segment: int) -> None:
+        self.segment_sizes.pop(segment, None)
+        try:
+            os.remove(self._segment_path(segment))
+        except FileNotFoundError:
+            pass
+
+    def read_batch(self, max_records: int) -> Tuple[List[Dict[str, Any]], Tuple[int, int]]:
+        """
+        Читает до max_records записей с позиции чтения, не сдвигая ее.
+
+        Returns:
+            Tuple: (записи, позиция после них) — позицию нужно передать в commit после успешной отправки
+        """
+        records = []
+        segment, offset = self.cursor
+        while len(records) < max_records and segment in self.segment_sizes:
+            if offset < self.segment_sizes[segment]:
+                with open(self._segment_path(segment), 'rb') as f:
+                    f.seek(offset)
+                    for line in f:
+                        if not line.endswith(b"\n"):
+                            if segment == self.current_segment:
+                                break
+                            # Недописанная строка закрытого сегмента (сбой при записи): пропускаем
+                            self.stats["corrupt_lines"] += 1
+                            offset += len(line)
+                            break
+                        offset += len(line)
+                        try:
+                            records.append(json.loads(line))
+                        except ValueError:
+                            self.stats["corrupt_lines"] += 1
+                            logger.error(f"Поврежденная строка в сегменте спула {segment} пропущена")
+                            continue
+                        if len(records) >= max_records:
+                            break
+            if len(records) >= max_records or segment == self.current_segment:
+                break
+            # Сегмент прочитан целиком: переходим к следующему
+            segment = min((n for n in self.segment_sizes if n > segment), default=self.current_segment)
+            offset = 0
+        return records, (segment, offset)
+
+    def commit(self, position: Tuple[int, int], shipped: int) -> None:
+        """Сдвигает позицию чтения после успешной отправки и удаляет прочитанные сегменты"""
+        self.cursor = position
+        self._save_cursor()
+        self.stats["shipped"] += shipped
+        for segment in [n for n in self.segment_sizes if n < position[0]]:
+            self._remove_segment(segment)
+
+    def pending_bytes(self) -> int:
+        """Размер неотправленной части спула в байтах"""
+        segment, offset = self.cursor
+        return sum(size for n, size in self.segment_sizes.items() if n >= segment) - offset
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Метрики спула: счетчики записей, потери и размер неотправленных данных"""
+        stats = dict(self.stats)
+        stats["pending_bytes"] = self.pending_bytes()
+        stats["segments"] = len(self.segment_sizes)
+        return stats
+
+    def close(self) -> None:
+        """Закрывает файл текущего сегмента"""
+        if self._file:
+            self._file.close()
+            self._file = None
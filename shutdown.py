@@ -0,0 +1,148 @@
+import os
+import time
+import signal
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Coroutine, Dict, List, Set, Tuple
+
+from user_inbox import user_inbox
+
+logger = logging.getLogger(__name__)
+
+# Сколько ждать завершения начатых ответов пользователям после сигнала остановки (секунд)
+SHUTDOWN_DRAIN_SECONDS = float(os.getenv('SHUTDOWN_DRAIN_SECONDS', '30'))
+
+# Сколько ждать записи накопленного (диалоги, Google Sheets) после ответов (секунд)
+SHUTDOWN_FLUSH_SECONDS = float(os.getenv('SHUTDOWN_FLUSH_SECONDS', '15'))
+
+# Полное время остановки процесса: по нему входной процесс (sharding) ждет обработчики
+SHUTDOWN_TIMEOUT_SECONDS = SHUTDOWN_DRAIN_SECONDS + SHUTDOWN_FLUSH_SECONDS + 10
+
+ShutdownStep = Callable[[], Awaitable[Any]]
+
+class ShutdownCoordinator:
+    def __init__(self, drain_timeout: float = SHUTDOWN_DRAIN_SECONDS, flush_timeout: float = SHUTDOWN_FLUSH_SECONDS):
+        """
+        Порядок остановки бота:
+        1. прекратить прием обновлений (polling, webhook, сокет обработчика);
+        2. дождаться начатых ответов и фоновых задач, но не дольше drain_timeout;
+        3. записать накопленное (диалоги, спул Google Sheets) с ограничением flush_timeout;
+        4. записать в лог, что не удалось завершить.
+
+        Args:
+            drain_timeout: Предел ожидания ответов пользователям
+            flush_timeout: Предел ожидания каждой записи накопленного
+        """
+        self.drain_timeout = drain_timeout
+        self.flush_timeout = flush_timeout
+        self.intake: List[Tuple[str, ShutdownStep]] = []
+        self.flushers: List[Tuple[str, ShutdownStep]] = []
+        self.background: Set[asyncio.Task] = set()
+        self.stopping = False
+
+    def add_intake(self, name: str, stop: ShutdownStep) -> None:
+        """Регистрирует источник обновлений, который останавливается первым"""
+        self.intake.append((name, stop))
+
+    def add_flusher(self, name: str, flush: ShutdownStep) -> None:
+        """Регистрирует запись накопленного; результат flush (если есть) попадает в отчет"""
+        self.flushers.append((name, flush))
+
+    def track(self, coro: Coroutine) -> asyncio.Task:
+        """
+        Запускает фоновую задачу, которую остановка дождется (вместо asyncio.create_task
+        для записей, которые нельзя потерять).
+        """
+        task = asyncio.create_task(coro)
+        self.background.add(task)
+        task.add_done_callback(self.background.discard)
+        return task
+
+    async def _stop_intake(self) -> None:
+        for name, stop in self.intake:
+            try:
+                await stop()
+            except Exception as e:
+                logger.error(f"[ОСТАНОВКА] Ошибка при остановке приема обновлений ({name}): {e}", exc_info=True)
+
+    async def _drain_background(self, timeout: float) -> int:
+        """Ждет фоновые задачи; возвращает количество отмененных по таймауту"""
+        tasks = list(self.background)
+        if not tasks:
+            return 0
+        _, pending = await asyncio.wait(tasks, timeout=max(0.0, timeout))
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        return len(pending)
+
+    async def _flush(self) -> Dict[str, str]:
+        async def run(name: str, flush: ShutdownStep) -> str:
+            try:
+                result = await asyncio.wait_for(flush(), self.flush_timeout)
+                return "ok" if result is None else str(result)
+            except asyncio.TimeoutError:
+                return f"не завершено за {self.flush_timeout:.0f}с"
+            except Exception as e:
+                logger.error(f"[ОСТАНОВКА] Ошибка при записи накопленного ({name}): {e}", exc_info=True)
+                return f"ошибка: {e}"
+
+        results = await asyncio.gather(*(run(name, flush) for name, flush in self.flushers))
+        return {name: result for (name, _), result in zip(self.flushers, results)}
+
+    async def shutdown(self) -> Dict[str, Any]:
+        """
+        Выполняет остановку и возвращает отчет.
+        Повторный вызов ничего не делает.
+        """
+        if self.stopping:
+            return {}
+        self.stopping = True
+        started = time.perf_counter()
+        logger.info(f"[ОСТАНОВКА] Прием обновлений прекращается, ждем ответы до {self.drain_timeout:.0f}с")
+
+        await self._stop_intake()
+        intake_seconds = time.perf_counter() - started
+
+        inbox_report = await user_inbox.drain(self.drain_timeout)
+        background_cancelled = await self._drain_background(self.drain_timeout - (time.perf_counter() - started))
+        drain_seconds = time.perf_counter() - started - intake_seconds
+
+        flushed = await self._flush()
+
+        report = {
+            "seconds": round(time.perf_counter() - started, 2),
+            "intake_seconds": round(intake_seconds, 2),
+            "drain_seconds": round(drain_seconds, 2),
+            "turns_completed": inbox_report["completed"],
+            "turns_interrupted": inbox_report["interrupted"],
+            "messages_dropped": inbox_report["dropped"],
+            "background_cancelled": background_cancelled,
+            "flushed": flushed
+        }
+        lost = report["turns_interrupted"] or report["messages_dropped"] or report["background_cancelled"]
+        log = logger.warning if lost else logger.info
+        log(
+            f"[ОСТАНОВКА] Завершено за {report['seconds']:.1f}с: ответов дописано {report['turns_completed']}, "
+            f"прервано {report['turns_interrupted']}, сообщений без ответа {report['messages_dropped']}, "
+            f"фоновых задач отменено {report['background_cancelled']}; запись: "
+            + ", ".join(f"{name} — {result}" for name, result in flushed.items())
+        )
+        return report
+
+def install_signal_handlers(shutdown_event: asyncio.Event) -> None:
+    """SIGINT/SIGTERM запускают остановку; обработчики работают в event loop, а не между байткодами"""
+    loop = asyncio.get_running_loop()
+
+    def on_signal(sig: signal.Signals) -> None:
+        if shutdown_event.is_set():
+            logger.info(f"🛑 Получен сигнал {sig.name}: остановка уже выполняется")
+            return
+        logger.info(f"🛑 Получен сигнал {sig.name}. Инициация graceful shutdown...")
+        shutdown_event.set()
+
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, on_signal, sig)
+
+# Общий координатор остановки процесса
+shutdown_coordinator = ShutdownCoordinator()
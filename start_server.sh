@@ -23,7 +23,7 @@ if [ -f "$BOT_DIR/requirements.txt" ]; then
     echo "✅ Зависимости установлены из requirements.txt"
 else
     echo "⚠️ Файл requirements.txt не найден, устанавливаем основные пакеты..."
-    pip install aiogram google-api-python-client google-auth google-auth-httplib2 google-auth-oauthlib python-dotenv requests Flask --upgrade
+    pip install aiogram google-api-python-client google-auth google-auth-httplib2 google-auth-oauthlib python-dotenv requests --upgrade
 fi
 
 echo "🔧 Настраиваем переменные окружения..."
@@ -0,0 +1,122 @@
+import time
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Повторные попытки соединения с Telegram API при запуске
+TELEGRAM_CONNECT_ATTEMPTS = 3
+TELEGRAM_CONNECT_RETRY_DELAY = 5
+
+class StartupReport:
+    def __init__(self):
+        """
+        Замеры фаз запуска бота.
+
+        Независимые фазы выполняются параллельно, поэтому для каждой фазы записывается
+        и момент начала относительно старта, и длительность.
+        """
+        self.started = time.perf_counter()
+        self.phases: List[Tuple[str, float, float, str]] = []  # (фаза, начало, длительность, результат)
+
+    async def run(self, name: str, func: Callable[..., Awaitable[Any]], *args, required: bool = True) -> Any:
+        """
+        Выполняет фазу запуска и записывает ее длительность.
+
+        Args:
+            name: Название фазы для отчета
+            func: Асинхронная функция фазы
+            required: Без этой фазы бот не может работать (ошибка прерывает запуск);
+                иначе ошибка записывается в лог, а фаза возвращает None
+
+        Returns:
+            Any: Результат фазы
+        """
+        phase_started = time.perf_counter()
+        try:
+            result = await func(*args)
+        except Exception as e:
+            self._record(name, phase_started, f"ошибка: {e}")
+            if required:
+                raise
+            logger.error(f"Фаза запуска '{name}' завершилась ошибкой: {e}", exc_info=True)
+            return None
+        self._record(name, phase_started, "ok")
+        return result
+
+    def background(self, name: str, func: Callable[..., Awaitable[Any]], *args) -> asyncio.Task:
+        """Запускает необязательную фазу в фоне: бот начинает работу, не дожидаясь ее"""
+        return asyncio.create_task(self.run(name, func, *args, required=False))
+
+    def _record(self, name: str, phase_started: float, status: str) -> None:
+        self.phases.append((name, phase_started - self.started, time.perf_counter() - phase_started, status))
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def log(self, title: str) -> None:
+        """Пишет в лог отчет о фазах запуска"""
+        lines = [
+            f"  {name:<22} +{offset * 1000:6.0f} мс  {duration * 1000:6.0f} мс  {status}"
+            for name, offset, duration, status in sorted(self.phases, key=lambda phase: phase[1])
+        ]
+        logger.info(f"⏱️ {title} за {self.elapsed() * 1000:.0f} мс:\n" + "\n".join(lines))
+
+async def connect_telegram(bot):
+    """Проверяет соединение с Telegram API с повторными попытками"""
+    for attempt in range(TELEGRAM_CONNECT_ATTEMPTS):
+        try:
+            bot_info = await bot.get_me()
+            logger.info(f"✅ Соединение с Telegram API установлено. Бот: @{bot_info.username}")
+            return bot_info
+        except Exception as e:
+            logger.error(f"❌ Ошибка соединения с Telegram API (попытка {attempt + 1}/{TELEGRAM_CONNECT_ATTEMPTS}): {e}")
+            if attempt == TELEGRAM_CONNECT_ATTEMPTS - 1:
+                raise
+            await asyncio.sleep(TELEGRAM_CONNECT_RETRY_DELAY)
+
+def _create_docs_loader():
+    # Клиенты Google импортируются здесь, в потоке пула Google, параллельно с соединением с Telegram
+    from docs_loader import DocsLoader
+    return DocsLoader()
+
+def _create_sheets_logger():
+    from sheets_logger import SheetsLogger, SHEETS_LAYOUT, SHEETS_REQUESTS_PER_SECOND
+    from sharding import is_shard_worker, shard_path, SHARD_COUNT
+    if not is_shard_worker():
+        return SheetsLogger()
+    # Обработчики пишут в одну таблицу параллельно: столбцы пользователей назначались бы
+    # в нескольких процессах сразу, поэтому используется раскладка "rows" (values.append),
+    # а квота Sheets API делится между процессами
+    if SHEETS_LAYOUT != "rows":
+        logger.warning(f"При SHARD_COUNT={SHARD_COUNT} лог в Google Sheets пишется в раскладке rows вместо {SHEETS_LAYOUT}")
+    return SheetsLogger(layout="rows", spool_dir=shard_path("sheets_spool"),
+                        requests_per_second=SHEETS_REQUESTS_PER_SECOND / SHARD_COUNT)
+
+async def init_prompts_phase():
+    """Создает DocsLoader и загружает промпт (из локального кэша или из Google Docs)"""
+    from google_executor import google_executor
+    from m_prompts import init_prompts
+    try:
+        docs_loader_instance = await google_executor.run(_create_docs_loader)
+    except Exception as e:
+        logger.error(f"Не удалось инициализировать DocsLoader: {e}. Промпт будет загружен из локального кэша.", exc_info=True)
+        docs_loader_instance = None
+    await init_prompts(docs_loader_instance)
+    return docs_loader_instance
+
+async def init_sheets_phase():
+    """Создает SheetsLogger (без сетевых запросов: сообщения сразу пишутся в локальный спул)"""
+    from google_executor import google_executor
+    try:
+        return await google_executor.run(_create_sheets_logger)
+    except Exception as e:
+        logger.error(f"Не удалось инициализировать SheetsLogger: {e}. Логирование в Google Sheets будет недоступно.", exc_info=True)
+        return None
+
+async def start_sheets_phase(sheets_logger_instance):
+    """Читает заголовки таблицы и запускает отправку спула (в фоне, после запуска polling)"""
+    from google_executor import google_executor
+    await google_executor.run(sheets_logger_instance.create_headers_if_needed)
+    sheets_logger_instance.start()
@@ -5,9 +5,13 @@ import logging
 import asyncio
 import os
 from datetime import datetime
+from sharding import SHARD_COUNT
 
 logger = logging.getLogger(__name__)
 
+# Ожидаемое число процессов main.py: входной процесс и обработчики при разделении (sharding)
+EXPECTED_BOT_PROCESSES = SHARD_COUNT + 1 if SHARD_COUNT > 1 else 1
+
 class SystemMonitor:
     def __init__(self, check_interval=300):  # 5 минут
         self.check_interval = check_interval
@@ -51,7 +55,7 @@ class SystemMonitor:
             if cpu_percent > 80:
                 logger.warning(f"⚠️ Высокое использование CPU: {cpu_percent:.1f}%")
                 
-            if len(bot_processes) > 3:
+            if len(bot_processes) > EXPECTED_BOT_PROCESSES + 2:
                 logger.warning(f"⚠️ Слишком много процессов бота: {len(bot_processes)}")
                 
         except Exception as e:
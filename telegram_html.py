@@ -0,0 +1,306 @@
+import re
+import logging
+from bisect import bisect_right
+from html import escape
+from typing import Callable, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Все конструкции markdown, которые мы понимаем, разбираются одним регулярным выражением за один проход
+# (опережающая проверка первого символа позволяет быстро пропускать обычный текст)
+_MARKDOWN_TOKEN = re.compile(r"""(?=[`\[*_~])(?:
+    (?P<fence>```(?s:.*?)```)                                   # блок кода (в Telegram отображается плохо, удаляем)
+  | (?P<code>`[^`\n]+`)                                         # моноширинный код
+  | \[(?P<link_text>[^\]\n]+)\]\((?P<link_url>[^)\s]+)\)        # ссылка [текст](url)
+  | (?P<marker>\*\*|__|~~|\*|_)                                 # маркеры начертания
+)""", re.VERBOSE)
+
+_MARKER_TAGS = {"**": "b", "__": "b", "*": "i", "_": "i", "~~": "s"}
+_ALLOWED_LINK_SCHEMES = ("http://", "https://", "tg://", "mailto:")
+
+def render_markdown(text: str) -> str:
+    """
+    Конвертирует markdown разметку в HTML, поддерживаемый Telegram, за один проход.
+
+    Весь текст вне тегов экранируется, незакрытые маркеры остаются обычным текстом,
+    поэтому результат всегда является корректным и сбалансированным HTML.
+
+    Args:
+        text: Текст с markdown разметкой
+
+    Returns:
+        str: Текст с HTML-тегами Telegram
+    """
+    # Маркеры markdown не содержат <, > и &, поэтому текст можно экранировать заранее целиком
+    text = escape(text, quote=False)
+    out: List[str] = []
+    # Открытые маркеры: (маркер, позиция открывающего тега в out)
+    stack: List[Tuple[str, int]] = []
+    position = 0
+
+    for match in _MARKDOWN_TOKEN.finditer(text):
+        start = match.start()
+        if start > position:
+            out.append(text[position:start])
+        position = match.end()
+
+        marker = match.group("marker")
+        if marker is not None:
+            before = text[start - 1] if start > 0 else " "
+            after = text[position] if position < len(text) else " "
+
+            if any(open_marker == marker for open_marker, _ in stack) and _can_close(marker, before, after):
+                # Закрываем маркер; вложенные незакрытые маркеры становятся обычным текстом
+                while stack:
+                    open_marker, index = stack.pop()
+                    if open_marker == marker:
+                        break
+                    out[index] = open_marker
+                out.append(f"</{_MARKER_TAGS[marker]}>")
+            elif _can_open(marker, before, after):
+                stack.append((marker, len(out)))
+                out.append(f"<{_MARKER_TAGS[marker]}>")
+            else:
+                out.append(marker)
+        elif match.group("code") is not None:
+            out.append(f"<code>{match.group('code')[1:-1]}</code>")
+        elif match.group("link_url") is not None:
+            url = match.group("link_url")
+            if url.lower().startswith(_ALLOWED_LINK_SCHEMES):
+                href = url.replace('"', "&quot;")
+                out.append(f'<a href="{href}">{match.group("link_text")}</a>')
+            else:
+                out.append(match.group(0))
+        # Блоки кода (fence) просто пропускаются
+
+    if position < len(text):
+        out.append(text[position:])
+
+    # Незакрытые маркеры выводим как обычный текст
+    for open_marker, index in stack:
+        out[index] = open_marker
+
+    return "".join(out)
+
+def _can_open(marker: str, before: str, after: str) -> bool:
+    """Маркер открывает выделение, если за ним идет текст, а подчеркивание не стоит внутри слова"""
+    if after.isspace():
+        return False
+    if marker[0] == "_" and before.isalnum():
+        return False
+    return True
+
+def _can_close(marker: str, before: str, after: str) -> bool:
+    """Маркер закрывает выделение, если перед ним текст, а подчеркивание не стоит внутри слова"""
+    if before.isspace():
+        return False
+    if marker[0] == "_" and after.isalnum():
+        return False
+    return True
+
+# Разбор готового HTML: теги, сущности и непрерывные куски текста
+_HTML_PIECE = re.compile(r'<(/?)([a-z]+)[^>]*>|&(?:#\d+|#x[0-9a-fA-F]+|[a-zA-Z]+);|[^<&]+|[<&]', re.IGNORECASE)
+
+# Границы разрыва в порядке предпочтения и сколько символов границы оставить в текущей части
+_BREAKS = (("\n\n", 2), ("\n", 1), (". ", 1), ("! ", 1), ("? ", 1), (" ", 1))
+
+def visible_length(text: str) -> int:
+    """Длина текста так, как ее считает Telegram (в единицах UTF-16)"""
+    return len(text.encode("utf-16-le")) // 2
+
+def split_html(html: str, max_length: int) -> List[str]:
+    """
+    Разбивает HTML Telegram на части, не разрывая теги.
+
+    Длина считается по видимому тексту (как в лимитах Telegram). Разрыв ищется на границе
+    абзаца, строки, предложения или слова; открытые на границе теги закрываются в конце
+    части и открываются заново в начале следующей.
+
+    Args:
+        html: Сбалансированный HTML (например, результат render_markdown)
+        max_length: Максимальная видимая длина одной части
+
+    Returns:
+        List[str]: Список частей
+    """
+    return _split_html(html, max_length, lambda visible, start: _find_cut(visible, start, max_length))
+
+def split_html_tail(html: str, max_length: int) -> Tuple[str, str]:
+    """
+    Отрезает от конца HTML последнюю часть видимой длины не больше max_length (подпись к фото),
+    по тем же правилам, что split_html: на границе абзаца, строки, предложения или слова.
+
+    Returns:
+        Tuple[str, str]: (начало, конец); начало пустое, если весь текст помещается в max_length.
+                         Начало может быть длиннее любого лимита — его режет split_html
+    """
+    tail_cut = None
+
+    def choose_cut(visible: str, start: int) -> int:
+        nonlocal tail_cut
+        if tail_cut is None:
+            tail_cut = _find_tail_cut(visible, max_length)
+        return tail_cut if start < tail_cut else len(visible)
+
+    chunks = _split_html(html, max_length, choose_cut)
+    if len(chunks) < 2:
+        return "", chunks[0] if chunks else ""
+    return chunks[0], chunks[1]
+
+def _split_html(html: str, max_length: int, choose_cut: Callable[[str, int], int]) -> List[str]:
+    """Разбивает HTML на части; choose_cut(видимый текст, начало части) возвращает конец части"""
+    # Видимый текст (сущность = один символ) и соответствие его позиций позициям в HTML
+    visible_parts = []
+    vis_starts: List[int] = []
+    raw_starts: List[int] = []
+    entity_flags: List[bool] = []
+    tags = []  # (начало, конец, имя, закрывающий ли, исходный текст)
+    vis_length = 0
+    for match in _HTML_PIECE.finditer(html):
+        raw = match.group(0)
+        if match.group(2):
+            tags.append((match.start(), match.end(), match.group(2).lower(), bool(match.group(1)), raw))
+            continue
+        is_entity = raw.startswith("&") and len(raw) > 1
+        vis_starts.append(vis_length)
+        raw_starts.append(match.start())
+        entity_flags.append(is_entity)
+        visible_parts.append("&" if is_entity else raw)
+        vis_length += 1 if is_entity else len(raw)
+    visible = "".join(visible_parts)
+
+    if visible_length(visible) <= max_length:
+        return [html]
+
+    def raw_position(vis_pos: int) -> int:
+        if vis_pos >= len(visible):
+            return len(html)
+        index = bisect_right(vis_starts, vis_pos) - 1
+        if entity_flags[index]:
+            return raw_starts[index]
+        return raw_starts[index] + vis_pos - vis_starts[index]
+
+    tag_ends = [end for _, end, _, _, _ in tags]
+
+    def raw_cut_position(vis_pos: int) -> int:
+        # Закрывающие теги прямо перед границей остаются в текущей части, открывающие уходят в следующую
+        raw_pos = raw_position(vis_pos)
+        index = bisect_right(tag_ends, raw_pos) - 1
+        run_start = raw_pos
+        first_open = None
+        while index >= 0 and tags[index][1] == run_start:
+            run_start = tags[index][0]
+            if not tags[index][3]:
+                first_open = run_start
+            index -= 1
+        return raw_pos if first_open is None else first_open
+
+    chunks = []
+    open_tags: List[Tuple[str, str]] = []  # (имя тега, открывающий тег) на начало текущей части
+    tag_index = 0
+    vis_pos = 0
+    raw_pos = 0
+    while vis_pos < len(visible):
+        # Пробелы на границе частей не переносим
+        while vis_pos < len(visible) and visible[vis_pos].isspace() and raw_position(vis_pos) == raw_pos:
+            vis_pos += 1
+            raw_pos += 1
+        if vis_pos >= len(visible):
+            break
+
+        cut = choose_cut(visible, vis_pos)
+        raw_cut = raw_cut_position(cut)
+
+        stack = list(open_tags)
+        while tag_index < len(tags) and tags[tag_index][0] < raw_cut:
+            _, _, name, is_close, raw = tags[tag_index]
+            if is_close:
+                if stack and stack[-1][0] == name:
+                    stack.pop()
+            else:
+                stack.append((name, raw))
+            tag_index += 1
+
+        body = html[raw_pos:raw_cut].rstrip()
+        if body:
+            chunk = "".join(raw for _, raw in open_tags) + body + "".join(f"</{name}>" for name, _ in reversed(stack))
+            chunks.append(chunk)
+
+        open_tags = stack
+        vis_pos = cut
+        raw_pos = raw_cut
+
+    return chunks
+
+def _find_tail_cut(visible: str, max_length: int) -> int:
+    """Возвращает позицию видимого текста, с которой начинается последняя часть не длиннее max_length"""
+    start = max(0, len(visible) - max_length)
+    # Символы вне BMP занимают в Telegram две единицы длины
+    excess = visible_length(visible[start:]) - max_length
+    while excess > 0:
+        start += (excess + 1) // 2
+        excess = visible_length(visible[start:]) - max_length
+    if start == 0:
+        return 0
+
+    # Предпочитаем более «крупную» границу, если она не слишком далеко от начала допустимого окна
+    for upper in (start + (len(visible) - start) // 2, len(visible)):
+        for separator, keep in _BREAKS:
+            position = visible.find(separator, start, upper)
+            if position != -1:
+                return position + keep
+    return start
+
+def _find_cut(visible: str, start: int, max_length: int) -> int:
+    """Возвращает позицию видимого текста, на которой нужно закончить часть, начинающуюся со start"""
+    end = start + max_length
+    # Символы вне BMP занимают в Telegram две единицы длины
+    excess = visible_length(visible[start:end]) - max_length
+    while excess > 0 and end > start + 1:
+        end = max(start + 1, end - (excess + 1) // 2)
+        excess = visible_length(visible[start:end]) - max_length
+    if end >= len(visible):
+        return len(visible)
+
+    # Предпочитаем более «крупную» границу, если она не слишком близко к началу части
+    for lower in (start + (end - start) // 2, start + 1):
+        for separator, keep in _BREAKS:
+            position = visible.rfind(separator, lower, end)
+            if position != -1:
+                return position + keep
+    return end
+
+if __name__ == "__main__":
+    # Сравнение производительности с прежней многопроходной конвертацией:
+    # python telegram_html.py
+    import timeit
+
+    def legacy_convert_markdown_to_html(text: str) -> str:
+        text = re.sub(r'\*\*(.*?)\*\*', r'<b>\1</b>', text)
+        text = re.sub(r'__(.*?)__', r'<b>\1</b>', text)
+        text = re.sub(r'\*(.*?)\*', r'<i>\1</i>', text)
+        text = re.sub(r'_(.*?)_', r'<i>\1</i>', text)
+        text = re.sub(r'`(.*?)`', r'<code>\1</code>', text)
+        text = re.sub(r'```.*?```', '', text, flags=re.DOTALL)
+        text = re.sub(r'\[([^\]]+)\]\(([^\)]+)\)', r'<a href="\2">\1</a>', text)
+        return text
+
+    sample = (
+        "### План на неделю\n\n"
+        "**Шаг 1.** Обсудите с ребенком *почему* учеба важна — без давления & упреков.\n"
+        "- Используйте правило 3 < 5: три коротких занятия лучше пяти длинных\n"
+        "- Хвалите за __усилия__, а не за оценки; ведите файл progress_log.txt\n"
+        "Подробнее в гайде: [Скачать гайд](https://mellow-fish-patx92z.gamma.site/)\n"
+        "```\nкод, который не нужен в Telegram\n```\n"
+        "Итог: `5 минут` в день дают больше, чем **2 часа** раз в неделю.\n\n"
+    ) * 8
+
+    iterations = 2000
+    legacy_time = timeit.timeit(lambda: legacy_convert_markdown_to_html(sample), number=iterations)
+    new_time = timeit.timeit(lambda: render_markdown(sample), number=iterations)
+    split_time = timeit.timeit(lambda: split_html(render_markdown(sample), 1024), number=iterations // 10)
+
+    print(f"Размер текста: {len(sample)} символов, итераций: {iterations}")
+    print(f"Прежняя конвертация: {legacy_time / iterations * 1e6:.1f} мкс на текст")
+    print(f"render_markdown:     {new_time / iterations * 1e6:.1f} мкс на текст")
+    print(f"render + split_html: {split_time / (iterations // 10) * 1e6:.1f} мкс на текст")
@@ -0,0 +1,196 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Any
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+from rate_limiter import TokenBucket
+from metrics import TELEGRAM_SEND_SECONDS, ERRORS
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты исходящих сообщений (меньше — важнее)
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BROADCAST = 10
+_PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_BROADCAST: "broadcast"}
+
+# Лимиты Telegram: около 30 сообщений в секунду на бота и около 1 сообщения в секунду в один чат
+GLOBAL_RATE = 30
+GLOBAL_BURST = 30
+CHAT_RATE = 1
+CHAT_BURST = 3  # Несколько частей одного ответа уходят без ожидания
+
+# Сколько раз повторять запрос после TelegramRetryAfter
+MAX_RETRY_ATTEMPTS = 3
+
+# Сколько чатов держать в памяти, прежде чем забывать неактивные
+MAX_TRACKED_CHATS = 10000
+
+# Сколько последних задержек хранить для статистики
+LATENCY_WINDOW = 1000
+
+# Методы API, на которые распространяются лимиты на отправку
+_RATE_LIMITED_PREFIXES = ("send", "edit", "copy", "forward")
+
+_current_priority: ContextVar[int] = ContextVar("outbound_priority", default=PRIORITY_INTERACTIVE)
+
+@contextmanager
+def send_priority(priority: int):
+    """
+    Задает приоритет всех отправок внутри блока (и в задачах, созданных внутри него).
+
+    Пример:
+        with send_priority(PRIORITY_BROADCAST):
+            await bot.send_message(...)
+    """
+    token = _current_priority.set(priority)
+    try:
+        yield
+    finally:
+        _current_priority.reset(token)
+
+class OutboundScheduler(BaseRequestMiddleware):
+    def __init__(self, global_rate: float = GLOBAL_RATE, global_burst: float = GLOBAL_BURST,
+                 chat_rate: float = CHAT_RATE, chat_burst: float = CHAT_BURST):
+        """
+        Общий планировщик исходящих запросов к Telegram.
+
+        Подключается как middleware сессии бота, поэтому через него проходят все вызовы
+        (message.answer, bot.send_message, bot.send_photo и т.д.) без изменений в обработчиках.
+        Сообщения в один чат уходят строго по порядку, общий поток ограничивается token bucket,
+        интерактивные ответы обслуживаются раньше рассылки, а TelegramRetryAfter
+        обрабатывается автоматически.
+        """
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chats: Dict[Any, Dict[str, Any]] = {}  # chat_id -> {"lock", "bucket", "users"}
+
+        self.queued: Dict[int, int] = {}  # Приоритет -> запросов в ожидании
+        self.in_flight = 0
+        self.sent = 0
+        self.retries = 0
+        self.failed = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)  # Полное время: ожидание + запрос
+        self.waits = deque(maxlen=LATENCY_WINDOW)  # Только ожидание в очереди
+
+    async def __call__(self, make_request, bot: Bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        api_method = getattr(method, "__api_method__", "")
+        if chat_id is None or not api_method.startswith(_RATE_LIMITED_PREFIXES):
+            return await make_request(bot, method)
+
+        priority = _current_priority.get()
+        started = time.monotonic()
+        chat = self._get_chat(chat_id)
+        chat["users"] += 1
+        self.queued[priority] = self.queued.get(priority, 0) + 1
+        queued = True
+        try:
+            # Блокировка чата (FIFO) гарантирует порядок сообщений внутри одного чата
+            async with chat["lock"]:
+                for attempt in range(MAX_RETRY_ATTEMPTS):
+                    await chat["bucket"].acquire(priority)
+                    await self.global_bucket.acquire(priority)
+                    if queued:
+                        self.queued[priority] -= 1
+                        queued = False
+                        self.waits.append(time.monotonic() - started)
+
+                    self.in_flight += 1
+                    try:
+                        # Ожидание в очереди планировщика — атрибут этапа, сам этап — запрос к Telegram
+                        wait_ms = round((time.monotonic() - started) * 1000)
+                        with span(f"telegram.{api_method}", wait_ms=wait_ms, attempt=attempt + 1):
+                            result = await make_request(bot, method)
+                    except TelegramRetryAfter as e:
+                        self.retries += 1
+                        if attempt == MAX_RETRY_ATTEMPTS - 1:
+                            raise
+                        logger.warning(
+                            f"[ОТПРАВКА] Telegram просит подождать {e.retry_after}с перед {api_method} в чат {chat_id} "
+                            f"(попытка {attempt + 1}/{MAX_RETRY_ATTEMPTS})"
+                        )
+                        chat["bucket"].pause(e.retry_after)
+                        continue
+                    finally:
+                        self.in_flight -= 1
+
+                    self.sent += 1
+                    latency = time.monotonic() - started
+                    self.latencies.append(latency)
+                    TELEGRAM_SEND_SECONDS.labels(api_method).observe(latency)
+                    return result
+        except Exception as e:
+            self.failed += 1
+            ERRORS.labels("telegram", type(e).__name__).inc()
+            raise
+        finally:
+            if queued:
+                self.queued[priority] -= 1
+            chat["users"] -= 1
+            self._forget_idle_chats()
+
+    def _get_chat(self, chat_id) -> Dict[str, Any]:
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            chat = {"lock": asyncio.Lock(), "bucket": TokenBucket(self.chat_rate, self.chat_burst), "users": 0}
+            self.chats[chat_id] = chat
+        return chat
+
+    def _forget_idle_chats(self) -> None:
+        """Удаляет состояние чатов, в которые давно ничего не отправлялось"""
+        if len(self.chats) <= MAX_TRACKED_CHATS:
+            return
+        idle = [chat_id for chat_id, chat in self.chats.items() if chat["users"] == 0 and chat["bucket"].idle]
+        for chat_id in idle:
+            del self.chats[chat_id]
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        Возвращает метрики планировщика.
+
+        Returns:
+            Dict: Глубина очереди (всего и по приоритетам), число запросов в работе,
+                  счетчики и задержки отправки в секундах
+        """
+        latencies = sorted(self.latencies)
+        return {
+            "queue_depth": sum(self.queued.values()),
+            "queue_depth_by_priority": {
+                _PRIORITY_NAMES.get(priority, str(priority)): count for priority, count in self.queued.items()
+            },
+            "in_flight": self.in_flight,
+            "sent": self.sent,
+            "retries": self.retries,
+            "failed": self.failed,
+            "tracked_chats": len(self.chats),
+            "wait_avg": sum(self.waits) / len(self.waits) if self.waits else 0.0,
+            "latency_avg": sum(latencies) / len(latencies) if latencies else 0.0,
+            "latency_p95": latencies[int(len(latencies) * 0.95) - 1] if latencies else 0.0,
+            "latency_max": latencies[-1] if latencies else 0.0
+        }
+
+def setup_outbound_scheduler(bot: Bot, share: int = 1) -> OutboundScheduler:
+    """
+    Подключает планировщик к сессии бота и сохраняет его в bot.outbound_scheduler.
+
+    Args:
+        bot: Бот
+        share: На сколько процессов делится общий лимит Telegram (обработчики при sharding)
+    """
+    scheduler = OutboundScheduler(global_rate=GLOBAL_RATE / share, global_burst=max(1, GLOBAL_BURST // share))
+    bot.session.middleware(scheduler)
+    bot.outbound_scheduler = scheduler
+    logger.info(
+        f"Планировщик исходящих сообщений подключен: {GLOBAL_RATE / share:g} сообщений/с всего, "
+        f"{CHAT_RATE} сообщений/с на чат (всплеск до {CHAT_BURST})"
+    )
+    return scheduler
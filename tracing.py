@@ -0,0 +1,248 @@
+"""
+Трассировка обработки сообщений: дерево этапов (span) для каждого ответа пользователю.
+
+Трасса начинается в deepseek_router, когда очередь сообщений передает вопрос в обработку,
+и включает ожидание в очереди, выбор модели, проверку модели, запросы к DeepSeek, сборку промпта
+и каждый вызов Telegram (текст, картинка эмоции). Последние трассы хранятся в кольцевом буфере;
+медленные сразу пишутся в лог целиком, /slow_traces показывает самые медленные из буфера,
+а export_jsonl выгружает буфер в JSONL.
+"""
+import os
+import json
+import time
+import uuid
+import logging
+import functools
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Сколько последних трасс хранить в памяти
+TRACE_BUFFER_SIZE = int(os.getenv('TRACE_BUFFER_SIZE', '500'))
+
+# Обработка дольше порога записывается в журнал медленных запросов (секунд)
+TRACE_SLOW_SECONDS = float(os.getenv('TRACE_SLOW_SECONDS', '30'))
+
+# Журнал медленных запросов (JSONL, по строке на трассу) и файл выгрузки буфера
+TRACE_SLOW_LOG = os.getenv('TRACE_SLOW_LOG', 'logs/slow_traces.jsonl')
+TRACE_EXPORT_FILE = os.getenv('TRACE_EXPORT_FILE', 'logs/traces.jsonl')
+
+class Span:
+    __slots__ = ("span_id", "parent_id", "name", "start", "end", "attrs", "error")
+
+    def __init__(self, span_id: int, parent_id: Optional[int], name: str, start: float, attrs: Dict[str, Any]):
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.name = name
+        self.start = start
+        self.end: Optional[float] = None
+        self.attrs = attrs
+        self.error: Optional[str] = None
+
+class Trace:
+    def __init__(self, name: str, user_id: int, started: Optional[float] = None, **attrs):
+        """
+        Трасса одного ответа пользователю.
+
+        Args:
+            name: Имя корневого этапа
+            user_id: ID пользователя
+            started: Начало по time.perf_counter() (по умолчанию — сейчас)
+            attrs: Атрибуты корневого этапа
+        """
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.user_id = user_id
+        self.started = started if started is not None else time.perf_counter()
+        self.started_at = time.time() - (time.perf_counter() - self.started)
+        self.spans: List[Span] = []
+        self.root = self.open(name, None, attrs, self.started)
+
+    def open(self, name: str, parent: Optional[Span], attrs: Dict[str, Any], start: Optional[float] = None) -> Span:
+        span = Span(len(self.spans), parent.span_id if parent else None, name,
+                    start if start is not None else time.perf_counter(), attrs)
+        self.spans.append(span)
+        return span
+
+    def add_span(self, name: str, start: float, end: float, parent: Optional[Span] = None, **attrs) -> Span:
+        """Добавляет уже завершившийся этап (например, ожидание в очереди)"""
+        span = self.open(name, parent or self.root, attrs, start)
+        span.end = end
+        return span
+
+    @property
+    def duration(self) -> float:
+        end = self.root.end if self.root.end is not None else time.perf_counter()
+        return end - self.started
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Трасса для JSONL: времена этапов в миллисекундах от начала трассы"""
+        now = time.perf_counter()
+        return {
+            "trace_id": self.trace_id,
+            "user_id": self.user_id,
+            "started_at": datetime.fromtimestamp(self.started_at).isoformat(timespec="milliseconds"),
+            "duration_ms": round(self.duration * 1000, 1),
+            "spans": [
+                {
+                    "id": span.span_id,
+                    "parent": span.parent_id,
+                    "name": span.name,
+                    "start_ms": round((span.start - self.started) * 1000, 1),
+                    "duration_ms": round(((span.end if span.end is not None else now) - span.start) * 1000, 1),
+                    **({"attrs": span.attrs} if span.attrs else {}),
+                    **({"error": span.error} if span.error else {})
+                }
+                for span in self.spans
+            ]
+        }
+
+def format_trace(trace: Dict[str, Any]) -> str:
+    """
+    Дерево этапов трассы (из to_dict) для лога и админской команды:
+        Трасса 3f2a... пользователя 123 (2026-01-01T12:00:00.000): 81234 мс
+          deepseek_router +0 мс 81234 мс
+            inbox +0 мс 1502 мс
+            handle_deepseek_message +1502 мс 79730 мс outcome=ok
+              routing +1510 мс 820 мс timeout=10.0 ...
+    """
+    children: Dict[Optional[int], List[Dict[str, Any]]] = {}
+    for span in trace["spans"]:
+        children.setdefault(span["parent"], []).append(span)
+
+    lines = [f"Трасса {trace['trace_id']} пользователя {trace['user_id']} ({trace['started_at']}): {trace['duration_ms']:.0f} мс"]
+
+    def walk(parent: Optional[int], depth: int) -> None:
+        for span in children.get(parent, []):
+            parts = [f"{'  ' * depth}{span['name']} +{span['start_ms']:.0f} мс {span['duration_ms']:.0f} мс"]
+            parts.extend(f"{key}={value}" for key, value in span.get("attrs", {}).items())
+            if span.get("error"):
+                parts.append(f"ОШИБКА {span['error']}")
+            lines.append(" ".join(parts))
+            walk(span["id"], depth + 1)
+
+    walk(None, 1)
+    return "\n".join(lines)
+
+_current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+@contextmanager
+def span(name: str, **attrs):
+    """
+    Этап текущей трассы. Вне трассы ничего не делает и возвращает None.
+
+    Пример:
+        with span("make_deepseek_request", model=model) as current:
+            ...
+            if current:
+                current.attrs["tokens"] = 120
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield None
+        return
+    current = trace.open(name, _current_span.get(), attrs)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = type(e).__name__
+        raise
+    finally:
+        current.end = time.perf_counter()
+        _current_span.reset(token)
+
+def set_attrs(**attrs) -> None:
+    """Добавляет атрибуты текущему этапу (вне трассы ничего не делает)"""
+    current = _current_span.get()
+    if current is not None:
+        current.attrs.update(attrs)
+
+def traced(name: Optional[str] = None):
+    """Декоратор асинхронной функции: ее вызов записывается этапом текущей трассы"""
+    def decorate(func):
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with span(span_name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+@contextmanager
+def start_trace(name: str, user_id: int, started: Optional[float] = None, **attrs):
+    """Начинает трассу в текущей задаче; по завершении она записывается в буфер"""
+    trace = Trace(name, user_id, started, **attrs)
+    trace_token = _current_trace.set(trace)
+    span_token = _current_span.set(trace.root)
+    try:
+        yield trace
+    except BaseException as e:
+        trace.root.error = type(e).__name__
+        raise
+    finally:
+        trace.root.end = time.perf_counter()
+        _current_span.reset(span_token)
+        _current_trace.reset(trace_token)
+        trace_recorder.record(trace)
+
+class TraceRecorder:
+    def __init__(self, size: int = TRACE_BUFFER_SIZE, slow_seconds: float = TRACE_SLOW_SECONDS,
+                 slow_log: str = TRACE_SLOW_LOG):
+        """
+        Кольцевой буфер последних трасс и журнал медленных запросов.
+
+        Args:
+            size: Сколько трасс хранить
+            slow_seconds: Порог медленного запроса
+            slow_log: JSONL-файл медленных запросов
+        """
+        self.buffer: deque = deque(maxlen=size)
+        self.slow_seconds = slow_seconds
+        self.slow_log = slow_log
+        self.stats = {"recorded": 0, "slow": 0}
+
+    def record(self, trace: Trace) -> None:
+        self.buffer.append(trace)
+        self.stats["recorded"] += 1
+        if trace.duration < self.slow_seconds:
+            return
+        self.stats["slow"] += 1
+        data = trace.to_dict()
+        logger.warning(f"[ТРАССА] Медленный запрос (порог {self.slow_seconds:g}с):\n{format_trace(data)}")
+        # Медленные запросы редки, поэтому строка дописывается сразу
+        try:
+            os.makedirs(os.path.dirname(self.slow_log) or '.', exist_ok=True)
+            with open(self.slow_log, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(data, ensure_ascii=False) + "\n")
+        except OSError as e:
+            logger.error(f"[ТРАССА] Не удалось записать медленный запрос в {self.slow_log}: {e}")
+
+    def slowest(self, limit: int = 5) -> List[Dict[str, Any]]:
+        """Самые медленные трассы из буфера (в формате to_dict)"""
+        traces = sorted(self.buffer, key=lambda trace: trace.duration, reverse=True)[:limit]
+        return [trace.to_dict() for trace in traces]
+
+    def export_jsonl(self, path: str = TRACE_EXPORT_FILE) -> int:
+        """
+        Выгружает буфер в JSONL (файл перезаписывается).
+
+        Returns:
+            int: Количество выгруженных трасс
+        """
+        traces = list(self.buffer)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for trace in traces:
+                f.write(json.dumps(trace.to_dict(), ensure_ascii=False) + "\n")
+        os.replace(tmp_path, path)
+        return len(traces)
+
+# Трассы процесса
+trace_recorder = TraceRecorder()
@@ -2,19 +2,22 @@ import json
 import os
 import logging
 from datetime import datetime
-from typing import Dict, Any, Optional
+from typing import Callable, Dict, Any, Optional
 
 logger = logging.getLogger(__name__)
 
 class UserDataManager:
-    def __init__(self, data_dir: str = "user_data"):
+    def __init__(self, data_dir: str = "user_data", user_filter: Optional[Callable[[int], bool]] = None):
         """
         Инициализация менеджера данных пользователей
         
         Args:
             data_dir: Директория для хранения файлов с данными пользователей
+            user_filter: get_all_users_data возвращает только пользователей, для которых функция
+                возвращает True (данные обработчика при разделении на процессы)
         """
         self.data_dir = data_dir
+        self.user_filter = user_filter
         self._ensure_data_dir()
         
     def _ensure_data_dir(self) -> None:
@@ -112,6 +115,8 @@ class UserDataManager:
             if filename.startswith("user_") and filename.endswith(".json"):
                 try:
                     user_id = int(filename[5:-5])  # Извлекаем ID из имени файла
+                    if self.user_filter and not self.user_filter(user_id):
+                        continue
                     users_data[user_id] = self.get_user_data(user_id)
                 except Exception as e:
                     logger.error(f"Ошибка при чтении файла {filename}: {e}")
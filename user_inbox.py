@@ -0,0 +1,186 @@
+import os
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List
+
+from aiogram.types import Message
+
+from request_context import (
+    RequestContext, set_request_context, CANCEL_SUPERSEDED, REASON_SUPERSEDED, REASON_RESET, REASON_SHUTDOWN
+)
+
+logger = logging.getLogger(__name__)
+
+# Сообщения, пришедшие с паузой меньше этой, объединяются в один вопрос (секунд)
+INBOX_DEBOUNCE_SECONDS = float(os.getenv('INBOX_DEBOUNCE_SECONDS', '1.5'))
+
+# Дольше этого с первого сообщения пачки ответ не откладывается, даже если пользователь продолжает писать
+INBOX_MAX_WAIT_SECONDS = float(os.getenv('INBOX_MAX_WAIT_SECONDS', '6'))
+
+# При остановке: сколько после отмены генераций ждать ответы, которые уже отправляются (секунд)
+INBOX_DELIVERY_GRACE_SECONDS = 10.0
+
+MessageProcessor = Callable[[Message], Awaitable[None]]
+
+def merge_messages(messages: List[Message]) -> Message:
+    """
+    Объединяет несколько сообщений пользователя в одно.
+    Ответ будет отправлен на последнее из них.
+    """
+    if len(messages) == 1:
+        return messages[0]
+    text = "\n".join(message.text for message in messages if message.text)
+    return messages[-1].model_copy(update={"text": text})
+
+class UserInbox:
+    def __init__(self, debounce: float = INBOX_DEBOUNCE_SECONDS, max_wait: float = INBOX_MAX_WAIT_SECONDS):
+        """
+        Очередь входящих сообщений перед обработчиком DeepSeek.
+
+        Сообщения одного пользователя обрабатываются строго по очереди (одна задача на пользователя),
+        а сообщения, присланные подряд, объединяются в один запрос к модели.
+
+        Args:
+            debounce: Пауза, после которой накопленные сообщения отправляются в обработку
+            max_wait: Максимальная задержка с первого сообщения пачки
+        """
+        self.debounce = debounce
+        self.max_wait = max_wait
+        self.pending: Dict[int, List[Message]] = {}
+        self.processors: Dict[int, MessageProcessor] = {}
+        self.first_arrival: Dict[int, float] = {}
+        self.last_arrival: Dict[int, float] = {}
+        self.workers: Dict[int, asyncio.Task] = {}
+        self.active: Dict[int, RequestContext] = {}
+        # Остановка: пауза объединения больше не выдерживается, а после stopped новые запросы не начинаются
+        self.closing = asyncio.Event()
+        self.stopped = False
+        self.stats = {"received": 0, "turns": 0, "coalesced": 0, "superseded": 0, "reset": 0}
+
+    def submit(self, message: Message, process: MessageProcessor) -> None:
+        """
+        Ставит сообщение в очередь пользователя (не дожидаясь обработки).
+
+        Args:
+            message: Входящее сообщение
+            process: Обработчик объединенного сообщения
+        """
+        user_id = message.from_user.id
+        now = asyncio.get_running_loop().time()
+        if not self.pending.get(user_id):
+            self.first_arrival[user_id] = now
+        self.pending.setdefault(user_id, []).append(message)
+        self.processors[user_id] = process
+        self.last_arrival[user_id] = now
+        self.stats["received"] += 1
+        if user_id not in self.workers:
+            self.workers[user_id] = asyncio.create_task(self._drain(user_id))
+        elif CANCEL_SUPERSEDED and user_id in self.active:
+            # Ответ на предыдущее сообщение еще генерируется: отменяем его, вопросы будут обработаны вместе
+            if self.active[user_id].cancel(REASON_SUPERSEDED):
+                self.stats["superseded"] += 1
+
+    def reset(self, user_id: int) -> None:
+        """Сбрасывает очередь пользователя (/reset): ждущие сообщения удаляются, текущая генерация отменяется"""
+        self.pending.pop(user_id, None)
+        self.processors.pop(user_id, None)
+        context = self.active.get(user_id)
+        if context and context.cancel(REASON_RESET):
+            self.stats["reset"] += 1
+
+    async def _run_turn(self, context: RequestContext, process: MessageProcessor, message: Message) -> None:
+        set_request_context(context)
+        await process(message)
+
+    async def _wait_quiet(self, user_id: int) -> None:
+        """Ждет паузы в сообщениях пользователя, но не дольше max_wait с первого сообщения пачки"""
+        loop = asyncio.get_running_loop()
+        while not self.closing.is_set():
+            deadline = min(self.last_arrival[user_id] + self.debounce, self.first_arrival[user_id] + self.max_wait)
+            delay = deadline - loop.time()
+            if delay <= 0:
+                return
+            try:
+                await asyncio.wait_for(self.closing.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _drain(self, user_id: int) -> None:
+        try:
+            while self.pending.get(user_id) and not self.stopped:
+                await self._wait_quiet(user_id)
+                # Очередь могла быть сброшена командой /reset во время ожидания
+                messages = self.pending.pop(user_id, None)
+                process = self.processors.pop(user_id, None)
+                if not messages:
+                    break
+                self.stats["turns"] += 1
+                if len(messages) > 1:
+                    self.stats["coalesced"] += len(messages) - 1
+                    logger.info(f"[ОЧЕРЕДЬ] {len(messages)} сообщений пользователя {user_id} объединены в один запрос")
+                context = RequestContext(user_id)
+                turn = asyncio.create_task(self._run_turn(context, process, merge_messages(messages)))
+                context.task = turn
+                self.active[user_id] = context
+                try:
+                    # wait не поднимает исключение отмененной задачи: отмена хода не останавливает очередь
+                    await asyncio.wait([turn])
+                finally:
+                    self.active.pop(user_id, None)
+                    if not turn.done():
+                        # Остановлена сама очередь (завершение работы бота)
+                        turn.cancel()
+
+                if turn.cancelled():
+                    # Вопрос, не попавший в историю диалога, объединяется со следующими сообщениями
+                    if context.cancel_reason != REASON_RESET and not context.committed and user_id in self.pending:
+                        self.pending[user_id] = messages + self.pending[user_id]
+                elif turn.exception():
+                    # Обработчик сам отвечает пользователю об ошибке; очередь продолжает работу
+                    logger.error(f"[ОЧЕРЕДЬ] Ошибка при обработке сообщения пользователя {user_id}: {turn.exception()}")
+        finally:
+            self.workers.pop(user_id, None)
+            self.first_arrival.pop(user_id, None)
+            self.last_arrival.pop(user_id, None)
+
+    async def drain(self, timeout: float) -> Dict[str, int]:
+        """
+        Останавливает очередь при завершении работы бота.
+
+        Накопленные сообщения сразу уходят в обработку (без паузы объединения), начатые ответы
+        дописываются. По истечении timeout генерации отменяются; ответы, которые уже отправляются,
+        получают еще INBOX_DELIVERY_GRACE_SECONDS.
+
+        Returns:
+            Dict[str, int]: completed — запросов обработано за время остановки,
+                interrupted — генераций отменено, dropped — сообщений осталось без ответа
+        """
+        self.closing.set()
+        turns_before = self.stats["turns"] - len(self.active)
+        interrupted = 0
+        if self.workers:
+            await asyncio.wait(list(self.workers.values()), timeout=timeout)
+        self.stopped = True
+        for context in list(self.active.values()):
+            if context.cancel(REASON_SHUTDOWN):
+                interrupted += 1
+        if self.workers:
+            _, pending = await asyncio.wait(list(self.workers.values()), timeout=INBOX_DELIVERY_GRACE_SECONDS)
+            for worker in pending:
+                worker.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        dropped = sum(len(messages) for messages in self.pending.values())
+        self.pending.clear()
+        self.processors.clear()
+        completed = self.stats["turns"] - turns_before - interrupted
+        return {"completed": completed, "interrupted": interrupted, "dropped": dropped}
+
+    def get_stats(self) -> Dict[str, int]:
+        """Счетчики очереди: принято сообщений, запросов к модели, сэкономлено объединением, отменено генераций"""
+        stats = dict(self.stats)
+        stats["active_users"] = len(self.workers)
+        stats["queued"] = sum(len(messages) for messages in self.pending.values())
+        return stats
+
+# Общая очередь входящих сообщений процесса
+user_inbox = UserInbox()
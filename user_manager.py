@@ -5,28 +5,43 @@ import os
 import logging
 
 class UserManager:
-    def __init__(self, file_path='user_ids.json'):
+    def __init__(self, file_path='user_ids.json', seed_path=None, user_filter=None):
+        """
+        Args:
+            file_path: JSON файл со списком user_ids
+            seed_path: Файл, из которого берется начальный список, если file_path еще нет
+                (общий список при переходе на несколько обработчиков)
+            user_filter: Оставлять только пользователей, для которых функция возвращает True
+        """
         self.file_path = file_path
+        self.user_filter = user_filter
         self.user_ids = self._load_user_ids()
+        if not os.path.exists(self.file_path) and seed_path and os.path.exists(seed_path):
+            self.user_ids = self._load_user_ids(seed_path)
+            self.save_user_ids()
+            logging.info(f"Список пользователей {self.file_path} создан из {seed_path}")
         logging.info(f"UserManager инициализирован. Загружено {len(self.user_ids)} уникальных user_ids.")
 
-    def _load_user_ids(self):
+    def _load_user_ids(self, file_path=None):
         """Загружает user_ids из JSON файла."""
-        if not os.path.exists(self.file_path):
+        file_path = file_path or self.file_path
+        if not os.path.exists(file_path):
             return set()
         try:
-            with open(self.file_path, 'r', encoding='utf-8') as f:
+            with open(file_path, 'r', encoding='utf-8') as f:
                 data = json.load(f)
-                logging.info(f"DEBUG: Загружено из файла {self.file_path}: {data}")
+                logging.info(f"DEBUG: Загружено из файла {file_path}: {data}")
                 # Убедимся, что загружаем set, если в файле list
                 result_set = set(data)
+                if self.user_filter:
+                    result_set = {user_id for user_id in result_set if self.user_filter(user_id)}
                 logging.info(f"DEBUG: После конвертации в set: {result_set}")
                 return result_set
         except json.JSONDecodeError:
-            logging.error(f"Ошибка декодирования JSON из файла {self.file_path}. Файл будет перезаписан.")
+            logging.error(f"Ошибка декодирования JSON из файла {file_path}. Файл будет перезаписан.")
             return set()
         except Exception as e:
-            logging.error(f"Ошибка при загрузке user_ids из файла {self.file_path}: {e}", exc_info=True)
+            logging.error(f"Ошибка при загрузке user_ids из файла {file_path}: {e}", exc_info=True)
             return set()
 
     def save_user_ids(self):
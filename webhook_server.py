@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+Прием обновлений Telegram через webhook (BOT_MODE=webhook) вместо long polling.
+
+Проверка локально без Telegram — отправить фейковое обновление на работающий сервер:
+    python webhook_server.py --text "Привет" --user-id 12345
+"""
+import os
+import hmac
+import time
+import random
+import asyncio
+import logging
+import argparse
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from aiohttp import web, ClientSession
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+logger = logging.getLogger(__name__)
+
+# Публичный адрес, который Telegram будет вызывать (https://example.com/webhook)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+
+# Telegram передает его в заголовке X-Telegram-Bot-Api-Secret-Token; без него запросы отклоняются
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+# Обработчики обновлений и предел очереди: при переполнении отвечаем 503, и Telegram повторит доставку позже
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '16'))
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', '1000'))
+
+# Сколько последних update_id помнить, чтобы не обработать повторную доставку дважды
+RECENT_UPDATES_LIMIT = 10000
+
+# Сколько ждать обработки принятых обновлений при остановке (секунд)
+WEBHOOK_DRAIN_TIMEOUT = 10.0
+
+class WebhookServer:
+    def __init__(self, dp: Optional[Dispatcher], bot: Bot, path: str = WEBHOOK_PATH, secret: str = WEBHOOK_SECRET,
+                 workers: int = WEBHOOK_WORKERS, queue_size: int = WEBHOOK_QUEUE_SIZE,
+                 forward: Optional[Callable[[Dict[str, Any]], Awaitable[Any]]] = None,
+                 allowed_updates: Optional[List[str]] = None):
+        """
+        Встроенный aiohttp-сервер для webhook Telegram.
+
+        Запрос проверяется и ставится в очередь, ответ 200 отправляется сразу;
+        обновления обрабатывают workers задач.
+
+        Args:
+            dp: Диспетчер aiogram
+            bot: Бот
+            path: Путь webhook
+            secret: Секретный токен webhook
+            workers: Количество обработчиков
+            queue_size: Предел очереди принятых обновлений
+            forward: Вместо обработки в dp передавать обновление (dict) этой функции —
+                входной процесс при разделении на обработчики (sharding)
+            allowed_updates: Типы обновлений для Telegram (по умолчанию — используемые в dp)
+        """
+        self.dp = dp
+        self.bot = bot
+        self.path = path
+        self.secret = secret
+        self.workers = workers
+        self.forward = forward
+        self.allowed_updates = allowed_updates
+        self.queue: asyncio.Queue = asyncio.Queue(queue_size)
+        self.recent_updates: "OrderedDict[int, None]" = OrderedDict()
+        self.runner: Optional[web.AppRunner] = None
+        self.worker_tasks: List[asyncio.Task] = []
+        self.stats = {"received": 0, "processed": 0, "failed": 0, "rejected": 0, "duplicates": 0, "unauthorized": 0}
+        self.queue_wait_max = 0.0
+
+    async def handle(self, request: web.Request) -> web.Response:
+        """Принимает обновление: проверка токена, постановка в очередь, немедленный ответ"""
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), self.secret):
+            self.stats["unauthorized"] += 1
+            return web.Response(status=401)
+        try:
+            data = await request.json()
+            update_id = data["update_id"]
+        except Exception:
+            return web.Response(status=400)
+
+        if update_id in self.recent_updates:
+            self.stats["duplicates"] += 1
+            return web.Response()
+        try:
+            self.queue.put_nowait((data, time.perf_counter()))
+        except asyncio.QueueFull:
+            self.stats["rejected"] += 1
+            logger.warning(f"[WEBHOOK] Очередь обновлений заполнена ({self.queue.qsize()}), обновление {update_id} отклонено")
+            return web.Response(status=503)
+
+        self.recent_updates[update_id] = None
+        if len(self.recent_updates) > RECENT_UPDATES_LIMIT:
+            self.recent_updates.popitem(last=False)
+        self.stats["received"] += 1
+        return web.Response()
+
+    async def _worker(self) -> None:
+        while True:
+            data, received_at = await self.queue.get()
+            self.queue_wait_max = max(self.queue_wait_max, time.perf_counter() - received_at)
+            try:
+                if self.forward:
+                    await self.forward(data)
+                else:
+                    update = Update.model_validate(data, context={"bot": self.bot})
+                    await self.dp.feed_update(self.bot, update)
+                self.stats["processed"] += 1
+            except Exception as e:
+                self.stats["failed"] += 1
+                logger.error(f"[WEBHOOK] Ошибка при обработке обновления {data.get('update_id')}: {e}", exc_info=True)
+            finally:
+                self.queue.task_done()
+
+    async def start(self, host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT, url: str = WEBHOOK_URL) -> None:
+        """Запускает сервер и обработчики, регистрирует webhook в Telegram"""
+        if not self.secret:
+            raise ValueError("WEBHOOK_SECRET не установлен: без секретного токена webhook принимал бы чужие запросы")
+
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        self.worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logger.info(f"[WEBHOOK] Сервер запущен на {host}:{port}{self.path}, обработчиков: {self.workers}")
+
+        if url:
+            await self.bot.set_webhook(
+                url=url,
+                secret_token=self.secret,
+                allowed_updates=self.allowed_updates if self.allowed_updates is not None else self.dp.resolve_used_update_types(),
+                drop_pending_updates=True
+            )
+            logger.info(f"[WEBHOOK] Webhook зарегистрирован в Telegram: {url}")
+        else:
+            logger.warning("[WEBHOOK] WEBHOOK_URL не задан: webhook в Telegram не регистрируется (локальная проверка)")
+
+    async def stop(self) -> None:
+        """Перестает принимать запросы, дожидается обработки принятых обновлений и останавливает обработчики"""
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+        try:
+            await asyncio.wait_for(self.queue.join(), WEBHOOK_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"[WEBHOOK] За {WEBHOOK_DRAIN_TIMEOUT}с не обработано {self.queue.qsize()} обновлений")
+        for task in self.worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self.worker_tasks, return_exceptions=True)
+        self.worker_tasks = []
+        logger.info(f"[WEBHOOK] Сервер остановлен. Статистика: {self.get_stats()}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = dict(self.stats)
+        stats["queue_depth"] = self.queue.qsize()
+        stats["queue_wait_max"] = self.queue_wait_max
+        return stats
+
+def build_fake_update(update_id: int, user_id: int, text: str) -> Dict[str, Any]:
+    """Обновление в формате Telegram с текстовым сообщением из личного чата"""
+    user = {"id": user_id, "is_bot": False, "first_name": "Test", "username": f"test{user_id}"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": "Test"},
+            "from": user,
+            "text": text
+        }
+    }
+
+async def send_fake_update(url: str, secret: str, user_id: int, text: str) -> int:
+    """Отправляет фейковое обновление на webhook и возвращает HTTP-статус ответа"""
+    update = build_fake_update(random.randrange(1, 2**31), user_id, text)
+    async with ClientSession() as session:
+        async with session.post(url, json=update, headers={SECRET_HEADER: secret}) as response:
+            return response.status
+
+def main():
+    from dotenv import load_dotenv
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Отправка фейкового обновления на локальный webhook")
+    parser.add_argument("--url", default=f"http://127.0.0.1:{WEBHOOK_PORT}{WEBHOOK_PATH}", help="Адрес webhook")
+    parser.add_argument("--secret", default=os.getenv('WEBHOOK_SECRET', ''), help="Секретный токен (по умолчанию WEBHOOK_SECRET)")
+    parser.add_argument("--user-id", type=int, required=True, help="ID пользователя, от имени которого идет сообщение")
+    parser.add_argument("--text", required=True, help="Текст сообщения")
+    args = parser.parse_args()
+    status = asyncio.run(send_fake_update(args.url, args.secret, args.user_id, args.text))
+    logger.info(f"Ответ webhook: HTTP {status}")
+
+if __name__ == "__main__":
+    main()